@@ -29,6 +29,49 @@ class UserService:
         cache.set(key, profile)
         return profile
 
+    @classmethod
+    def get_profiles_through_cache(cls, user_ids):
+        """
+        批量获取 profiles，返回 {user_id: profile}
+        一次 get_many 读 memcached，miss 的部分用一条 IN query 补齐
+        """
+        user_ids = {user_id for user_id in user_ids if user_id is not None}
+        key_to_user_id = {
+            USER_PROFILE_PATTERN.format(user_id=user_id): user_id
+            for user_id in user_ids
+        }
+        cached = cache.get_many(list(key_to_user_id.keys()))
+        profiles = {key_to_user_id[key]: profile for key, profile in cached.items()}
+
+        # cache miss, read from db
+        missing_user_ids = user_ids - profiles.keys()
+        if not missing_user_ids:
+            return profiles
+        for profile in UserProfile.objects.filter(user_id__in=missing_user_ids):
+            profiles[profile.user_id] = profile
+        # 还没有 profile 的用户和单个获取时一样走 get_or_create
+        for user_id in missing_user_ids - profiles.keys():
+            profiles[user_id], _ = UserProfile.objects.get_or_create(user_id=user_id)
+        cache.set_many({
+            USER_PROFILE_PATTERN.format(user_id=user_id): profiles[user_id]
+            for user_id in missing_user_ids
+        })
+        return profiles
+
+    @classmethod
+    def get_users_through_cache(cls, user_ids):
+        """
+        批量获取 users 以及他们的 profiles，返回 {user_id: user}
+        users 和 profiles 各需要一次 memcached get_many
+        """
+        users = MemcachedHelper.get_objects_through_cache(User, user_ids)
+        profiles = cls.get_profiles_through_cache(users.keys())
+        for user_id, user in users.items():
+            # 和 accounts.models.get_profile 用同一个属性缓存 profile
+            # 这样 user.profile 就不需要再访问一次 memcached
+            setattr(user, '_cached_user_profile', profiles[user_id])
+        return users
+
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
@@ -1,4 +1,5 @@
 from accounts.models import UserProfile
+from accounts.services import UserService
 from testing.testcases import TestCase
 
 
@@ -12,4 +13,23 @@ class UserProfileTests(TestCase):
         self.assertEqual(UserProfile.objects.count(), 0)
         p = linghu.profile
         self.assertEqual(isinstance(p, UserProfile), True)
-        self.assertEqual(UserProfile.objects.count(), 1)
\ No newline at end of file
+        self.assertEqual(UserProfile.objects.count(), 1)
+
+    def test_get_profiles_through_cache(self):
+        linghu = self.create_user('linghu')
+        dongxie = self.create_user('dongxie')
+        dongxie.profile.nickname = 'huanglaoxie'
+        dongxie.profile.save()
+
+        # linghu has no profile yet, will be created
+        profiles = UserService.get_profiles_through_cache([linghu.id, dongxie.id])
+        self.assertEqual(UserProfile.objects.count(), 2)
+        self.assertEqual(profiles[linghu.id].user_id, linghu.id)
+        self.assertEqual(profiles[dongxie.id].nickname, 'huanglaoxie')
+
+        # profile changed, cache invalidated
+        profile = profiles[dongxie.id]
+        profile.nickname = 'huangyaoshi'
+        profile.save()
+        profiles = UserService.get_profiles_through_cache([dongxie.id])
+        self.assertEqual(profiles[dongxie.id].nickname, 'huangyaoshi')
@@ -4,10 +4,11 @@ from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
 from likes.services import LikeService
+from utils.redis_helper import RedisHelper
 
 
 class CommentSerializer(serializers.ModelSerializer):
-    user = UserSerializerForComment(source='cached_user')
+    user = serializers.SerializerMethodField()
     likes_count = serializers.SerializerMethodField()
     has_liked = serializers.SerializerMethodField()
 
@@ -22,12 +23,32 @@ class CommentSerializer(serializers.ModelSerializer):
             'likes_count',
             'has_liked',
         )
+
+    def _get_hydrated(self, name, key, load):
+        # 列表类的 API 会通过 CommentService.hydrate_comments 把整页数据预先取好放在 context 里
+        # 没有预取的情况（比如 create / update）下退回到单个 object 的读取方式
+        hydrated = self.context.get('hydrated')
+        if hydrated is not None and key in hydrated[name]:
+            return hydrated[name][key]
+        return load()
+
+    def get_user(self, obj):
+        user = self._get_hydrated('users', obj.user_id, lambda: obj.cached_user)
+        return UserSerializerForComment(user).data
     
     def get_likes_count(self, obj):
-        return obj.like_set.count()
+        return self._get_hydrated(
+            'likes_count',
+            obj.id,
+            lambda: RedisHelper.get_count(obj, 'likes_count'),
+        )
 
     def get_has_liked(self, obj):
-        return LikeService.has_liked(self.context['request'].user, obj)
+        return self._get_hydrated(
+            'has_liked',
+            obj.id,
+            lambda: LikeService.has_liked(self.context['request'].user, obj),
+        )
 
 class CommentSerializerForCreate(serializers.ModelSerializer):
     # 这两项必须手动添加
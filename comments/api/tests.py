@@ -2,6 +2,8 @@ from comments.models import Comment
 from django.utils import timezone
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from utils.redis_helper import RedisHelper
+from utils.paginations import EndlessPagination
 
 COMMENT_URL = '/api/comments/'
 COMMENT_DETAIL_URL = '/api/comments/{}/'
@@ -141,6 +143,50 @@ class CommentApiTests(TestCase):
         self.assertEqual(len(response.data['comments']), 2)
     
 
+    def test_list_pagination(self):
+        page_size = EndlessPagination.page_size
+        comments = [
+            self.create_comment(self.dongxie, self.tweet, '{}'.format(i))
+            for i in range(page_size * 2)
+        ]
+
+        # 第一页是最新的 page_size 条 comments，页内按照时间顺序排列
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [comment['id'] for comment in response.data['comments']],
+            [comment.id for comment in comments[page_size:]],
+        )
+
+        # 用 next_cursor 翻到第二页
+        response = self.anonymous_client.get(COMMENT_URL, {
+            'tweet_id': self.tweet.id,
+            'cursor': response.data['next_cursor'],
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [comment['id'] for comment in response.data['comments']],
+            [comment.id for comment in comments[:page_size]],
+        )
+
+        # 修改 comment 之后 cache 失效，再次读取拿到的是新的内容
+        comment_url = COMMENT_DETAIL_URL.format(comments[-1].id)
+        self.dongxie_client.put(comment_url, {'content': 'updated'})
+        self.run_on_commit_callbacks()
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.data['comments'][-1]['content'], 'updated')
+
+        # 删除 comment 之后不再出现在列表里
+        self.dongxie_client.delete(comment_url)
+        self.run_on_commit_callbacks()
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.data['comments'][-1]['id'], comments[-2].id)
+
+        # tweet_id 必须是整数
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
     def test_comments_count(self):
         # test tweet detail api
         tweet = self.create_tweet(self.linghu)
@@ -176,12 +222,15 @@ class CommentApiTests(TestCase):
             client.post(COMMENT_URL, data)
             response =client.get(tweet_url)
             self.assertEqual(response.data['comments_count'], i + 1)
+            # 计数只在 redis 里修改，定期写回数据库，这里手动 flush 一次
+            RedisHelper.flush_dirty_counts()
             self.tweet.refresh_from_db()
             self.assertEqual(self.tweet.comments_count, i + 1)
 
         comment_data = self.dongxie_client.post(COMMENT_URL, data).data
         response = self.dongxie_client.get(tweet_url)
         self.assertEqual(response.data['comments_count'], 3)
+        RedisHelper.flush_dirty_counts()
         self.tweet.refresh_from_db()
         self.assertEqual(self.tweet.comments_count, 3)
 
@@ -191,6 +240,7 @@ class CommentApiTests(TestCase):
         self.assertEqual(response.status_code, 200)
         response = self.dongxie_client.get(tweet_url)
         self.assertEqual(response.data['comments_count'], 3)
+        RedisHelper.flush_dirty_counts()
         self.tweet.refresh_from_db()
         self.assertEqual(self.tweet.comments_count, 3)
 
@@ -199,5 +249,6 @@ class CommentApiTests(TestCase):
         self.assertEqual(response.status_code, 200)
         response = self.linghu_client.get(tweet_url)
         self.assertEqual(response.data['comments_count'], 2)
+        RedisHelper.flush_dirty_counts()
         self.tweet.refresh_from_db()
         self.assertEqual(self.tweet.comments_count, 2)
@@ -10,6 +10,9 @@ from comments.api.serializers import (
 from utils.permissions import IsObjectOwner
 from utils.decorators import required_params
 from inbox.services import NotificationService
+from comments.services import CommentService
+from utils.paginations import EndlessPagination
+from functools import partial
 from django.utils.decorators import method_decorator
 from ratelimit.decorators import ratelimit
 
@@ -21,7 +24,7 @@ class CommentViewSet(viewsets.GenericViewSet):
     # """
     serializer_class = CommentSerializerForCreate
     queryset = Comment.objects.all()
-    filterset_fields = ('tweet_id',)
+    pagination_class = EndlessPagination
 
     def get_permissions(self):
         # 注意要加用 AllowAny() / IsAuthenticated() 实例化出对象
@@ -35,19 +38,38 @@ class CommentViewSet(viewsets.GenericViewSet):
     @required_params(params=['tweet_id'])
     @method_decorator(ratelimit(key='user', rate='3/m', method='GET', block=True))
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        comments = self.filter_queryset(queryset)\
-            .prefetch_related('user')\
-            .order_by('created_at')
+        # 只有 tweet_id 会作为筛选条件，其他的参数（比如 user_id）会被忽略
+        tweet_id = request.query_params['tweet_id']
+        if not tweet_id.isdigit():
+            return Response({
+                'message': 'Please check input',
+                'errors': {'tweet_id': 'tweet_id should be an integer'},
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        # 热门 tweet 的 comments 可能非常多，只从 cache 里读取需要的那一页
+        page = self.paginator.paginate_cached_range(
+            partial(CommentService.get_cached_comments_in_range, int(tweet_id)),
+            request,
+        )
+        if page is None:
+            queryset = Comment.objects.filter(tweet_id=tweet_id)
+            page = self.paginate_queryset(queryset)
+        # 按照 created_at 倒序翻页，从最新的 comments 往前翻，每一页内部按照时间顺序排列
+        page = list(page)[::-1]
+
         serializer = CommentSerializer(
-            comments, 
-            context={'request': request}, 
+            page,
+            context={
+                'request': request,
+                'hydrated': CommentService.hydrate_comments(page, request.user),
+            },
             many=True,
         )
-        return Response(
-            {'comments': serializer.data},
-            status=status.HTTP_200_OK,
-        )    
+        return Response({
+            'comments': serializer.data,
+            'has_next_page': self.paginator.has_next_page,
+            'next_cursor': self.paginator.next_cursor,
+        }, status=status.HTTP_200_OK)
 
     @method_decorator(ratelimit(key='user', rate='3/s', method='POST', block=True))
     def create(self, request, *args, **kwargs):
@@ -1,26 +1,43 @@
+from django.db import transaction
 from utils.listeners import invalidate_object_cache
 from utils.redis_helper import RedisHelper
 
 
 def incr_comments_count(sender, instance, created, **kwargs):
     from tweets.models import Tweet
-    from django.db.models import F
 
     if not created:
         return
 
     # handle new comment
-    Tweet.objects.filter(id=instance.tweet_id)\
-        .update(comments_count=F('comments_count') + 1)
-    RedisHelper.incr_count(instance.tweet, 'comments_count')
+    # 和 likes_count 一样只修改 redis 里的计数，由 flush_dirty_counts_task 定期写回数据库
+    RedisHelper.incr_count_by_id(Tweet, 'comments_count', instance.tweet_id, 1)
     
 
 def decr_comments_count(sender, instance, **kwargs):
     from tweets.models import Tweet
-    from django.db.models import F
 
     # handle comment deletion
-    Tweet.objects.filter(id=instance.tweet_id)\
-        .update(comments_count=F('comments_count') - 1)
-    RedisHelper.decr_count(instance.tweet, 'comments_count')
-    
\ No newline at end of file
+    RedisHelper.incr_count_by_id(Tweet, 'comments_count', instance.tweet_id, -1)
+    
+
+def push_comment_to_cache(sender, instance, created, **kwargs):
+    from comments.services import CommentService
+
+    if created:
+        CommentService.push_comment_to_cache(instance)
+        return
+    # cache 里存的是序列化之后的 comment，修改之后需要删掉
+    _invalidate_comments_cache_on_commit(instance.tweet_id)
+
+
+def invalidate_comments_cache(sender, instance, **kwargs):
+    _invalidate_comments_cache_on_commit(instance.tweet_id)
+
+
+def _invalidate_comments_cache_on_commit(tweet_id):
+    from comments.services import CommentService
+
+    # 在 commit 之前删掉 cache 的话，同时读取的请求可能会从数据库里 load 到旧的数据重新写入 cache
+    # 等 commit 之后再删，之后的 rebuild 一定能读到修改之后的数据
+    transaction.on_commit(lambda: CommentService.invalidate_comments_cache(tweet_id))
@@ -0,0 +1,54 @@
+from comments.models import Comment
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from likes.models import Like
+from utils.redis_helper import RedisHelper
+
+
+class Command(BaseCommand):
+    help = 'Compute Comment.likes_count from the likes table for existing comments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        # 中断之后可以从上次输出的 comment id 继续
+        parser.add_argument('--start-id', type=int, default=0)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = options['start_id']
+        content_type = ContentType.objects.get_for_model(Comment)
+        # 每个 comment 的 like 数，可以用到 <content_type, object_id, created_at> 的索引
+        likes_count = Subquery(
+            Like.objects.filter(content_type=content_type, object_id=OuterRef('id'))
+            .order_by()
+            .values('object_id')
+            .annotate(count=Count('id'))
+            .values('count'),
+            output_field=IntegerField(),
+        )
+        total = 0
+        while True:
+            comment_ids = list(
+                Comment.objects.filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not comment_ids:
+                break
+
+            # UPDATE ... SET likes_count = (SELECT COUNT(*) ...) 在一条语句里完成计算和写入
+            # 分开查询再写入的话，中间新增或者取消的 like 会被覆盖掉
+            Comment.objects.filter(id__in=comment_ids).update(
+                likes_count=Coalesce(likes_count, 0),
+            )
+
+            # redis 里缓存的计数和还没有写回的修改都是 backfill 之前的，丢弃之后下次读取会从数据库里重新加载
+            RedisHelper.discard_counts(Comment, 'likes_count', comment_ids)
+
+            total += len(comment_ids)
+            last_id = comment_ids[-1]
+            self.stdout.write('{} comments backfilled, last comment id {}'.format(total, last_id))
+
+        self.stdout.write(self.style.SUCCESS('Done, {} comments backfilled.'.format(total)))
@@ -4,8 +4,13 @@ from tweets.models import Tweet
 from likes.models import Like
 from django.contrib.contenttypes.models import ContentType
 from utils.memcached_helper import MemcachedHelper
-from comments.listeners import incr_comments_count, decr_comments_count
-from django.db.models.signals import post_save, pre_delete
+from comments.listeners import (
+    incr_comments_count,
+    decr_comments_count,
+    push_comment_to_cache,
+    invalidate_comments_cache,
+)
+from django.db.models.signals import post_save, pre_delete, post_delete
 
 
 class Comment(models.Model):
@@ -19,6 +24,10 @@ class Comment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # 新增的 field 一定要设置 null=True，否则 default = 0 会遍历整个表单去设置
+    # 已有的 comments 的 likes_count 使用 backfill_comment_likes_count 命令计算
+    likes_count = models.IntegerField(default=0, null=True)
+
     class Meta:
         # 有在某个 tweet 下排序所有 comments 的需求
         index_together = (('tweet', 'created_at'),)
@@ -44,3 +53,5 @@ class Comment(models.Model):
     
 post_save.connect(incr_comments_count, sender=Comment)
 pre_delete.connect(decr_comments_count, sender=Comment)
+post_save.connect(push_comment_to_cache, sender=Comment)
+post_delete.connect(invalidate_comments_cache, sender=Comment)
@@ -0,0 +1,43 @@
+from accounts.services import UserService
+from comments.models import Comment
+from likes.services import LikeService
+from twitter.cache import TWEET_COMMENTS_PATTERN
+from utils.redis_helper import RedisHelper
+
+
+def lazy_load_comments(tweet_id):
+    def _lazy_load(limit):
+        # created_at 相同的时候按 id 倒序，和 EndlessPagination 的 cursor 的顺序一致
+        return Comment.objects.filter(tweet_id=tweet_id).order_by('-created_at', '-id')[:limit]
+    return _lazy_load
+
+
+class CommentService(object):
+
+    @classmethod
+    def get_cached_comments_in_range(cls, tweet_id, **kwargs):
+        # 参数见 RedisHelper.load_objects_in_range，用于 EndlessPagination.paginate_cached_range
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id)
+        return RedisHelper.load_objects_in_range(key, lazy_load_comments(tweet_id), **kwargs)
+
+    @classmethod
+    def push_comment_to_cache(cls, comment):
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=comment.tweet_id)
+        RedisHelper.push_object(key, comment, lazy_load_comments(comment.tweet_id))
+
+    @classmethod
+    def invalidate_comments_cache(cls, tweet_id):
+        # 修改和删除 comment 的频率比较低，直接删掉整个 list，下次读取的时候重新 load
+        RedisHelper.delete_objects(TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id))
+
+    @classmethod
+    def hydrate_comments(cls, comments, user):
+        """
+        把渲染一页 comments 需要的数据一次性批量取出来，放在 serializer 的 context['hydrated'] 里
+        authors 从 memcached 里批量读取，likes_count 和 has_liked 各需要一次 redis 调用
+        """
+        return {
+            'users': UserService.get_users_through_cache([comment.user_id for comment in comments]),
+            'likes_count': RedisHelper.get_counts(comments, 'likes_count'),
+            'has_liked': LikeService.has_liked_many(user, comments),
+        }
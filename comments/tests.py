@@ -1,8 +1,13 @@
+from comments.models import Comment
+from django.core.management import call_command
+from io import StringIO
 from testing.testcases import TestCase
+from utils.redis_helper import RedisHelper
 
 class CommentModelTests(TestCase):
 
     def setUp(self):
+        super(CommentModelTests, self).setUp()
         self.linghu = self.create_user('linghu')
         self.tweet = self.create_tweet(self.linghu)
         self.comment = self.create_comment(self.linghu, self.tweet)
@@ -19,4 +24,42 @@ class CommentModelTests(TestCase):
 
         dongxie = self.create_user('dongxie')
         self.create_like(dongxie, self.comment)
-        self.assertEqual(self.comment.like_set.count(), 2)
\ No newline at end of file
+        self.assertEqual(self.comment.like_set.count(), 2)
+
+    def test_likes_count(self):
+        dongxie = self.create_user('dongxie')
+        like = self.create_like(self.linghu, self.comment)
+        self.create_like(dongxie, self.comment)
+        # 计数只在 redis 里修改，定期写回数据库，这里手动 flush 一次
+        RedisHelper.flush_dirty_counts()
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.likes_count, 2)
+        self.assertEqual(RedisHelper.get_count(self.comment, 'likes_count'), 2)
+
+        like.delete()
+        RedisHelper.flush_dirty_counts()
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.likes_count, 1)
+        self.assertEqual(RedisHelper.get_count(self.comment, 'likes_count'), 1)
+
+    def test_backfill_comment_likes_count(self):
+        dongxie = self.create_user('dongxie')
+        comments = [self.comment] + [self.create_comment(dongxie, self.tweet) for _ in range(4)]
+        for comment in comments[:3]:
+            self.create_like(self.linghu, comment)
+        self.create_like(dongxie, comments[0])
+        # 模拟 likes_count 这个 field 加上之前就已经存在的 comments 和 likes
+        Comment.objects.update(likes_count=0)
+
+        call_command('backfill_comment_likes_count', batch_size=2, stdout=StringIO())
+        self.assertEqual(
+            [Comment.objects.get(id=comment.id).likes_count for comment in comments],
+            [2, 1, 1, 0, 0],
+        )
+        # 还没有写回的修改也被丢弃，flush 不会用旧的计数覆盖 backfill 的结果
+        RedisHelper.flush_dirty_counts()
+        self.assertEqual(
+            [Comment.objects.get(id=comment.id).likes_count for comment in comments],
+            [2, 1, 1, 0, 0],
+        )
+        self.assertEqual(RedisHelper.get_count(comments[0], 'likes_count'), 2)
@@ -1,14 +1,51 @@
+from contextlib import contextmanager
 from django.conf import settings
+from thriftpy2.transport import TTransportException
 
 import happybase
+import os
 
 
 class HBaseClient:
-    conn = None
+    pool = None
+    # 创建 pool 的进程，fork 出来的子进程（比如 celery worker）不能使用父进程的 sockets
+    pid = None
 
     @classmethod
-    def get_connection(cls):
-        if cls.conn:
-            return cls.conn
-        cls.conn = happybase.Connection(settings.HBASE_HOST)
-        return cls.conn
\ No newline at end of file
+    def get_pool(cls):
+        pid = os.getpid()
+        if cls.pool is not None and cls.pid == pid:
+            return cls.pool
+        cls.pool = happybase.ConnectionPool(
+            size=settings.HBASE_POOL_SIZE,
+            host=settings.HBASE_HOST,
+        )
+        cls.pid = pid
+        return cls.pool
+
+    @classmethod
+    @contextmanager
+    def connection(cls):
+        """
+        从 pool 里拿一个 connection，with 结束的时候还回去
+        同一个线程里嵌套使用的时候拿到的是同一个 connection
+        thrift 出错的时候 happybase 会重新建立这个 connection 的 socket
+        """
+        with cls.get_pool().connection(timeout=settings.HBASE_POOL_TIMEOUT) as conn:
+            yield conn
+
+    @classmethod
+    def execute(cls, func, retry_times=None):
+        """
+        用一个 connection 执行 func(conn)，遇到 TTransportException 的时候重试
+        只有幂等的操作（get / put / delete）可以重试，counter_inc 之类的不能重试
+        """
+        if retry_times is None:
+            retry_times = settings.HBASE_RETRY_TIMES
+        for attempt in range(retry_times + 1):
+            try:
+                with cls.connection() as conn:
+                    return func(conn)
+            except TTransportException:
+                if attempt == retry_times:
+                    raise
@@ -1,3 +1,31 @@
+import numpy as np
+import struct
+
+
+def bulk_parse_ints(values, reverse=False):
+    """
+    用 numpy 一次性把等长的数字 bytes（比如补 0 到 16 位的 IntegerField）解析成 int list
+    不满足条件（有 None / 长度不一致 / 有非数字字符 / 超过 int64 范围）时返回 None
+    """
+    if not values:
+        return []
+    if None in values:
+        return None
+    width = len(values[0])
+    if width == 0 or width > 18:
+        return None
+    if any(len(value) != width for value in values):
+        return None
+    # uint8 减去 ord('0')，非数字字符会变成 > 9 的值
+    digits = np.frombuffer(b''.join(values), dtype=np.uint8).reshape(len(values), width) - 48
+    if (digits > 9).any():
+        return None
+    if reverse:
+        digits = digits[:, ::-1]
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    return (digits.astype(np.int64) @ powers).tolist()
+
+
 class HBaseField:
     field_type = None
 
@@ -8,6 +36,34 @@ class HBaseField:
         # 增加 is_required 属性，默认为 true 和 default 属性，默认 None。
         # 并在 HbaseModel 中做相应的处理，抛出相应的异常信息
 
+    def serialize(self, value):
+        value = self.to_str(value)
+        if self.reverse:
+            value = value[::-1]
+        return value
+
+    def deserialize(self, value):
+        # value 可能是 row key 里切出来的 str，也可能是 column 里存的 bytes
+        if self.reverse:
+            value = value[::-1]
+        return self.from_str(value)
+
+    def deserialize_many(self, values):
+        # 批量反序列化一列 bytes，value 为 None 表示这个 row 里没有这个 column
+        return [
+            None if value is None else self.deserialize(value)
+            for value in values
+        ]
+
+    def to_str(self, value):
+        return str(value)
+
+    def from_str(self, value):
+        # row key 里切出来的和 column 里存的都是 bytes，统一转换成 str
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        return value
+
 
 class IntegerField(HBaseField):
     field_type = 'int'
@@ -15,9 +71,53 @@ class IntegerField(HBaseField):
     def __init__(self, *args, **kwargs):
         super(IntegerField, self).__init__(*args, **kwargs)
 
+    def to_str(self, value):
+        # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
+        # 解决的办法是固定 int 的位数为 16 位（8的倍数更容易利用空间），不足位补 0
+        value = str(value)
+        if len(value) < 16:
+            value = '0' * (16 - len(value)) + value
+        return value
+
+    def from_str(self, value):
+        return int(value)
+
+    def deserialize_many(self, values):
+        ints = bulk_parse_ints(values, reverse=self.reverse)
+        if ints is None:
+            return super(IntegerField, self).deserialize_many(values)
+        return ints
+
 
 class TimestampField(HBaseField):
     field_type = 'timestamp'
 
     def __init__(self, *args, **kwargs):
-        super(TimestampField, self).__init__( *args, **kwargs)
\ No newline at end of file
+        super(TimestampField, self).__init__( *args, **kwargs)
+
+    def from_str(self, value):
+        return int(value)
+
+    def deserialize_many(self, values):
+        ints = bulk_parse_ints(values, reverse=self.reverse)
+        if ints is None:
+            return super(TimestampField, self).deserialize_many(values)
+        return ints
+
+
+class CounterField(HBaseField):
+    """
+    使用 hbase 的原子计数器（counter_inc）维护的 column
+    hbase 把计数存储为 8 bytes 的 big-endian 有符号整数，而不是字符串
+    只能作为 column 使用，不能放在 row key 里
+    """
+    field_type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super(CounterField, self).__init__(*args, **kwargs)
+
+    def serialize(self, value):
+        return struct.pack('>q', value)
+
+    def deserialize(self, value):
+        return struct.unpack('>q', value)[0]
@@ -1,50 +1,59 @@
+from contextlib import contextmanager
 from django_hbase.client import HBaseClient
 from .exceptions import EmptyColumnError, BadRowKeyError
 from .fields import HBaseField, IntegerField, TimestampField
 from django.conf import settings
 
 class HBaseModel:
+    # 以下 field 相关的信息在 subclass 创建的时候由 __init_subclass__ 计算好
+    # 这样 scan 大量 rows 的时候不需要每次都去遍历 cls.__dict__
+    # {field name: field}
+    _field_hash = {}
+    # [(row key 里的 field name, field)]，按照 Meta.row_key 的顺序
+    _row_key_fields = []
+    # {field name: field}，只包含有 column_family 的 fields
+    _column_fields = {}
+    # {b'cf:field_name': (field name, field)}
+    _column_key_to_field = {}
 
     class Meta:
         table_name = None
         row_key = ()
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        field_hash = {}
+        for name, value in cls.__dict__.items():
+            if isinstance(value, HBaseField):
+                field_hash[name] = value
+        cls._field_hash = field_hash
+        cls._row_key_fields = [(key, field_hash.get(key)) for key in cls.Meta.row_key]
+        cls._column_fields = {
+            name: field
+            for name, field in field_hash.items()
+            if field.column_family
+        }
+        cls._column_key_to_field = {
+            bytes('{}:{}'.format(field.column_family, name), encoding='utf-8'): (name, field)
+            for name, field in cls._column_fields.items()
+        }
 
     def __init__(self, **kwargs):
-        for key, field in self.get_field_hash().items():
+        for key in self._field_hash:
             value = kwargs.get(key)
             setattr(self, key, value)   # ----> __dict__
 
     @classmethod
     def get_field_hash(cls):
-        field_hash = {}
-        for field in cls.__dict__:
-            field_obj = getattr(cls, field)
-            if isinstance(field_obj, HBaseField):
-                field_hash[field] = field_obj
-        return field_hash
+        return cls._field_hash
     
     @classmethod
     def serialize_field(cls, field, value):
-        value = str(value)
-        if isinstance(field, IntegerField):
-            # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
-            # 解决的办法是固定 int 的位数为 16 位（8的倍数更容易利用空间），不足位补 0
-            value = str(value)
-            while len(value) < 16:
-                value = '0' + value
-        if field.reverse:
-            value = value[::-1]
-        return value
+        return field.serialize(value)
     
     @classmethod
     def deserialize_field(cls, key, value):
-        field = cls.get_field_hash()[key]
-        if field.reverse:
-            value = value[::-1]
-        if field.field_type in [IntegerField.field_type, TimestampField.field_type]:
-            return int(value)
-        return value
+        return cls._field_hash[key].deserialize(value)
     
     @classmethod
     def serialize_row_key(cls, data, is_prefix=False):
@@ -54,16 +63,14 @@ class HBaseModel:
         {key1: val1, key2: val2} => b"val1:val2"
         {key1: val1, key2: val2, key3: val3} => b"val1:val2:val3"
         """
-        field_hash = cls.get_field_hash()
         values = []
-        for key in cls.Meta.row_key:
-            field = field_hash.get(key)
+        for key, field in cls._row_key_fields:
             value = data.get(key)
             if value is None:
                 if not is_prefix:
                     raise BadRowKeyError(f"{key} is missing in row key")
                 break
-            value = cls.serialize_field(field, value)
+            value = field.serialize(value)
             if ':' in value:
                 raise BadRowKeyError(f"{key} should not contain ':' in value: {value}")
             values.append(value)
@@ -82,28 +89,20 @@ class HBaseModel:
             # bytes -> str
             row_key = row_key.decode('utf-8')
 
-        # val1:val2 => val1:val2: 方便每次 find(':') 都能找到一个 val
-        row_key = row_key + ':'
-        for key in cls.Meta.row_key:
-            index = row_key.find(':')
-            if index == -1:
-                break
-            data[key] = cls.deserialize_field(key, row_key[:index])
-            row_key = row_key[index + 1:]
+        # val1:val2 => [val1, val2]，多出来的 row key fields 不会出现在 data 里
+        for (key, field), value in zip(cls._row_key_fields, row_key.split(':')):
+            data[key] = field.deserialize(value)
         return data
     
     @classmethod
     def serialize_row_data(cls, data):
         row_data = {}
-        field_hash = cls.get_field_hash()
-        for key, field in field_hash.items():
-            if not field.column_family:
-                continue
-            column_key = '{}:{}'.format(field.column_family, key)
+        for key, field in cls._column_fields.items():
             column_value = data.get(key)
             if column_value is None:
                 continue
-            row_data[column_key] = cls.serialize_field(field, column_value)
+            column_key = '{}:{}'.format(field.column_family, key)
+            row_data[column_key] = field.serialize(column_value)
         return row_data
     
 
@@ -113,10 +112,9 @@ class HBaseModel:
             return None
         data = cls.deserialize_row_key(row_key)
         for column_key, column_value in row_data.items():
-            # remove column family
-            column_key = column_key.decode('utf-8')
-            key = column_key[column_key.find(':') + 1:]
-            data[key] = cls.deserialize_field(key, column_value)
+            # b'cf:key' => key
+            key, field = cls._column_key_to_field[column_key]
+            data[key] = field.deserialize(column_value)
         return cls(**data)
 
     @property
@@ -125,9 +123,19 @@ class HBaseModel:
     
 
     @classmethod
+    @contextmanager
     def get_table(cls):
-        conn = HBaseClient.get_connection()
-        return conn.table(cls.get_table_name())
+        # 在 with 的范围内占用 pool 里的一个 connection
+        with HBaseClient.connection() as conn:
+            yield conn.table(cls.get_table_name())
+
+    @classmethod
+    def _execute(cls, func, retry_times=None):
+        # 执行 func(table)，遇到 thrift 的连接错误会重试，见 HBaseClient.execute
+        return HBaseClient.execute(
+            lambda conn: func(conn.table(cls.get_table_name())),
+            retry_times=retry_times,
+        )
 
     
     def save(self, batch=None):
@@ -140,14 +148,12 @@ class HBaseModel:
         if batch:
             batch.put(self.row_key, row_data)
         else:
-            table = self.get_table()
-            table.put(self.row_key, row_data)
+            self._execute(lambda table: table.put(self.row_key, row_data))
 
     @classmethod
     def get(cls, **kwargs):
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        row_data = table.row(row_key)
+        row_data = cls._execute(lambda table: table.row(row_key))
         return cls.init_from_row(row_key, row_data)
 
     @classmethod
@@ -158,21 +164,57 @@ class HBaseModel:
     
     @classmethod
     def batch_create(cls, batch_data):
-        table = cls.get_table()
-        batch = table.batch()
-        results = []
-        for data in batch_data:
-            results.append(cls.create(batch=batch, **data))
-        batch.send()
-        return results
+        def _batch_create(table):
+            batch = table.batch()
+            results = []
+            for data in batch_data:
+                results.append(cls.create(batch=batch, **data))
+            batch.send()
+            return results
+        # put 是幂等的，整个 batch 失败之后可以重新发送
+        return cls._execute(_batch_create)
     
     @classmethod
     def get(cls, **kwargs):
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        row = table.row(row_key)
+        row = cls._execute(lambda table: table.row(row_key))
         return cls.init_from_row(row_key, row)
     
+    @classmethod
+    def get_many(cls, keys):
+        """
+        keys 是每个 row key 对应的 dict list，一次请求读取多个 rows
+        返回和 keys 一一对应的 instance list，不存在的 row 为 None
+        """
+        row_keys = [cls.serialize_row_key(key) for key in keys]
+        rows = dict(cls._execute(lambda table: table.rows(row_keys)))
+        return [cls.init_from_row(row_key, rows.get(row_key)) for row_key in row_keys]
+
+    @classmethod
+    def _get_column_key(cls, field_name):
+        field = cls._column_fields[field_name]
+        return bytes('{}:{}'.format(field.column_family, field_name), encoding='utf-8')
+
+    @classmethod
+    def counter_inc(cls, field_name, value=1, **kwargs):
+        """
+        对 CounterField 做原子的加法，kwargs 为 row key，返回加完之后的值
+        row 或者 column 不存在的时候从 0 开始加
+        """
+        row_key = cls.serialize_row_key(kwargs)
+        column_key = cls._get_column_key(field_name)
+        # 不知道失败之前有没有加成功，所以不能重试
+        return cls._execute(
+            lambda table: table.counter_inc(row_key, column_key, value),
+            retry_times=0,
+        )
+
+    @classmethod
+    def counter_set(cls, field_name, value, **kwargs):
+        row_key = cls.serialize_row_key(kwargs)
+        column_key = cls._get_column_key(field_name)
+        cls._execute(lambda table: table.counter_set(row_key, column_key, value))
+
     @classmethod
     def get_table_name(cls):
         if not cls.Meta.table_name:
@@ -185,24 +227,24 @@ class HBaseModel:
     def drop_table(cls):
         if not settings.TESTING:
             raise Exception('You can not drop table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        conn.delete_table(cls.get_table_name(), True)
+        with HBaseClient.connection() as conn:
+            conn.delete_table(cls.get_table_name(), True)
 
     @classmethod
     def create_table(cls):
         if not settings.TESTING:
             raise Exception('You can not create table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        # convert table name from bytes to str
-        tables = [table.decode('utf-8') for table in conn.tables()]
-        if cls.get_table_name() in tables:
-            return
-        column_families = {
-            field.column_family: dict()
-            for key, field in cls.get_field_hash().items()
-            if field.column_family is not None
-        }
-        conn.create_table(cls.get_table_name(), column_families)
+        with HBaseClient.connection() as conn:
+            # convert table name from bytes to str
+            tables = [table.decode('utf-8') for table in conn.tables()]
+            if cls.get_table_name() in tables:
+                return
+            column_families = {
+                field.column_family: dict()
+                for key, field in cls.get_field_hash().items()
+                if field.column_family is not None
+            }
+            conn.create_table(cls.get_table_name(), column_families)
 
     # <HOMEWORK> 实现一个 get_or_create 的方法，返回 (instance, created)
 
@@ -217,28 +259,137 @@ class HBaseModel:
         return cls.serialize_row_key(data, is_prefix=True)
 
     @classmethod
-    def filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False):
+    def decode_rows(cls, rows, as_columns=False, fields=None):
+        """
+        批量反序列化 scan 出来的 rows，比逐个 init_from_row 少很多中间对象
+        所有 row keys 先一次性切开，然后每个 field 整列一起解析（int field 使用 numpy）
+        as_columns=False 返回 instance list
+        as_columns=True 返回按列存储的结果 {field name: [value1, value2, ...]}
+        fields 为需要解析的 field names，默认解析所有 fields
+        """
+        if fields is None:
+            fields = cls._field_hash
+        row_key_fields = [
+            (index, key, field)
+            for index, (key, field) in enumerate(cls._row_key_fields)
+            if key in fields
+        ]
+        column_fields = [
+            (column_key, name, field)
+            for column_key, (name, field) in cls._column_key_to_field.items()
+            if name in fields
+        ]
+
+        row_keys = []
+        column_values = {name: [] for _, name, _ in column_fields}
+        for row_key, row_data in rows:
+            row_keys.append(row_key)
+            for column_key, name, _ in column_fields:
+                column_values[name].append(row_data.get(column_key))
+
+        # b"val1:val2" => [b"val1", b"val2"]
+        split_row_keys = [row_key.split(b':') for row_key in row_keys]
+        row_key_size = len(cls._row_key_fields)
+        for row_key, parts in zip(row_keys, split_row_keys):
+            if len(parts) != row_key_size:
+                raise BadRowKeyError(
+                    f"{cls.__name__} row key should have {row_key_size} parts: {row_key}"
+                )
+        columns = {}
+        for index, key, field in row_key_fields:
+            columns[key] = field.deserialize_many([parts[index] for parts in split_row_keys])
+        for _, name, field in column_fields:
+            columns[name] = field.deserialize_many(column_values[name])
+
+        if as_columns:
+            return columns
+        names = list(columns.keys())
+        return [
+            cls(**dict(zip(names, values)))
+            for values in zip(*columns.values())
+        ]
+
+    @classmethod
+    def _scan(cls, start=None, stop=None, prefix=None, limit=None, reverse=False, **kwargs):
         # serialize tuple to str
         row_start = cls.serialize_row_key_from_tuple(start)
         row_stop = cls.serialize_row_key_from_tuple(stop)
         row_prefix = cls.serialize_row_key_from_tuple(prefix)
 
         # scan table
-        table = cls.get_table()
-        rows = table.scan(row_start, row_stop, row_prefix, limit=limit, reverse=reverse)
+        # 这是一个 generator，遍历结束（或者被 close）之前一直占用着 pool 里的 connection
+        with cls.get_table() as table:
+            yield from table.scan(row_start, row_stop, row_prefix, limit=limit, reverse=reverse, **kwargs)
 
-        # deserialize to instance list
-        results = []
-        for row_key, row_data in rows:
-            instance = cls.init_from_row(row_key, row_data)
-            results.append(instance)
-        return results
+    @classmethod
+    def _iter_batches(cls, rows, batch_size):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @classmethod
+    def filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False, as_columns=False):
+        rows = cls._scan(start, stop, prefix, limit, reverse)
+        # deserialize to instance list (or columns)
+        return cls.decode_rows(rows, as_columns=as_columns)
+
+    @classmethod
+    def iter_filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False,
+                    batch_size=1000, columns=None):
+        """
+        generator 版本的 filter，不会把整个 scan 的结果都放在内存里
+        每次从 hbase 拉取 batch_size 个 rows，批量反序列化之后逐个 yield instance
+        columns 为需要读取的 field names，只读取这些 columns 以减少传输的数据量
+        row key 里的 fields 总是可以拿到，不需要额外读取 columns
+        """
+        scan_kwargs = {'batch_size': batch_size}
+        fields = None
+        if columns is not None:
+            fields = set(columns) | {key for key, _ in cls._row_key_fields}
+            column_keys = [
+                column_key
+                for column_key, (name, _) in cls._column_key_to_field.items()
+                if name in fields
+            ]
+            if column_keys:
+                scan_kwargs['columns'] = column_keys
+            else:
+                # 只需要 row key，每个 row 只返回第一个 column 并且不返回 value
+                scan_kwargs['filter'] = b'FirstKeyOnlyFilter() AND KeyOnlyFilter()'
+
+        rows = cls._scan(start, stop, prefix, limit, reverse, **scan_kwargs)
+        for batch in cls._iter_batches(rows, batch_size):
+            yield from cls.decode_rows(batch, fields=fields)
+
+    @classmethod
+    def filter_ids(cls, field_name, start=None, stop=None, prefix=None, limit=None,
+                   reverse=False, batch_size=1000):
+        """
+        只读取并 yield 某一个 field 的值，比如 HBaseFollower 的 from_user_id
+        不创建 instances，按列批量解析，用于需要遍历大量 rows 的场景（比如 fanout）
+        """
+        row_key_names = [key for key, _ in cls._row_key_fields]
+        scan_kwargs = {'batch_size': batch_size}
+        if field_name in row_key_names:
+            scan_kwargs['filter'] = b'FirstKeyOnlyFilter() AND KeyOnlyFilter()'
+        else:
+            field = cls._column_fields[field_name]
+            column_key = '{}:{}'.format(field.column_family, field_name)
+            scan_kwargs['columns'] = [bytes(column_key, encoding='utf-8')]
+
+        rows = cls._scan(start, stop, prefix, limit, reverse, **scan_kwargs)
+        for batch in cls._iter_batches(rows, batch_size):
+            yield from cls.decode_rows(batch, as_columns=True, fields=[field_name])[field_name]
     
     @classmethod
     def delete(cls, **kwargs):
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        return table.delete(row_key)
+        return cls._execute(lambda table: table.delete(row_key))
     
     @property
     def id(self):
@@ -23,19 +23,15 @@ class BaseFriendshipSerializer(serializers.Serializer):
     def get_user_id(self, obj):
         raise NotImplementedError
 
-    def _get_following_user_id_set(self):
-        if self.context['request'].user.is_anonymous:
-            return {}
-        if hasattr(self, '_cached_following_user_id_set'):
-            return self._cached_following_user_id_set
-        user_id_set = FriendshipService.get_following_user_id_set(
-            self.context['request'].user.id,
-        )
-        setattr(self, '_cached_following_user_id_set', user_id_set)
-        return user_id_set
-    
     def get_has_followed(self, obj):
-        return self.get_user_id(obj) in self._get_following_user_id_set()
+        if self.context['request'].user.is_anonymous:
+            return False
+        user_id = self.get_user_id(obj)
+        # list 的时候 view 会把整页的结果一次性查好放在 context['has_followed'] 里
+        has_followed = self.context.get('has_followed')
+        if has_followed is not None and user_id in has_followed:
+            return has_followed[user_id]
+        return FriendshipService.has_followed(self.context['request'].user.id, user_id)
 
     def get_user(self, obj):
         user = UserService.get_user_by_id(self.get_user_id(obj))
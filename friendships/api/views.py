@@ -26,6 +26,12 @@ class FriendshipViewSet(viewsets.GenericViewSet):
     queryset = User.objects.all()
     pagination_class = EndlessPagination
 
+    def _get_has_followed(self, request, user_ids):
+        # 一次 redis 调用查出当前用户是否关注了这一页里的每个用户
+        if request.user.is_anonymous:
+            return {}
+        return FriendshipService.has_followed_many(request.user.id, user_ids)
+
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
     @method_decorator(ratelimit(key='user_or_ip', rate='3/s', method='GET', block=True))
     def followers(self, request, pk):
@@ -38,7 +44,10 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             friendships = Friendship.objects.filter(to_user_id=pk).order_by('-created_at')
             page = paginator.paginate_queryset(friendships)
 
-        serializer = FollowerSerializer(page, many=True, context={'request': request})
+        serializer = FollowerSerializer(page, many=True, context={
+            'request': request,
+            'has_followed': self._get_has_followed(request, [f.from_user_id for f in page]),
+        })
         return paginator.get_paginated_response(serializer.data)
     
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
@@ -52,7 +61,10 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             friendships = Friendship.objects.filter(from_user_id=pk).order_by('-created_at')
             page = paginator.paginate_queryset(friendships)
 
-        serializer = FollowingSerializer(page, many=True, context={'request': request})
+        serializer = FollowingSerializer(page, many=True, context={
+            'request': request,
+            'has_followed': self._get_has_followed(request, [f.to_user_id for f in page]),
+        })
         return paginator.get_paginated_response(serializer.data)
     
     @action(methods=['POST'], detail=True, permission_classes=[IsAuthenticated])
@@ -0,0 +1,9 @@
+from django.conf import settings
+
+# 关注的人超过这个数量的用户不在 redis 里缓存 following set
+FOLLOWINGS_CACHE_LIMIT = 10000 if not settings.TESTING else 10
+
+# reconcile 的时候 scan 的结果不是快照就重新 scan，最多 RECONCILE_RETRY_TIMES 次
+RECONCILE_RETRY_TIMES = 3
+# follow 写 rows 和 counter_inc 之间的最长间隔（秒），这段时间之内创建的 rows 说明可能有 follow 还没有计数
+RECONCILE_SETTLE_TIME = 10 if not settings.TESTING else 0
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from friendships.models import HBaseFollowing, HBaseFriendship
+from gatekeeper.models import GateKeeper
+
+
+class Command(BaseCommand):
+    help = 'Write HBaseFriendship index rows for followings created before the index existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total = 0
+        batch = []
+        # put 是幂等的，中断之后重新跑一遍就可以
+        for following in HBaseFollowing.iter_filter(batch_size=batch_size):
+            batch.append(following)
+            if len(batch) >= batch_size:
+                total += self._backfill_batch(batch)
+                batch = []
+                self.stdout.write('{} friendships backfilled'.format(total))
+        if batch:
+            total += self._backfill_batch(batch)
+
+        # 之后 get_follow_instance 在 HBaseFriendship 里找不到就不再 scan followings
+        GateKeeper.turn_on('switch_hbase_friendship_backfilled')
+        self.stdout.write(self.style.SUCCESS('Done, {} friendships backfilled.'.format(total)))
+
+    def _backfill_batch(self, followings):
+        # 已经有索引的关注关系不需要再写，新的 follow 写入的索引比 scan 出来的更新
+        friendships = HBaseFriendship.get_many([
+            {'from_user_id': following.from_user_id, 'to_user_id': following.to_user_id}
+            for following in followings
+        ])
+        missing = [
+            following
+            for following, friendship in zip(followings, friendships)
+            if friendship is None
+        ]
+        if not missing:
+            return 0
+        HBaseFriendship.batch_create([
+            {
+                'from_user_id': following.from_user_id,
+                'to_user_id': following.to_user_id,
+                'created_at': following.created_at,
+            }
+            for following in missing
+        ])
+        # 读取 following 之后写入索引之前，并发的 unfollow 可能已经删掉了这个 following
+        # 再读一次 followings，把已经不存在的关注关系对应的索引删掉
+        current = HBaseFollowing.get_many([
+            {'from_user_id': following.from_user_id, 'created_at': following.created_at}
+            for following in missing
+        ])
+        for following, instance in zip(missing, current):
+            if instance is None:
+                HBaseFriendship.delete(
+                    from_user_id=following.from_user_id,
+                    to_user_id=following.to_user_id,
+                )
+        return len(missing)
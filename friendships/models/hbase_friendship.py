@@ -36,4 +36,37 @@ class HBaseFollower(models.HBaseModel):
 
     class Meta:
         row_key = ('to_user_id', 'created_at')
-        table_name = 'twitter_followers'
\ No newline at end of file
+        table_name = 'twitter_followers'
+
+class HBaseFriendship(models.HBaseModel):
+    """
+    按照 (from_user_id, to_user_id) 存储关注关系，是 HBaseFollowing 的反向索引
+    可以支持查询：
+     - A 有没有关注 B，一次 get 就可以知道
+     - A 什么时候关注的 B，用于 unfollow 的时候找到 followings / followers 里对应的 rows
+    """
+    # row key
+    from_user_id = models.IntegerField(reverse=True)
+    to_user_id = models.IntegerField()
+    # column key
+    created_at = models.TimestampField(column_family='cf')
+
+    class Meta:
+        table_name = 'twitter_friendships'
+        row_key = ('from_user_id', 'to_user_id')
+
+
+class HBaseFriendshipCount(models.HBaseModel):
+    """
+    每个 user 的粉丝数和关注数，follow / unfollow 的时候用 counter_inc 原子地更新
+    避免为了计数去 scan followers / followings
+    """
+    # row key
+    user_id = models.IntegerField(reverse=True)
+    # column key
+    followers_count = models.CounterField(column_family='cf')
+    followings_count = models.CounterField(column_family='cf')
+
+    class Meta:
+        table_name = 'twitter_friendship_counts'
+        row_key = ('user_id',)
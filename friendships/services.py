@@ -1,50 +1,370 @@
 from django.conf import settings
-from django.core.cache import caches
+from django.contrib.auth.models import User
 from twitter.cache import FOLLOWINGS_PATTERN
 from gatekeeper.models import GateKeeper
-from friendships.models import HBaseFollowing, HBaseFollower, Friendship
+from friendships.constants import (
+    FOLLOWINGS_CACHE_LIMIT,
+    RECONCILE_RETRY_TIMES,
+    RECONCILE_SETTLE_TIME,
+)
+from friendships.models import (
+    HBaseFollowing,
+    HBaseFollower,
+    HBaseFriendship,
+    HBaseFriendshipCount,
+    Friendship,
+)
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
 
 
 import time
 
-cache = caches['testing'] if settings.TESTING else caches['default']
+# following set 里的两个特殊的 member，user id 都是正数不会冲突
+# redis 里不能存储空的 set，set 里有 FOLLOWINGS_LOADED 才表示已经完整地 load 过了
+FOLLOWINGS_LOADED = 0
+# 关注的人太多，set 里只有这一个 member，读取的时候直接访问数据库
+FOLLOWINGS_OVERFLOW = -1
 
 
 
 class FriendshipService(object):
-    
+
     @classmethod
     def get_follower_ids(cls, to_user_id):
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             friendships = Friendship.objects.filter(to_user_id=to_user_id)
+            return [friendship.from_user_id for friendship in friendships]
+        # 只需要 from_user_id 这一列，不需要创建 HBaseFollower instances
+        columns = HBaseFollower.filter(prefix=(to_user_id, None), as_columns=True)
+        return columns['from_user_id']
+
+    @classmethod
+    def iter_follower_ranges(cls, to_user_id, batch_size=1000):
+        """
+        按照存储里的顺序流式地遍历 to_user_id 的 followers，每 batch_size 个切成一段
+        yield (start, stop, count)，表示 [start, stop) 这个 cursor 区间里有 count 个 followers
+        hbase 里 cursor 是 twitter_followers row key 里的 created_at，mysql 里是 Friendship.id
+        只读取 row key（或者 id），并且不保存已经遍历过的数据，粉丝再多内存也是 O(1) 的
+        """
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            cursors = Friendship.objects.filter(to_user_id=to_user_id)\
+                .order_by('id')\
+                .values_list('id', flat=True)\
+                .iterator(chunk_size=batch_size)
         else:
-            friendships = HBaseFollower.filter(prefix=(to_user_id, None))
-        return [friendship.from_user_id for friendship in friendships]
+            cursors = HBaseFollower.filter_ids(
+                'created_at',
+                prefix=(to_user_id, None),
+                batch_size=batch_size,
+            )
+
+        start, last, count = None, None, 0
+        for cursor in cursors:
+            if count == batch_size:
+                yield start, cursor, count
+                start, count = None, 0
+            if start is None:
+                start = cursor
+            last = cursor
+            count += 1
+        if count:
+            # 最后一段用 last + 1 作为结束的 cursor，之后新关注的人不会收到这条 tweet
+            yield start, last + 1, count
 
     @classmethod
-    def get_following_user_id_set(cls, from_user_id):
-        # <TODO> cache in redis set
+    def get_follower_ids_in_range(cls, to_user_id, start, stop):
+        """
+        读取 iter_follower_ranges 切出来的某一段 [start, stop) 里的 follower ids
+        """
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            return list(Friendship.objects.filter(
+                to_user_id=to_user_id,
+                id__gte=start,
+                id__lt=stop,
+            ).values_list('from_user_id', flat=True))
+        return list(HBaseFollower.filter_ids(
+            'from_user_id',
+            start=(to_user_id, start),
+            stop=(to_user_id, stop),
+        ))
+
+    @classmethod
+    def get_follower_count(cls, to_user_id, limit=None):
+        """
+        limit 不为空的时候最多只数 limit 个 followers，用于判断粉丝数有没有超过某个阈值
+        hbase 里直接读取 HBaseFriendshipCount 里维护好的计数
+        """
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
-            friendships = Friendship.objects.filter(from_user_id=from_user_id)
+            queryset = Friendship.objects.filter(to_user_id=to_user_id)
+            if limit is not None:
+                queryset = queryset[:limit]
+            return queryset.count()
+        count = cls._get_friendship_count(to_user_id, 'followers_count', limit=limit)
+        if limit is not None:
+            return min(count, limit)
+        return count
+
+    @classmethod
+    def _scan_friendship_count(cls, user_id, attr, limit=None):
+        # 只 scan row key，不读取 column 的数据
+        model_class = HBaseFollower if attr == 'followers_count' else HBaseFollowing
+        rows = model_class.iter_filter(prefix=(user_id, None), limit=limit, columns=[])
+        return sum(1 for _ in rows)
+
+    @classmethod
+    def _get_friendship_count(cls, user_id, attr, limit=None):
+        # 计数器上线之前已经存在的关注关系没有计入 HBaseFriendshipCount
+        # reconcile_friendship_counts_task 完整跑完一遍之前，计数器的值不可信，还是 scan
+        if not GateKeeper.is_switch_on('switch_friendship_counts_reconciled'):
+            return cls._scan_friendship_count(user_id, attr, limit=limit)
+
+        # 先读 redis 里的镜像，miss 的时候从 HBaseFriendshipCount 里读取并写回 redis
+        conn = RedisClient.get_connection()
+        key = RedisHelper.get_count_key_by_id(User, attr, user_id)
+        count = conn.get(key)
+        if count is not None:
+            return int(count)
+        instance = HBaseFriendshipCount.get(user_id=user_id)
+        count = getattr(instance, attr, None) or 0
+        conn.set(key, count, ex=settings.REDIS_KEY_EXPIRE_TIME)
+        return count
+
+    @classmethod
+    def _incr_friendship_counts(cls, from_user_id, to_user_id, delta):
+        followings_count = HBaseFriendshipCount.counter_inc(
+            'followings_count',
+            delta,
+            user_id=from_user_id,
+        )
+        followers_count = HBaseFriendshipCount.counter_inc(
+            'followers_count',
+            delta,
+            user_id=to_user_id,
+        )
+        # 用 hbase 返回的最新值覆盖 redis，即使并发的时候写入的顺序不对，下一次更新也会修正过来
+        with RedisClient.pipeline() as pipeline:
+            pipeline.set(
+                RedisHelper.get_count_key_by_id(User, 'followings_count', from_user_id),
+                followings_count,
+                ex=settings.REDIS_KEY_EXPIRE_TIME,
+            )
+            pipeline.set(
+                RedisHelper.get_count_key_by_id(User, 'followers_count', to_user_id),
+                followers_count,
+                ex=settings.REDIS_KEY_EXPIRE_TIME,
+            )
+
+    @classmethod
+    def reconcile_friendship_counts(cls, user_id):
+        """
+        流式地 scan user 的 followers 和 followings，把数出来的数量直接写到 HBaseFriendshipCount 和 redis
+        返回 {attr: drift}，drift 为实际的数量减去计数器里的数量
+        scan 的过程中有 follow / unfollow 的时候数出来的不是一个快照，这次跳过，drift 记为 0
+        """
+        conn = RedisClient.get_connection()
+        drifts = {}
+        for attr in ['followers_count', 'followings_count']:
+            drifts[attr] = 0
+            for _ in range(RECONCILE_RETRY_TIMES):
+                result = cls._get_reconciled_count(user_id, attr)
+                if result is None:
+                    continue
+                before, count = result
+                drifts[attr] = count - before
+                if count != before:
+                    # 写绝对值而不是 counter_inc(drift)，不会把 scan 期间的 follow 重复计算
+                    HBaseFriendshipCount.counter_set(attr, count, user_id=user_id)
+                    conn.set(
+                        RedisHelper.get_count_key_by_id(User, attr, user_id),
+                        count,
+                        ex=settings.REDIS_KEY_EXPIRE_TIME,
+                    )
+                break
+        return drifts
+
+    @classmethod
+    def _get_reconciled_count(cls, user_id, attr):
+        """
+        返回 (计数器的值, scan 数出来的数量)，scan 的结果不是一个快照的时候返回 None
+        scan 前后计数器的值发生了变化，说明 scan 的过程中有 follow / unfollow
+        follow 先写 rows 再 counter_inc，最近 RECONCILE_SETTLE_TIME 之内创建的 rows 可能还没有计入计数器
+        """
+        started_at = int(time.time() * 1000000)
+        before = getattr(HBaseFriendshipCount.get(user_id=user_id), attr, None) or 0
+        model_class = HBaseFollower if attr == 'followers_count' else HBaseFollowing
+        count, settle_at = 0, started_at - RECONCILE_SETTLE_TIME * 1000000
+        for row in model_class.iter_filter(prefix=(user_id, None), columns=[]):
+            if row.created_at >= settle_at:
+                return None
+            count += 1
+        after = getattr(HBaseFriendshipCount.get(user_id=user_id), attr, None) or 0
+        if before != after:
+            return None
+        return before, count
+
+    @classmethod
+    def _iter_following_ids(cls, from_user_id):
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            return Friendship.objects.filter(from_user_id=from_user_id)\
+                .values_list('to_user_id', flat=True)\
+                .iterator()
+        return HBaseFollowing.filter_ids('to_user_id', prefix=(from_user_id, None))
+
+    @classmethod
+    def _load_following_cache(cls, from_user_id):
+        """
+        从数据库里读取 from_user_id 关注的所有人，写到 redis set 里并返回
+        超过 FOLLOWINGS_CACHE_LIMIT 的时候只写入 FOLLOWINGS_OVERFLOW，返回 None
+        读数据库期间有并发的 follow / unfollow 的时候不写入，见 RedisHelper.load_set
+        """
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        version = RedisHelper.get_set_version(key)
+        following_ids = set()
+        for to_user_id in cls._iter_following_ids(from_user_id):
+            following_ids.add(to_user_id)
+            if len(following_ids) > FOLLOWINGS_CACHE_LIMIT:
+                following_ids = None
+                break
+
+        if following_ids is None:
+            RedisHelper.load_set(key, version, [FOLLOWINGS_OVERFLOW])
         else:
-            friendships = HBaseFollowing.filter(prefix=(from_user_id, None))
-        user_id_set = set([
-            fs.to_user_id
-            for fs in friendships
+            RedisHelper.load_set(key, version, [FOLLOWINGS_LOADED, *following_ids])
+        return following_ids
+
+    @classmethod
+    def get_following_user_id_set(cls, from_user_id):
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        conn = RedisClient.get_connection()
+        user_id_set = {int(member) for member in conn.smembers(key)}
+        if FOLLOWINGS_LOADED in user_id_set:
+            user_id_set.discard(FOLLOWINGS_LOADED)
+            return user_id_set
+        if FOLLOWINGS_OVERFLOW not in user_id_set:
+            user_id_set = cls._load_following_cache(from_user_id)
+            if user_id_set is not None:
+                return user_id_set
+        return set(cls._iter_following_ids(from_user_id))
+
+    @classmethod
+    def has_followed_many(cls, from_user_id, to_user_ids):
+        """
+        一次 redis 调用判断 from_user_id 是否关注了 to_user_ids 里的每个人
+        返回 {to_user_id: True / False}
+        """
+        to_user_ids = list(to_user_ids)
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        # redis-py 3.5 没有 SMISMEMBER，用 pipeline 把多个 SISMEMBER 合成一次请求
+        with RedisClient.pipeline() as pipeline:
+            pipeline.sismember(key, FOLLOWINGS_LOADED)
+            pipeline.sismember(key, FOLLOWINGS_OVERFLOW)
+            for to_user_id in to_user_ids:
+                pipeline.sismember(key, to_user_id)
+            loaded, overflow, *results = pipeline.execute()
+        if loaded:
+            return {
+                to_user_id: bool(result)
+                for to_user_id, result in zip(to_user_ids, results)
+            }
+
+        if not overflow:
+            following_ids = cls._load_following_cache(from_user_id)
+            if following_ids is not None:
+                return {to_user_id: to_user_id in following_ids for to_user_id in to_user_ids}
+
+        followed_ids = cls._get_followed_ids_without_cache(from_user_id, to_user_ids)
+        return {to_user_id: to_user_id in followed_ids for to_user_id in to_user_ids}
+
+    @classmethod
+    def get_followed_ids_in_set(cls, from_user_id, set_key):
+        """
+        找出 redis set set_key 里 from_user_id 关注了的 user ids
+        following set 已经 load 过的时候直接在 redis 里 SINTER，不需要把 set_key 读出来
+        关注的人太多没有缓存的时候才读取 set_key 再逐个判断
+        """
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        # MULTI / EXEC 保证判断 loaded 和 SINTER 看到的是同一个 set
+        with RedisClient.pipeline(transaction=True) as pipeline:
+            pipeline.sismember(key, FOLLOWINGS_LOADED)
+            pipeline.sismember(key, FOLLOWINGS_OVERFLOW)
+            pipeline.sinter(key, set_key)
+            loaded, overflow, followed_ids = pipeline.execute()
+        if loaded:
+            return {int(user_id) for user_id in followed_ids}
+
+        conn = RedisClient.get_connection()
+        user_ids = {int(user_id) for user_id in conn.smembers(set_key)}
+        if not overflow:
+            following_ids = cls._load_following_cache(from_user_id)
+            if following_ids is not None:
+                return following_ids & user_ids
+        if not user_ids:
+            return set()
+        return cls._get_followed_ids_without_cache(from_user_id, user_ids)
+
+    @classmethod
+    def _get_followed_ids_without_cache(cls, from_user_id, to_user_ids):
+        # 关注的人太多没有缓存的时候，只找出 to_user_ids 里已经关注了的人
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            return set(Friendship.objects.filter(
+                from_user_id=from_user_id,
+                to_user_id__in=to_user_ids,
+            ).values_list('to_user_id', flat=True))
+
+        # 通过 HBaseFriendship 一次批量 get
+        friendships = HBaseFriendship.get_many([
+            {'from_user_id': from_user_id, 'to_user_id': to_user_id}
+            for to_user_id in to_user_ids
         ])
-        return user_id_set
+        return {
+            friendship.to_user_id
+            for friendship in friendships
+            if friendship is not None
+        }
+
+    @classmethod
+    def _add_following_to_cache(cls, from_user_id, to_user_id):
+        # 只有 set 已经 load 过的时候才加入新的 following
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        RedisHelper.add_to_loaded_set(key, FOLLOWINGS_LOADED, to_user_id)
+
+    @classmethod
+    def _remove_following_from_cache(cls, from_user_id, to_user_id):
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        RedisHelper.remove_from_loaded_set(key, to_user_id)
 
     @classmethod
     def invalidate_following_cache(cls, from_user_id):
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        cache.delete(key)
+        RedisHelper.invalidate_loaded_set(key)
 
     @classmethod
     def get_follow_instance(cls, from_user_id, to_user_id):
-        followings = HBaseFollowing.filter(prefix=(from_user_id, None))
-        for follow in followings:
-            if follow.to_user_id == to_user_id:
-                return follow
+        # 从 HBaseFriendship 里找到关注的时间，就知道 HBaseFollowing 的 row key，不需要 scan
+        friendship = HBaseFriendship.get(from_user_id=from_user_id, to_user_id=to_user_id)
+        if friendship is not None:
+            return HBaseFollowing(
+                from_user_id=from_user_id,
+                to_user_id=to_user_id,
+                created_at=friendship.created_at,
+            )
+        # backfill_hbase_friendships 跑完之后会打开这个 switch，HBaseFriendship 里没有就是没关注
+        if GateKeeper.is_switch_on('switch_hbase_friendship_backfilled'):
+            return None
+
+        # 索引上线之前的关注关系只在 followings 里，退回到 prefix scan，找到之后顺便补上索引
+        followings = HBaseFollowing.iter_filter(prefix=(from_user_id, None), columns=['to_user_id'])
+        for following in followings:
+            if following.to_user_id != to_user_id:
+                continue
+            followings.close()
+            HBaseFriendship.create(
+                from_user_id=from_user_id,
+                to_user_id=to_user_id,
+                created_at=following.created_at,
+            )
+            return following
         return None
 
     @classmethod
@@ -88,13 +408,7 @@ class FriendshipService(object):
     def has_followed(cls, from_user_id, to_user_id):
         if from_user_id == to_user_id:
             return False
-        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
-            return Friendship.objects.filter(
-                from_user_id=from_user_id,
-                to_user_id=to_user_id,
-            ).exists()
-        instance = cls.get_follow_instance(from_user_id, to_user_id)
-        return instance is not None
+        return cls.has_followed_many(from_user_id, [to_user_id])[to_user_id]
     
 
     @classmethod
@@ -109,18 +423,34 @@ class FriendshipService(object):
                 to_user_id=to_user_id,
             )
 
+        # 重复 follow 的时候直接返回，避免在 followings / followers 里写入重复的 rows
+        instance = cls.get_follow_instance(from_user_id, to_user_id)
+        if instance is not None:
+            return instance
+
         # create data in hbase
+        # 三张表没有办法放在同一个 batch 里，HBaseFriendship 最后写
+        # 这样 HBaseFriendship 里存在的关注关系，followings 和 followers 里一定也存在
         now = int(time.time() * 1000000)
         HBaseFollower.create(
             from_user_id=from_user_id,
             to_user_id=to_user_id,
             created_at=now,
         )
-        return HBaseFollowing.create(
+        following = HBaseFollowing.create(
+            from_user_id=from_user_id,
+            to_user_id=to_user_id,
+            created_at=now,
+        )
+        HBaseFriendship.create(
             from_user_id=from_user_id,
             to_user_id=to_user_id,
             created_at=now,
         )
+        cls._incr_friendship_counts(from_user_id, to_user_id, 1)
+        # mysql 的 Friendship 由 listener 删除 cache，hbase 没有 listener，这里直接更新 set
+        cls._add_following_to_cache(from_user_id, to_user_id)
+        return following
     
     @classmethod
     def unfollow(cls, from_user_id, to_user_id):
@@ -145,13 +475,16 @@ class FriendshipService(object):
         if instance is None:
             return 0
         
+        # HBaseFriendship 最后删，中途失败的话重试 unfollow 仍然可以找到另外两个 rows
         HBaseFollowing.delete(from_user_id=from_user_id, created_at=instance.created_at)
         HBaseFollower.delete(to_user_id=to_user_id, created_at=instance.created_at)
+        HBaseFriendship.delete(from_user_id=from_user_id, to_user_id=to_user_id)
+        cls._incr_friendship_counts(from_user_id, to_user_id, -1)
+        cls._remove_following_from_cache(from_user_id, to_user_id)
         return 1
     
     @classmethod
     def get_following_count(cls, from_user_id):
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             return Friendship.objects.filter(from_user_id=from_user_id).count()
-        followings = HBaseFollowing.filter(prefix=(from_user_id, None))
-        return len(followings)
\ No newline at end of file
+        return cls._get_friendship_count(from_user_id, 'followings_count')
\ No newline at end of file
@@ -0,0 +1,42 @@
+from celery import shared_task
+from django.contrib.auth.models import User
+from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
+from utils.time_constants import ONE_HOUR
+
+
+RECONCILE_BATCH_SIZE = 1000
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def reconcile_friendship_counts_task(start_user_id=0, batch_size=RECONCILE_BATCH_SIZE):
+    """
+    按照 user id 的顺序，每次检查 batch_size 个 users 的粉丝数和关注数
+    检查完之后创建下一个 task 继续检查后面的 users，避免一个 task 运行太久
+    """
+    if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+        return 'friendship counts are not materialized, skipped.'
+
+    user_ids = list(
+        User.objects.filter(id__gte=start_user_id)
+        .order_by('id')
+        .values_list('id', flat=True)[:batch_size]
+    )
+    drifted_users_count, total_drift = 0, 0
+    for user_id in user_ids:
+        drifts = FriendshipService.reconcile_friendship_counts(user_id)
+        if any(drifts.values()):
+            drifted_users_count += 1
+            total_drift += sum(abs(drift) for drift in drifts.values())
+
+    if len(user_ids) == batch_size:
+        reconcile_friendship_counts_task.delay(user_ids[-1] + 1, batch_size)
+    else:
+        # 所有 users 都检查过一遍之后，计数器里才包含了上线之前的关注关系，可以用来读取粉丝数
+        GateKeeper.turn_on('switch_friendship_counts_reconciled')
+
+    return '{} users checked, {} users drifted, total drift {}.'.format(
+        len(user_ids),
+        drifted_users_count,
+        total_drift,
+    )
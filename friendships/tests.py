@@ -1,7 +1,22 @@
-from friendships.services import FriendshipService
+from django.core.management import call_command
+from friendships.services import FriendshipService, FOLLOWINGS_LOADED
+from friendships.tasks import reconcile_friendship_counts_task
+from gatekeeper.models import GateKeeper
+from io import StringIO
 from testing.testcases import TestCase
+from django_hbase.client import HBaseClient
 from django_hbase.models import EmptyColumnError, BadRowKeyError
-from friendships.models import HBaseFollowing, HBaseFollower
+from friendships.models import (
+    HBaseFollowing,
+    HBaseFollower,
+    HBaseFriendship,
+    HBaseFriendshipCount,
+)
+from friendships.constants import FOLLOWINGS_CACHE_LIMIT
+from twitter.cache import FOLLOWINGS_PATTERN
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from django.contrib.auth.models import User
 
 import time
 
@@ -30,6 +45,204 @@ class FriendshipServiceTests(TestCase):
         self.assertSetEqual(user_id_set, {user1.id, user2.id})
 
 
+    def test_has_followed_many(self):
+        conn = RedisClient.get_connection()
+        key = FOLLOWINGS_PATTERN.format(user_id=self.linghu.id)
+        users = [self.create_user('user{}'.format(i)) for i in range(FOLLOWINGS_CACHE_LIMIT + 1)]
+        self.create_friendship(from_user=self.linghu, to_user=self.dongxie)
+
+        # cache miss 的时候 load 整个 set
+        has_followed = FriendshipService.has_followed_many(
+            self.linghu.id,
+            [self.dongxie.id, users[0].id],
+        )
+        self.assertEqual(has_followed, {self.dongxie.id: True, users[0].id: False})
+        self.assertEqual(conn.sismember(key, self.dongxie.id), True)
+
+        # follow / unfollow 直接更新 set
+        self.create_friendship(from_user=self.linghu, to_user=users[0])
+        self.assertEqual(FriendshipService.has_followed(self.linghu.id, users[0].id), True)
+        FriendshipService.unfollow(self.linghu.id, self.dongxie.id)
+        self.assertEqual(FriendshipService.has_followed(self.linghu.id, self.dongxie.id), False)
+        self.assertSetEqual(
+            FriendshipService.get_following_user_id_set(self.linghu.id),
+            {users[0].id},
+        )
+
+        # 关注的人太多的时候不缓存
+        for user in users[1:]:
+            self.create_friendship(from_user=self.linghu, to_user=user)
+        FriendshipService.invalidate_following_cache(self.linghu.id)
+        has_followed = FriendshipService.has_followed_many(
+            self.linghu.id,
+            [self.dongxie.id, users[-1].id],
+        )
+        self.assertEqual(has_followed, {self.dongxie.id: False, users[-1].id: True})
+        self.assertEqual(conn.scard(key), 1)
+        self.assertEqual(
+            len(FriendshipService.get_following_user_id_set(self.linghu.id)),
+            FOLLOWINGS_CACHE_LIMIT + 1,
+        )
+
+    def test_get_followed_ids_in_set(self):
+        conn = RedisClient.get_connection()
+        users = [self.create_user('user{}'.format(i)) for i in range(FOLLOWINGS_CACHE_LIMIT + 1)]
+        self.create_friendship(from_user=self.linghu, to_user=self.dongxie)
+        conn.sadd('test_user_ids', self.dongxie.id, users[0].id)
+
+        # cache miss 的时候先 load following set，之后直接 SINTER
+        followed_ids = FriendshipService.get_followed_ids_in_set(self.linghu.id, 'test_user_ids')
+        self.assertSetEqual(followed_ids, {self.dongxie.id})
+        self.create_friendship(from_user=self.linghu, to_user=users[0])
+        followed_ids = FriendshipService.get_followed_ids_in_set(self.linghu.id, 'test_user_ids')
+        self.assertSetEqual(followed_ids, {self.dongxie.id, users[0].id})
+
+        # 关注的人太多的时候读数据库
+        for user in users[1:]:
+            self.create_friendship(from_user=self.linghu, to_user=user)
+        FriendshipService.invalidate_following_cache(self.linghu.id)
+        followed_ids = FriendshipService.get_followed_ids_in_set(self.linghu.id, 'test_user_ids')
+        self.assertSetEqual(followed_ids, {self.dongxie.id, users[0].id})
+        followed_ids = FriendshipService.get_followed_ids_in_set(self.dongxie.id, 'test_user_ids')
+        self.assertSetEqual(followed_ids, set())
+
+    def test_load_following_cache_with_concurrent_follow(self):
+        conn = RedisClient.get_connection()
+        key = FOLLOWINGS_PATTERN.format(user_id=self.linghu.id)
+
+        # 读数据库之后 follow，快照里没有 dongxie，不写入 cache
+        version = RedisHelper.get_set_version(key)
+        self.create_friendship(from_user=self.linghu, to_user=self.dongxie)
+        self.assertEqual(RedisHelper.load_set(key, version, [FOLLOWINGS_LOADED]), False)
+        self.assertEqual(conn.exists(key), False)
+        self.assertSetEqual(
+            FriendshipService.get_following_user_id_set(self.linghu.id),
+            {self.dongxie.id},
+        )
+
+        # 读数据库之后 unfollow，快照里还有 dongxie，也不写入 cache
+        FriendshipService.invalidate_following_cache(self.linghu.id)
+        version = RedisHelper.get_set_version(key)
+        FriendshipService.unfollow(self.linghu.id, self.dongxie.id)
+        self.assertEqual(RedisHelper.load_set(key, version, [FOLLOWINGS_LOADED, self.dongxie.id]), False)
+        self.assertSetEqual(FriendshipService.get_following_user_id_set(self.linghu.id), set())
+
+        # set 已经存在的时候不会被覆盖
+        version = RedisHelper.get_set_version(key)
+        self.assertEqual(RedisHelper.load_set(key, version, [FOLLOWINGS_LOADED, self.dongxie.id]), False)
+        self.assertEqual(conn.sismember(key, self.dongxie.id), False)
+
+    def test_follow_and_unfollow(self):
+        following = FriendshipService.follow(self.linghu.id, self.dongxie.id)
+        instance = FriendshipService.get_follow_instance(self.linghu.id, self.dongxie.id)
+        self.assertEqual(instance.to_user_id, self.dongxie.id)
+        self.assertEqual(instance.created_at, following.created_at)
+        self.assertEqual(FriendshipService.get_follow_instance(self.dongxie.id, self.linghu.id), None)
+
+        # 重复 follow 不会写入新的 rows
+        instance = FriendshipService.follow(self.linghu.id, self.dongxie.id)
+        self.assertEqual(instance.created_at, following.created_at)
+        self.assertEqual(len(HBaseFollowing.filter(prefix=(self.linghu.id, None))), 1)
+
+        friendships = HBaseFriendship.get_many([
+            {'from_user_id': self.linghu.id, 'to_user_id': self.dongxie.id},
+            {'from_user_id': self.dongxie.id, 'to_user_id': self.linghu.id},
+        ])
+        self.assertEqual(friendships[0].created_at, following.created_at)
+        self.assertEqual(friendships[1], None)
+
+        self.assertEqual(FriendshipService.unfollow(self.linghu.id, self.dongxie.id), 1)
+        self.assertEqual(FriendshipService.get_follow_instance(self.linghu.id, self.dongxie.id), None)
+        self.assertEqual(HBaseFollowing.filter(prefix=(self.linghu.id, None)), [])
+        self.assertEqual(HBaseFollower.filter(prefix=(self.dongxie.id, None)), [])
+        self.assertEqual(FriendshipService.unfollow(self.linghu.id, self.dongxie.id), 0)
+
+    def test_legacy_follow_without_index(self):
+        # HBaseFriendship 上线之前的关注关系只有 followings / followers
+        users = [self.create_user('user{}'.format(i)) for i in range(2)]
+        for user in users:
+            ts = int(time.time() * 1000000)
+            HBaseFollowing.create(from_user_id=user.id, to_user_id=self.dongxie.id, created_at=ts)
+            HBaseFollower.create(from_user_id=user.id, to_user_id=self.dongxie.id, created_at=ts)
+
+        # 没有 backfill 的时候 scan followings 并且补上索引
+        instance = FriendshipService.get_follow_instance(users[0].id, self.dongxie.id)
+        self.assertEqual(instance.to_user_id, self.dongxie.id)
+        friendship = HBaseFriendship.get(from_user_id=users[0].id, to_user_id=self.dongxie.id)
+        self.assertEqual(friendship.created_at, instance.created_at)
+        self.assertEqual(FriendshipService.unfollow(users[0].id, self.dongxie.id), 1)
+        self.assertEqual(HBaseFollowing.filter(prefix=(users[0].id, None)), [])
+
+        call_command('backfill_hbase_friendships', stdout=StringIO())
+        self.assertEqual(GateKeeper.is_switch_on('switch_hbase_friendship_backfilled'), True)
+        friendship = HBaseFriendship.get(from_user_id=users[1].id, to_user_id=self.dongxie.id)
+        self.assertNotEqual(friendship, None)
+        self.assertEqual(HBaseFriendship.get(from_user_id=users[0].id, to_user_id=self.dongxie.id), None)
+        self.assertEqual(FriendshipService.unfollow(users[1].id, self.dongxie.id), 1)
+
+    def test_friendship_counts(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        for user in users:
+            self.create_friendship(from_user=user, to_user=self.linghu)
+        self.create_friendship(from_user=self.linghu, to_user=self.dongxie)
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id), 3)
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id, limit=2), 2)
+        self.assertEqual(FriendshipService.get_following_count(self.linghu.id), 1)
+        self.assertEqual(FriendshipService.get_following_count(users[0].id), 1)
+
+        FriendshipService.unfollow(users[0].id, self.linghu.id)
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id), 2)
+        self.assertEqual(FriendshipService.get_following_count(users[0].id), 0)
+
+        # redis 里的计数丢失之后从 hbase 里读取
+        conn = RedisClient.get_connection()
+        key = RedisHelper.get_count_key_by_id(User, 'followers_count', self.linghu.id)
+        conn.delete(key)
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id), 2)
+
+        # 计数器和实际的数据不一致的时候，reconcile 可以修正过来
+        HBaseFriendshipCount.counter_set('followers_count', 5, user_id=self.linghu.id)
+        conn.delete(key)
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id), 5)
+        drifts = FriendshipService.reconcile_friendship_counts(self.linghu.id)
+        self.assertEqual(drifts, {'followers_count': -3, 'followings_count': 0})
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id), 2)
+        drifts = FriendshipService.reconcile_friendship_counts(self.linghu.id)
+        self.assertEqual(drifts, {'followers_count': 0, 'followings_count': 0})
+
+        # reconcile 没有跑完之前不读计数器，还是 scan
+        HBaseFriendshipCount.counter_set('followers_count', 5, user_id=self.linghu.id)
+        conn.delete(key)
+        GateKeeper.set_kv('switch_friendship_counts_reconciled', 'percent', 0)
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id), 2)
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id, limit=1), 1)
+        reconcile_friendship_counts_task()
+        self.assertEqual(GateKeeper.is_switch_on('switch_friendship_counts_reconciled'), True)
+        self.assertEqual(FriendshipService.get_follower_count(self.linghu.id), 2)
+
+    def test_iter_follower_ranges(self):
+        self.assertEqual(list(FriendshipService.iter_follower_ranges(self.linghu.id, 2)), [])
+
+        follower_ids = []
+        for i in range(5):
+            user = self.create_user('user{}'.format(i))
+            self.create_friendship(from_user=user, to_user=self.linghu)
+            follower_ids.append(user.id)
+        self.create_friendship(from_user=self.linghu, to_user=self.dongxie)
+
+        ranges = list(FriendshipService.iter_follower_ranges(self.linghu.id, 2))
+        self.assertEqual([count for _, _, count in ranges], [2, 2, 1])
+        # 相邻的两段首尾相接
+        self.assertEqual(ranges[0][1], ranges[1][0])
+        self.assertEqual(ranges[1][1], ranges[2][0])
+
+        ids = []
+        for start, stop, count in ranges:
+            batch_ids = FriendshipService.get_follower_ids_in_range(self.linghu.id, start, stop)
+            self.assertEqual(len(batch_ids), count)
+            ids.extend(batch_ids)
+        self.assertEqual(sorted(ids), sorted(follower_ids))
+
 class HBaseTests(TestCase):
 
     @property
@@ -137,3 +350,65 @@ class HBaseTests(TestCase):
         self.assertEqual(results[0].to_user_id, 3)
         self.assertEqual(results[1].to_user_id, 2)
 
+
+    def test_filter_as_columns(self):
+        timestamps = [self.ts_now for _ in range(3)]
+        for to_user_id, ts in zip([2, 3, 4], timestamps):
+            HBaseFollowing.create(from_user_id=1, to_user_id=to_user_id, created_at=ts)
+
+        columns = HBaseFollowing.filter(prefix=(1, None), as_columns=True)
+        self.assertEqual(columns['from_user_id'], [1, 1, 1])
+        self.assertEqual(columns['to_user_id'], [2, 3, 4])
+        self.assertEqual(columns['created_at'], timestamps)
+
+        # same result as decoding row by row
+        table = HBaseFollowing.get_table()
+        rows = list(table.scan(row_prefix=HBaseFollowing.serialize_row_key_from_tuple((1, None))))
+        instances = HBaseFollowing.decode_rows(rows)
+        for instance, (row_key, row_data) in zip(instances, rows):
+            expected = HBaseFollowing.init_from_row(row_key, row_data)
+            self.assertEqual(instance.row_key, expected.row_key)
+            self.assertEqual(instance.to_user_id, expected.to_user_id)
+
+        # row key 段数不对时抛出 BadRowKeyError 而不是 IndexError
+        try:
+            HBaseFollowing.decode_rows([(b'0000000000000001', {})])
+            exception_raised = False
+        except BadRowKeyError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+    def test_iter_filter(self):
+        for to_user_id in range(2, 9):
+            HBaseFollowing.create(from_user_id=1, to_user_id=to_user_id, created_at=self.ts_now)
+        HBaseFollowing.create(from_user_id=2, to_user_id=1, created_at=self.ts_now)
+
+        results = HBaseFollowing.iter_filter(prefix=(1, None), batch_size=3)
+        self.assertEqual(isinstance(results, list), False)
+        self.assertEqual([r.to_user_id for r in results], list(range(2, 9)))
+
+        results = list(HBaseFollowing.iter_filter(prefix=(1, None), batch_size=3, reverse=True))
+        self.assertEqual([r.to_user_id for r in results], list(range(8, 1, -1)))
+
+        # only read row key, to_user_id is not fetched
+        results = list(HBaseFollowing.iter_filter(prefix=(1, None), columns=['created_at']))
+        self.assertEqual(len(results), 7)
+        self.assertEqual(results[0].from_user_id, 1)
+        self.assertEqual(results[0].to_user_id, None)
+
+        ids = HBaseFollowing.filter_ids('to_user_id', prefix=(1, None), batch_size=2)
+        self.assertEqual(list(ids), list(range(2, 9)))
+        ids = HBaseFollowing.filter_ids('from_user_id', prefix=(2, None))
+        self.assertEqual(list(ids), [2])
+
+    def test_connection_pool(self):
+        pool = HBaseClient.get_pool()
+        self.assertEqual(HBaseClient.get_pool() is pool, True)
+        # 模拟 fork 之后 pid 变了，需要重新创建 pool
+        HBaseClient.pid = None
+        self.assertEqual(HBaseClient.get_pool() is pool, False)
+
+        # 同一个线程里嵌套使用的是同一个 connection
+        with HBaseClient.connection() as conn:
+            with HBaseClient.connection() as nested_conn:
+                self.assertEqual(conn is nested_conn, True)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from gatekeeper.models import GATEKEEPER_CHANNEL, GATEKEEPER_KEY_PREFIX, GATEKEEPER_NAMES_KEY
+from utils.redis_client import RedisClient
+
+
+class Command(BaseCommand):
+    help = 'Register gatekeepers created before GATEKEEPER_NAMES_KEY existed'
+
+    def handle(self, *args, **options):
+        # 只需要在上线的时候跑一次，之后 set_kv 会自己把名字写到 GATEKEEPER_NAMES_KEY 里
+        conn = RedisClient.get_connection()
+        gk_names = [
+            key.decode('utf-8')[len(GATEKEEPER_KEY_PREFIX):]
+            for key in conn.scan_iter(match=GATEKEEPER_KEY_PREFIX + '*')
+        ]
+        if gk_names:
+            conn.sadd(GATEKEEPER_NAMES_KEY, *gk_names)
+            # 通知正在运行的进程重新读取快照
+            conn.publish(GATEKEEPER_CHANNEL, '')
+        self.stdout.write(self.style.SUCCESS(
+            'Done, {} gatekeepers registered.'.format(len(gk_names)),
+        ))
@@ -1,26 +1,124 @@
+from django.conf import settings
 from utils.redis_client import RedisClient
 
+import os
+import threading
+import time
+
+
+GATEKEEPER_KEY_PREFIX = 'gatekeeper:'
+# 所有 gatekeeper 的名字，set_kv 的时候写入，读取快照的时候不需要 scan 整个 keyspace
+# 不能以 GATEKEEPER_KEY_PREFIX 开头，否则会被当成一个 gatekeeper 的 hash
+GATEKEEPER_NAMES_KEY = 'gatekeeper_names'
+# set_kv 之后在这个 channel 里通知所有进程丢弃本地的 gatekeeper 缓存
+GATEKEEPER_CHANNEL = 'gatekeeper_updates'
+
 
 class GateKeeper(object):
+    # 本进程里所有 gatekeeper 的快照 {gk_name: {'percent': .., 'description': ..}}
+    # is_switch_on 在每个 request 里会被调用很多次，读本地的 dict 就不需要每次访问 redis
+    _snapshot = None
+    _snapshot_expire_at = 0
+    # 每次 invalidate 加一
+    _version = 0
+    _lock = threading.Lock()
+    # 订阅 GATEKEEPER_CHANNEL 的后台线程，fork 之后线程不会被复制，需要按照 pid 重新创建
+    _listener_thread = None
+    _listener_pid = None
 
     @classmethod
-    def get(cls, gk_name):
+    def _load_snapshot(cls):
         conn = RedisClient.get_connection()
-        name = f'gatekeeper:{gk_name}'
-        if not conn.exists(name):
-            return {'percent': 0, 'description': ''}
+        gk_names = [gk_name.decode('utf-8') for gk_name in conn.smembers(GATEKEEPER_NAMES_KEY)]
+        with RedisClient.pipeline() as pipeline:
+            for gk_name in gk_names:
+                pipeline.hgetall(f'{GATEKEEPER_KEY_PREFIX}{gk_name}')
+            redis_hashes = pipeline.execute()
+        snapshot = {}
+        for gk_name, redis_hash in zip(gk_names, redis_hashes):
+            snapshot[gk_name] = {
+                'percent': int(redis_hash.get(b'percent', 0)),
+                'description': str(redis_hash.get(b'description', '')),
+            }
+        return snapshot
 
-        redis_hash = conn.hgetall(name)
-        return {
-            'percent': int(redis_hash.get(b'percent', 0)),
-            'description': str(redis_hash.get(b'description', '')),
-        }
+    @classmethod
+    def _refresh_snapshot(cls):
+        # 读取的过程中如果收到了 invalidate，读到的可能是旧数据，不设置过期时间，下次重新读取
+        version = cls._version
+        expire_at = time.time() + settings.GATEKEEPER_LOCAL_CACHE_TTL
+        snapshot = cls._load_snapshot()
+        with cls._lock:
+            cls._snapshot = snapshot
+            if cls._version == version:
+                cls._snapshot_expire_at = expire_at
+        return snapshot
+
+    @classmethod
+    def _listen(cls):
+        while True:
+            try:
+                pubsub = RedisClient.get_connection().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(GATEKEEPER_CHANNEL)
+                while True:
+                    message = pubsub.get_message(timeout=settings.GATEKEEPER_LOCAL_CACHE_TTL / 2)
+                    if message is not None:
+                        cls.invalidate_local_cache()
+                    else:
+                        # 没有修改的时候在后台刷新快照，请求里基本不会遇到快照过期
+                        cls._refresh_snapshot()
+            except Exception:
+                # redis 断开的时候可能错过了通知，丢掉快照，请求里会直接读 redis
+                cls.invalidate_local_cache()
+                time.sleep(1)
+
+    @classmethod
+    def _ensure_listener(cls):
+        pid = os.getpid()
+        if cls._listener_pid == pid:
+            return
+        if cls._listener_pid is not None:
+            # fork 的时候 lock 可能正被父进程的其他线程持有，子进程里需要一个新的 lock
+            cls._lock = threading.Lock()
+        with cls._lock:
+            if cls._listener_pid == pid:
+                return
+            cls._snapshot = None
+            cls._snapshot_expire_at = 0
+            cls._listener_thread = threading.Thread(
+                target=cls._listen,
+                name='gatekeeper-listener',
+                daemon=True,
+            )
+            cls._listener_thread.start()
+            cls._listener_pid = pid
+
+    @classmethod
+    def invalidate_local_cache(cls):
+        with cls._lock:
+            cls._snapshot_expire_at = 0
+            cls._version += 1
+
+    @classmethod
+    def get(cls, gk_name):
+        cls._ensure_listener()
+        snapshot = cls._snapshot
+        if snapshot is None or time.time() >= cls._snapshot_expire_at:
+            snapshot = cls._refresh_snapshot()
+        gk = snapshot.get(gk_name)
+        if gk is None:
+            return {'percent': 0, 'description': ''}
+        return dict(gk)
 
     @classmethod
     def set_kv(cls, gk_name, key, value):
-        conn = RedisClient.get_connection()
-        name = f'gatekeeper:{gk_name}'
-        conn.hset(name, key, value)
+        name = f'{GATEKEEPER_KEY_PREFIX}{gk_name}'
+        # 本进程马上生效，其他进程通过 pub/sub 收到通知之后生效
+        with RedisClient.pipeline() as pipeline:
+            pipeline.hset(name, key, value)
+            pipeline.sadd(GATEKEEPER_NAMES_KEY, gk_name)
+            pipeline.publish(GATEKEEPER_CHANNEL, gk_name)
+        cls.invalidate_local_cache()
 
     @classmethod
     def is_switch_on(cls, gk_name):
@@ -32,4 +130,4 @@ class GateKeeper(object):
         
     @classmethod
     def in_gk(cls, gk_name, user_id):
-        return user_id % 100 < cls.get(gk_name)['percent']
\ No newline at end of file
+        return user_id % 100 < cls.get(gk_name)['percent']
@@ -1,5 +1,8 @@
+from django.core.management import call_command
+from io import StringIO
 from testing.testcases import TestCase
-from gatekeeper.models import GateKeeper
+from gatekeeper.models import GATEKEEPER_NAMES_KEY, GateKeeper
+from utils.redis_client import RedisClient
 
 
 class GateKeeperTests(TestCase):
@@ -19,4 +22,35 @@ class GateKeeperTests(TestCase):
 
         GateKeeper.set_kv('gk_name', 'percent', 100)
         self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
-        self.assertEqual(GateKeeper.in_gk('gk_name', 1), True)
\ No newline at end of file
+        self.assertEqual(GateKeeper.in_gk('gk_name', 1), True)
+
+    def test_local_cache(self):
+        GateKeeper.set_kv('gk_name', 'percent', 20)
+        self.assertEqual(GateKeeper.get('gk_name')['percent'], 20)
+
+        # 绕过 set_kv 直接修改 redis，本进程的缓存不会马上更新
+        conn = RedisClient.get_connection()
+        conn.hset('gatekeeper:gk_name', 'percent', 100)
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), False)
+        GateKeeper.invalidate_local_cache()
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
+
+        # set_kv 马上生效
+        GateKeeper.set_kv('gk_name', 'percent', 0)
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), False)
+
+    def test_registered_names(self):
+        conn = RedisClient.get_connection()
+        GateKeeper.turn_on('gk_name')
+        # clear_cache 里打开的 switches 也会注册，只检查 gk_name 在不在里面
+        self.assertEqual(conn.sismember(GATEKEEPER_NAMES_KEY, 'gk_name'), True)
+        self.assertEqual(conn.sismember(GATEKEEPER_NAMES_KEY, 'old_gk'), False)
+
+        # 没有通过 set_kv 写入的 hash 不会被读到，需要跑 register_gatekeepers
+        conn.hset('gatekeeper:old_gk', 'percent', 100)
+        GateKeeper.invalidate_local_cache()
+        self.assertEqual(GateKeeper.is_switch_on('old_gk'), False)
+        call_command('register_gatekeepers', stdout=StringIO())
+        GateKeeper.invalidate_local_cache()
+        self.assertEqual(GateKeeper.is_switch_on('old_gk'), True)
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
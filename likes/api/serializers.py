@@ -8,12 +8,19 @@ from tweets.models import Tweet
 
 
 class LikeSerializer(serializers.ModelSerializer):
-    user = UserSerializerForLike(source='cached_user')
+    user = serializers.SerializerMethodField()
 
     class Meta:
         model = Like
         fields = ('user', 'created_at')
 
+    def get_user(self, obj):
+        # 一页 likes 的 users 可以通过 context['hydrated'] 预先批量取好，见 LikeService.hydrate_likes
+        hydrated = self.context.get('hydrated')
+        if hydrated is not None and obj.user_id in hydrated['users']:
+            return UserSerializerForLike(hydrated['users'][obj.user_id]).data
+        return UserSerializerForLike(obj.cached_user).data
+
 
 class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
     content_type = serializers.ChoiceField(choices=['comment', 'tweet'])
@@ -1,4 +1,5 @@
 from testing.testcases import TestCase
+from utils.redis_helper import RedisHelper
 from rest_framework.test import APIClient
 
 
@@ -220,11 +221,14 @@ class LikeApiTests(TestCase):
         tweet_url = TWEET_DETAIL_API.format(tweet.id)
         response = self.linghu_client.get(tweet_url)
         self.assertEqual(response.data['likes_count'], 1)
+        # 计数只在 redis 里修改，定期写回数据库，这里手动 flush 一次
+        RedisHelper.flush_dirty_counts()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 1)
 
         # dongxie canceled likes
         self.linghu_client.post(LIKE_BASE_URL + 'cancel/', data)
+        RedisHelper.flush_dirty_counts()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 0)
         response = self.dongxie_client.get(tweet_url)
@@ -243,12 +247,14 @@ class LikeApiTests(TestCase):
             # check tweet api
             response = client.get(tweet_url)
             self.assertEqual(response.data['likes_count'], i + 1)
+            RedisHelper.flush_dirty_counts()
             tweet.refresh_from_db()
             self.assertEqual(tweet.likes_count, i + 1)
 
         self.dongxie_client.post(LIKE_BASE_URL, data)
         response = self.dongxie_client.get(tweet_url)
         self.assertEqual(response.data['likes_count'], 4)
+        RedisHelper.flush_dirty_counts()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 4)
 
@@ -261,6 +267,7 @@ class LikeApiTests(TestCase):
 
         # dongxie canceled likes
         self.dongxie_client.post(LIKE_BASE_URL + 'cancel/', data)
+        RedisHelper.flush_dirty_counts()
         tweet.refresh_from_db()
         self.assertEqual(tweet.likes_count, 3)
         response = self.dongxie_client.get(tweet_url)
@@ -0,0 +1,4 @@
+from django.conf import settings
+
+# 一个 user like 过的某一种 objects 超过这个数量的时候不在 redis 里缓存 liked set
+LIKES_CACHE_LIMIT = 10000 if not settings.TESTING else 10
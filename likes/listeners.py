@@ -2,35 +2,41 @@ from utils.redis_helper import RedisHelper
 
 def incr_likes_count(sender, instance, created, **kwargs):
     from tweets.models import Tweet
-    from django.db.models import F
+    from comments.models import Comment
+    from likes.services import LikeService
 
     if not created:
         return
 
+    # tweet 和 comment 的 like 都需要更新 user 的 liked set
+    LikeService.add_like_to_cache(instance)
+
     model_class = instance.content_type.model_class()
-    if model_class != Tweet:
-        # TODO HOMEWORK 给 Comment 使用类似的方法进行 likes_count 的统计
+    if model_class not in (Tweet, Comment):
         return
+    if model_class == Tweet:
+        LikeService.push_tweet_like_to_cache(instance)
 
-    # 不可以使用 tweet.likes_count += 1; tweet.save() 的方式
-    # 因此这个操作不是原子操作，必须使用 update 语句才是原子操作
-    # tweet = instance.content_object
-    #SQL Query: UPDATE likes_count = likes_count + 1 FROM tweets_table WHERE id=<instance.object_id>
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') + 1)
-    RedisHelper.incr_count(instance.content_object, 'likes_count')
+    # 不可以使用 tweet.likes_count += 1; tweet.save() 的方式，也不在这里 UPDATE 数据库
+    # 热门 tweet 每秒钟可能有成千上万个 like，每个 like 一条 UPDATE 会在同一行上产生大量的行锁竞争
+    # 只修改 redis 里的计数，由 flush_dirty_counts_task 定期合并之后写回数据库
+    # object 已经被删除的时候返回 None，不会写入 cache
+    RedisHelper.incr_count_by_id(model_class, 'likes_count', instance.object_id, 1)
 
 
 
 def decr_likes_count(sender, instance, **kwargs):
     from tweets.models import Tweet
-    from django.db.models import F
+    from comments.models import Comment
+    from likes.services import LikeService
+
+    LikeService.remove_like_from_cache(instance)
 
     model_class = instance.content_type.model_class()
-    if model_class != Tweet:
-        # TODO HOMEWORK 给 Comment 使用类似的方法进行 likes_count 的统计
+    if model_class not in (Tweet, Comment):
         return
+    if model_class == Tweet:
+        LikeService.remove_tweet_like_from_cache(instance)
 
-    # handle tweet likes cancel
-    #tweet = instance.content_object
-    Tweet.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') - 1)
-    RedisHelper.decr_count(instance.content_object, 'likes_count')
\ No newline at end of file
+    # handle tweet / comment likes cancel
+    RedisHelper.incr_count_by_id(model_class, 'likes_count', instance.object_id, -1)
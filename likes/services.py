@@ -1,15 +1,135 @@
+from accounts.services import UserService
+from likes.constants import LIKES_CACHE_LIMIT
 from likes.models import Like
 from django.contrib.contenttypes.models import ContentType
+from twitter.cache import LIKED_OBJECTS_PATTERN, TWEET_LIKES_PATTERN
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+
+# liked set 里的两个特殊的 member，object id 都是正数不会冲突
+# redis 里不能存储空的 set，set 里有 LIKES_LOADED 才表示已经完整地 load 过了
+LIKES_LOADED = 0
+# like 过的 objects 太多，set 里只有这一个 member，读取的时候直接访问数据库
+LIKES_OVERFLOW = -1
+
+
+def lazy_load_tweet_likes(tweet_id):
+    def _lazy_load(limit):
+        from tweets.models import Tweet
+        # 可以用到 <content_type, object_id, created_at> 的索引
+        return Like.objects.filter(
+            content_type=ContentType.objects.get_for_model(Tweet),
+            object_id=tweet_id,
+        ).order_by('-created_at', '-id')[:limit]
+    return _lazy_load
 
 
 class LikeService(object):
 
+    @classmethod
+    def _get_liked_key(cls, user_id, model_class):
+        return LIKED_OBJECTS_PATTERN.format(user_id=user_id, model=model_class._meta.model_name)
+
+    @classmethod
+    def _load_liked_cache(cls, user_id, model_class):
+        """
+        从数据库里读取 user like 过的所有 model_class 的 objects，写到 redis set 里并返回
+        超过 LIKES_CACHE_LIMIT 的时候只写入 LIKES_OVERFLOW，返回 None
+        这条查询可以用到 <user, content_type, created_at> 的索引
+        读数据库期间有并发的 like / 取消 like 的时候不写入，见 RedisHelper.load_set
+        """
+        key = cls._get_liked_key(user_id, model_class)
+        version = RedisHelper.get_set_version(key)
+        object_ids = set(Like.objects.filter(
+            user_id=user_id,
+            content_type=ContentType.objects.get_for_model(model_class),
+        ).values_list('object_id', flat=True)[:LIKES_CACHE_LIMIT + 1])
+        if len(object_ids) > LIKES_CACHE_LIMIT:
+            object_ids = None
+
+        if object_ids is None:
+            RedisHelper.load_set(key, version, [LIKES_OVERFLOW])
+        else:
+            RedisHelper.load_set(key, version, [LIKES_LOADED, *object_ids])
+        return object_ids
+
+    @classmethod
+    def _get_liked_ids_without_cache(cls, user_id, model_class, object_ids):
+        return set(Like.objects.filter(
+            content_type=ContentType.objects.get_for_model(model_class),
+            object_id__in=object_ids,
+            user_id=user_id,
+        ).values_list('object_id', flat=True))
+
     @classmethod
     def has_liked(cls, user, target):
+        return cls.has_liked_many(user, [target])[target.id]
+
+    @classmethod
+    def has_liked_many(cls, user, targets):
+        """
+        批量判断 user 是否 like 了 targets，返回 {target.id: bool}
+        targets 需要是同一种 model（比如一页 tweets），一次 redis 调用就可以得到结果
+        只有 set 不在 cache 里的时候才访问数据库，like 过的 objects 太多的用户使用一条 IN query
+        """
+        if not targets:
+            return {}
         if user.is_anonymous:
-            return False
-        return Like.objects.filter(
-            content_type=ContentType.objects.get_for_model(target.__class__),
-            object_id=target.id,
-            user=user,
-        ).exists()
\ No newline at end of file
+            return {target.id: False for target in targets}
+
+        model_class = targets[0].__class__
+        object_ids = [target.id for target in targets]
+        key = cls._get_liked_key(user.id, model_class)
+        # redis-py 3.5 没有 SMISMEMBER，用 pipeline 把多个 SISMEMBER 合成一次请求
+        with RedisClient.pipeline() as pipeline:
+            pipeline.sismember(key, LIKES_LOADED)
+            pipeline.sismember(key, LIKES_OVERFLOW)
+            for object_id in object_ids:
+                pipeline.sismember(key, object_id)
+            loaded, overflow, *results = pipeline.execute()
+        if loaded:
+            return {
+                object_id: bool(result)
+                for object_id, result in zip(object_ids, results)
+            }
+
+        liked_ids = None
+        if not overflow:
+            liked_ids = cls._load_liked_cache(user.id, model_class)
+        if liked_ids is None:
+            liked_ids = cls._get_liked_ids_without_cache(user.id, model_class, object_ids)
+        return {object_id: object_id in liked_ids for object_id in object_ids}
+
+    @classmethod
+    def add_like_to_cache(cls, like):
+        # 只有 set 已经 load 过的时候才加入新的 like
+        key = cls._get_liked_key(like.user_id, like.content_type.model_class())
+        RedisHelper.add_to_loaded_set(key, LIKES_LOADED, like.object_id)
+
+    @classmethod
+    def remove_like_from_cache(cls, like):
+        key = cls._get_liked_key(like.user_id, like.content_type.model_class())
+        RedisHelper.remove_from_loaded_set(key, like.object_id)
+
+    @classmethod
+    def hydrate_likes(cls, likes):
+        # 渲染一页 likes 只需要 users，从 memcached 里批量读取
+        return {'users': UserService.get_users_through_cache([like.user_id for like in likes])}
+
+    @classmethod
+    def get_cached_tweet_likes_in_range(cls, tweet_id, **kwargs):
+        # 参数见 RedisHelper.load_objects_in_range，用于 EndlessPagination.paginate_cached_range
+        key = TWEET_LIKES_PATTERN.format(tweet_id=tweet_id)
+        return RedisHelper.load_objects_in_range(key, lazy_load_tweet_likes(tweet_id), **kwargs)
+
+    @classmethod
+    def push_tweet_like_to_cache(cls, like):
+        key = TWEET_LIKES_PATTERN.format(tweet_id=like.object_id)
+        RedisHelper.push_object(key, like, lazy_load_tweet_likes(like.object_id))
+
+    @classmethod
+    def remove_tweet_like_from_cache(cls, like):
+        # 取消 like 的时候只从 sorted set 里删掉这一个 like，不需要重新 load 整个 cache
+        key = TWEET_LIKES_PATTERN.format(tweet_id=like.object_id)
+        RedisHelper.remove_object(key, like)
@@ -1,3 +1,77 @@
-from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from likes.constants import LIKES_CACHE_LIMIT
+from likes.models import Like
+from likes.services import LikeService, LIKES_LOADED
+from testing.testcases import TestCase
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
 
-# Create your tests here.
+
+class LikeServiceTests(TestCase):
+
+    def setUp(self):
+        super(LikeServiceTests, self).setUp()
+        self.linghu = self.create_user('linghu')
+        self.dongxie = self.create_user('dongxie')
+
+    def test_has_liked_many(self):
+        tweets = [self.create_tweet(self.dongxie) for _ in range(3)]
+        comment = self.create_comment(self.dongxie, tweets[0])
+        self.create_like(self.linghu, tweets[0])
+        self.create_like(self.linghu, comment)
+        conn = RedisClient.get_connection()
+        key = LikeService._get_liked_key(self.linghu.id, tweets[0].__class__)
+        # tweet 和 comment 的 id 可能相同，修改 likes 的时候要限定 content_type
+        tweet_likes = Like.objects.filter(
+            user=self.linghu,
+            content_type=ContentType.objects.get_for_model(tweets[0].__class__),
+        )
+
+        # cache miss, load from db
+        conn.delete(key)
+        expected = {tweets[0].id: True, tweets[1].id: False, tweets[2].id: False}
+        self.assertEqual(LikeService.has_liked_many(self.linghu, tweets), expected)
+        self.assertEqual(conn.ttl(key) > 0, True)
+
+        # cache hit，tweet 和 comment 分开缓存
+        tweet_likes.filter(object_id=tweets[0].id).update(object_id=tweets[1].id)
+        self.assertEqual(LikeService.has_liked_many(self.linghu, tweets), expected)
+        self.assertEqual(LikeService.has_liked(self.linghu, comment), True)
+        self.assertEqual(LikeService.has_liked(self.dongxie, comment), False)
+        self.assertEqual(LikeService.has_liked(AnonymousUser(), comment), False)
+
+        # like / cancel like 的时候更新 cache
+        conn.delete(key)
+        LikeService.has_liked_many(self.linghu, tweets)
+        self.create_like(self.linghu, tweets[2])
+        self.assertEqual(LikeService.has_liked(self.linghu, tweets[2]), True)
+        tweet_likes.filter(object_id=tweets[2].id).delete()
+        self.assertEqual(LikeService.has_liked(self.linghu, tweets[2]), False)
+
+        # like 过的 objects 太多，不使用 cache
+        for _ in range(LIKES_CACHE_LIMIT):
+            self.create_like(self.linghu, self.create_tweet(self.dongxie))
+        conn.delete(key)
+        self.assertEqual(LikeService.has_liked(self.linghu, tweets[1]), True)
+        self.assertEqual(LikeService.has_liked(self.linghu, tweets[2]), False)
+        self.assertEqual(conn.scard(key), 1)
+
+    def test_load_liked_cache_with_concurrent_like(self):
+        tweet = self.create_tweet(self.dongxie)
+        conn = RedisClient.get_connection()
+        key = LikeService._get_liked_key(self.linghu.id, tweet.__class__)
+
+        # 读数据库之后 like，快照里没有这个 tweet，不写入 cache
+        version = RedisHelper.get_set_version(key)
+        like = self.create_like(self.linghu, tweet)
+        self.assertEqual(RedisHelper.load_set(key, version, [LIKES_LOADED]), False)
+        self.assertEqual(conn.exists(key), False)
+        self.assertEqual(LikeService.has_liked(self.linghu, tweet), True)
+
+        # 读数据库之后取消 like，快照里还有这个 tweet，也不写入 cache
+        conn.delete(key)
+        version = RedisHelper.get_set_version(key)
+        like.delete()
+        self.assertEqual(RedisHelper.load_set(key, version, [LIKES_LOADED, tweet.id]), False)
+        self.assertEqual(LikeService.has_liked(self.linghu, tweet), False)
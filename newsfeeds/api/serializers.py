@@ -14,7 +14,12 @@ class NewsFeedSerializer(serializers.Serializer):
         pass
 
     def get_tweet(self, obj):
-        return TweetSerializer(obj.cached_tweet, context=self.context).data
+        hydrated = self.context.get('hydrated')
+        if hydrated is not None and obj.tweet_id in hydrated['tweets']:
+            tweet = hydrated['tweets'][obj.tweet_id]
+        else:
+            tweet = obj.cached_tweet
+        return TweetSerializer(tweet, context=self.context).data
 
     def get_created_at(self, obj):
         return obj.created_at
\ No newline at end of file
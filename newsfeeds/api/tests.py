@@ -5,6 +5,8 @@ from testing.testcases import TestCase
 from utils.paginations import EndlessPagination
 from newsfeeds.services import NewsFeedService
 from django.conf import settings
+from twitter.cache import CELEBRITY_USER_IDS_KEY
+from utils.redis_client import RedisClient
 
 
 NEWSFEEDS_URL = '/api/newsfeeds/'
@@ -163,14 +165,18 @@ class NewsFeedApiTests(TestCase):
         self.assertEqual(results[0]['tweet']['content'], 'content2')
 
 
-    def _paginate_to_get_newsfeeds(self, client):
+    def _paginate_to_get_newsfeeds(self, client, use_cursor=False):
         # paginate until the end
         response = client.get(NEWSFEEDS_URL)
         results = response.data['results']
         while response.data['has_next_page']:
-            created_at__lt = response.data['results'][-1]['created_at']
-            response = client.get(NEWSFEEDS_URL, {'created_at__lt': created_at__lt})
+            if use_cursor:
+                params = {'cursor': response.data['next_cursor']}
+            else:
+                params = {'created_at__lt': response.data['results'][-1]['created_at']}
+            response = client.get(NEWSFEEDS_URL, params)
             results.extend(response.data['results'])
+        self.assertEqual(response.data['next_cursor'], None)
         return results
 
     def test_redis_list_limit(self):
@@ -214,4 +220,46 @@ class NewsFeedApiTests(TestCase):
 
         # cache expired
         self.clear_cache()
-        _test_newsfeeds_after_new_feed_pushed()
\ No newline at end of file
+        _test_newsfeeds_after_new_feed_pushed()
+
+    def test_paginate_with_cursor(self):
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        page_size = EndlessPagination.page_size
+        newsfeeds = []
+        for i in range(list_limit + page_size):
+            tweet = self.create_tweet(user=self.dongxie, content='feed{}'.format(i))
+            newsfeeds.append(self.create_newsfeed(self.linghu, tweet))
+        newsfeeds = newsfeeds[::-1]
+
+        # 翻页的时候从 cache 读到数据库，不会重复也不会遗漏
+        results = self._paginate_to_get_newsfeeds(self.linghu_client, use_cursor=True)
+        self.assertEqual(len(results), list_limit + page_size)
+        for i in range(list_limit + page_size):
+            self.assertEqual(newsfeeds[i].created_at, results[i]['created_at'])
+
+        # 被修改过的 cursor 不能使用
+        response = self.linghu_client.get(NEWSFEEDS_URL)
+        cursor = response.data['next_cursor']
+        response = self.linghu_client.get(NEWSFEEDS_URL, {'cursor': cursor + 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_paginate_with_celebrities_beyond_cache(self):
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        page_size = EndlessPagination.page_size
+        GateKeeper.turn_on('switch_newsfeed_pull_for_celebrities')
+        self.create_friendship(self.linghu, self.dongxie)
+        RedisClient.get_connection().sadd(CELEBRITY_USER_IDS_KEY, self.dongxie.id)
+
+        # celebrity 的 tweets 没有 fanout 到 newsfeeds 里，和 linghu 自己的 newsfeeds 交替出现
+        tweet_ids = []
+        for i in range(list_limit + page_size * 2):
+            if i % 3 == 0:
+                tweet = self.create_tweet(self.dongxie, 'celebrity{}'.format(i))
+            else:
+                tweet = self.create_tweet(self.linghu, 'feed{}'.format(i))
+                self.create_newsfeed(self.linghu, tweet)
+            tweet_ids.append(tweet.id)
+
+        # 超出 cache 的部分从数据库里读取的时候，celebrity 的 tweets 仍然会合并进来
+        results = self._paginate_to_get_newsfeeds(self.linghu_client, use_cursor=True)
+        self.assertEqual([result['tweet']['id'] for result in results], tweet_ids[::-1])
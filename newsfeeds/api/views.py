@@ -5,11 +5,16 @@ from rest_framework.response import Response
 from gatekeeper.models import GateKeeper
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
 from newsfeeds.api.serializers import NewsFeedSerializer
-from utils.paginations import EndlessPagination
+from utils.paginations import (
+    CURSOR_SOURCE_HBASE,
+    CURSOR_SOURCE_MYSQL,
+    EndlessPagination,
+)
 from newsfeeds.services import NewsFeedService
 from ratelimit.decorators import ratelimit
 from django.utils.decorators import method_decorator
 from gatekeeper.models import GateKeeper
+from functools import partial
 
 
 
@@ -22,18 +27,39 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
 
     @method_decorator(ratelimit(key='user', rate='5/s', method='GET', block=True))
     def list(self, request):
-        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
+        # 如果打开了 celebrity 的 pull 模式，这里会把关注的 celebrities 的 tweets 合并进来
+        # 超出 cache 的部分从数据库里读取，同样需要合并 celebrities 的 tweets
+        page = self.paginator.paginate_cached_range(
+            partial(NewsFeedService.get_cached_newsfeeds_in_range, request.user.id),
+            request,
+        )
         if page is None:
-            if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            celebrity_ids = NewsFeedService.get_pulled_celebrity_ids(request.user.id)
+            is_hbase = GateKeeper.is_switch_on('switch_newsfeed_to_hbase')
+            if celebrity_ids:
+                page = self.paginator.paginate_merged_range(
+                    partial(
+                        NewsFeedService.get_newsfeeds_with_celebrities_from_db,
+                        request.user.id,
+                        celebrity_ids,
+                    ),
+                    request,
+                    CURSOR_SOURCE_HBASE if is_hbase else CURSOR_SOURCE_MYSQL,
+                )
+            elif is_hbase:
                 page = self.paginator.paginate_hbase(HBaseNewsFeed, (request.user.id,), request)
             else:
                 queryset = NewsFeed.objects.filter(user=request.user)
                 page = self.paginate_queryset(queryset)
         
+        # 整页一次性预取 tweets / users / profiles / counts / has_liked
+        # 避免每个 newsfeed 单独访问 cache 和数据库
         serializer = NewsFeedSerializer(
             page,
-            context={'request': request},
+            context={
+                'request': request,
+                'hydrated': NewsFeedService.hydrate_newsfeeds(page, request.user),
+            },
             many=True,
         )
         return self.get_paginated_response(serializer.data)
\ No newline at end of file
@@ -1,3 +1,7 @@
 from django.conf import settings
 
-FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
\ No newline at end of file
+FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+
+# 粉丝数达到这个数量的用户发 tweet 的时候不再 fanout 到每个粉丝的 newsfeeds 里
+# 而是由粉丝读取 newsfeeds 的时候从他们的 user_tweets cache 里拉取（需要打开 gatekeeper 开关）
+CELEBRITY_FOLLOWERS_THRESHOLD = 100000 if not settings.TESTING else 5
@@ -1,15 +1,27 @@
+from django.conf import settings
+from django.db.models import Q
+from friendships.services import FriendshipService
+from newsfeeds.constants import CELEBRITY_FOLLOWERS_THRESHOLD
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from twitter.cache import USER_NEWSFEEDS_PATTERN, CELEBRITY_USER_IDS_KEY
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
 from newsfeeds.tasks import fanout_newsfeeds_main_task
 from gatekeeper.models import GateKeeper
 from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
+from utils.memcached_helper import MemcachedHelper
+from tweets.models import Tweet
+from tweets.services import TweetService
+from utils.time_helpers import from_timestamp, get_ordering_key
+
+import heapq
+
 
 def lazy_load_newsfeeds(user_id):
     def _lazy_load(limit):
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
             return HBaseNewsFeed.filter(prefix=(user_id, None), limit=limit, reverse=True)
-        return NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')[:limit]
+        return NewsFeed.objects.filter(user_id=user_id).order_by('-created_at', '-id')[:limit]
     return _lazy_load
 
 class NewsFeedService(object):
@@ -68,6 +80,263 @@ class NewsFeedService(object):
             NewsFeed.objects.bulk_create(newsfeeds)
 
         # bulk_create和batch_create都不会触发 post_save 的 signal，所以需要手动 push 到 cache 里
-        for newsfeed in newsfeeds:
-            NewsFeedService.push_newsfeed_to_cache(newsfeed)
-        return newsfeeds
\ No newline at end of file
+        cls.batch_push_newsfeeds_to_cache(newsfeeds)
+        return newsfeeds
+
+    @classmethod
+    def batch_push_newsfeeds_to_cache(cls, newsfeeds):
+        """
+        一次 redis 调用把一批 newsfeeds push 到各自 user 的 cache 里
+        和 push_newsfeed_to_cache 不同，不在 cache 里的 key 直接跳过而不是从数据库 load
+        因为 fanout 的时候大部分 follower 并不活跃，下次读取的时候自然会 load 完整的 list
+        返回被跳过的 keys
+        """
+        keys = [
+            USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
+            for newsfeed in newsfeeds
+        ]
+        return RedisHelper.batch_push_objects(keys, newsfeeds)
+
+    @classmethod
+    def hydrate_newsfeeds(cls, newsfeeds, user):
+        """
+        批量取出一页 newsfeeds 对应的 tweets 以及渲染 tweets 需要的数据
+        结果作为 NewsFeedSerializer 的 context['hydrated'] 使用
+        """
+        tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+        )
+        hydrated = TweetService.hydrate_tweets(tweets.values(), user)
+        hydrated['tweets'] = tweets
+        return hydrated
+
+    @classmethod
+    def mark_celebrity_if_needed(cls, user_id):
+        """
+        粉丝数达到 CELEBRITY_FOLLOWERS_THRESHOLD 的用户加入 celebrity set，返回是否是 celebrity
+        已经在 set 里的用户不需要再读取粉丝数
+        不会把用户从 set 里移除，因为 pull 模式下发的 tweets 并没有 fanout 到粉丝的 newsfeeds 里
+        移除之后粉丝就看不到这些 tweets 了
+        """
+        conn = RedisClient.get_connection()
+        if conn.sismember(CELEBRITY_USER_IDS_KEY, user_id):
+            return True
+        followers_count = FriendshipService.get_follower_count(
+            user_id,
+            limit=CELEBRITY_FOLLOWERS_THRESHOLD,
+        )
+        if followers_count < CELEBRITY_FOLLOWERS_THRESHOLD:
+            return False
+        conn.sadd(CELEBRITY_USER_IDS_KEY, user_id)
+        return True
+
+    @classmethod
+    def get_followed_celebrity_ids(cls, user_id):
+        # following set 和 celebrity set 都在 redis 里，直接求交集
+        return sorted(FriendshipService.get_followed_ids_in_set(user_id, CELEBRITY_USER_IDS_KEY))
+
+    @classmethod
+    def merge_newsfeed_lists(cls, newsfeed_lists):
+        """
+        把若干个按 (created_at, id) 倒序排列的 newsfeed lists 做 k-way merge，按 tweet_id 去重
+        返回 (merged, is_complete)
+        cache 里的 list 如果达到了长度上限，说明更早的数据可能只在数据库里，所以 merge 的结果
+        只保留到这些 list 里最晚的那个结尾为止，此时 is_complete 为 False
+        merge 的结果最多保留 REDIS_LIST_LENGTH_LIMIT 个，和单个 cached list 的长度一样
+        """
+        horizons = [
+            newsfeeds[-1].created_at
+            for newsfeeds in newsfeed_lists
+            if len(newsfeeds) >= settings.REDIS_LIST_LENGTH_LIMIT
+        ]
+        horizon = max(horizons) if horizons else None
+
+        merged, tweet_ids = [], set()
+        # created_at 相同的时候也要按 tie breaker 排序，和翻页时 cursor 的比较方式一致
+        for newsfeed in heapq.merge(*newsfeed_lists, key=get_ordering_key, reverse=True):
+            if horizon is not None and newsfeed.created_at < horizon:
+                break
+            if len(merged) >= settings.REDIS_LIST_LENGTH_LIMIT:
+                return merged, False
+            # 成为 celebrity 之前发的 tweets 已经 fanout 过了，会同时出现在两个 list 里
+            if newsfeed.tweet_id in tweet_ids:
+                continue
+            tweet_ids.add(newsfeed.tweet_id)
+            merged.append(newsfeed)
+        return merged, horizon is None
+
+    @classmethod
+    def get_pulled_celebrity_ids(cls, user_id):
+        # pull 模式没有打开的时候不需要 merge 任何 celebrity 的 tweets
+        if not GateKeeper.is_switch_on('switch_newsfeed_pull_for_celebrities'):
+            return []
+        return cls.get_followed_celebrity_ids(user_id)
+
+    @classmethod
+    def _tweets_to_newsfeeds(cls, user_id, tweets):
+        # celebrities 的 tweets 没有 fanout 到 newsfeeds 里，临时创建没有保存的 newsfeeds 用于渲染
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            return [
+                HBaseNewsFeed(user_id=user_id, created_at=tweet.timestamp, tweet_id=tweet.id)
+                for tweet in tweets
+            ]
+        return [
+            NewsFeed(user_id=user_id, created_at=tweet.created_at, tweet_id=tweet.id)
+            for tweet in tweets
+        ]
+
+    @classmethod
+    def _merge_celebrity_newsfeeds(cls, user_id, newsfeeds, celebrity_ids):
+        newsfeed_lists = [newsfeeds]
+        for celebrity_id in celebrity_ids:
+            newsfeed_lists.append(
+                cls._tweets_to_newsfeeds(user_id, TweetService.get_cached_tweets(celebrity_id)),
+            )
+        return cls.merge_newsfeed_lists(newsfeed_lists)
+
+    @classmethod
+    def _filter_before_cursor(cls, queryset, max_timestamp, max_tie_breaker_id):
+        # 和 EndlessPagination.paginate_queryset 一样，(created_at, id) < cursor
+        # 临时创建的 newsfeeds 用 tweet_id 作为 tie breaker，所以 tweets 和 newsfeeds 都是比较自己的 id
+        if max_timestamp is None:
+            return queryset
+        created_at = from_timestamp(max_timestamp)
+        condition = Q(created_at__lt=created_at)
+        if max_tie_breaker_id is not None:
+            condition |= Q(created_at=created_at, id__lt=max_tie_breaker_id)
+        return queryset.filter(condition)
+
+    @classmethod
+    def _load_newsfeeds_before(cls, user_id, max_timestamp, max_tie_breaker_id, limit):
+        # user 自己的 newsfeeds 里 cursor 之后最新的 limit 个
+        # hbase 里同一个 user 的 created_at 不会重复，从 cursor 所在的 row key 开始 scan，最多多读到一个
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            if max_timestamp is None:
+                return HBaseNewsFeed.filter(prefix=(user_id, None), limit=limit, reverse=True)
+            return HBaseNewsFeed.filter(
+                start=(user_id, max_timestamp),
+                stop=(user_id, None),
+                limit=limit,
+                reverse=True,
+            )
+        queryset = cls._filter_before_cursor(
+            NewsFeed.objects.filter(user_id=user_id),
+            max_timestamp,
+            max_tie_breaker_id,
+        )
+        return list(queryset.order_by('-created_at', '-id')[:limit])
+
+    @classmethod
+    def _load_celebrity_tweets_before(cls, celebrity_id, max_timestamp, max_tie_breaker_id, limit):
+        # 可以用到 tweets 表上 <user, created_at> 的索引
+        queryset = cls._filter_before_cursor(
+            Tweet.objects.filter(user_id=celebrity_id),
+            max_timestamp,
+            max_tie_breaker_id,
+        )
+        return list(queryset.order_by('-created_at', '-id')[:limit])
+
+    @classmethod
+    def get_newsfeeds_with_celebrities_from_db(
+        cls,
+        user_id,
+        celebrity_ids,
+        max_timestamp=None,
+        max_tie_breaker_id=None,
+        limit=None,
+    ):
+        """
+        超出 cache 的部分从数据库里读取，和 cache 里一样把 celebrities 的 tweets 合并进来
+        否则 pull 模式下没有 fanout 的 tweets 在 cache 之外就再也看不到了
+        每个数据源只读取 cursor 之后的 limit 个，按 (created_at, tie breaker) 倒序 merge 之后按 tweet_id 去重
+        返回 (newsfeeds, has_more)，has_more 表示是否有数据源还有没有读取的 newsfeeds
+        用于 EndlessPagination.paginate_merged_range
+        """
+        # hbase 的 scan 可能多读到 cursor 所在的那一个 newsfeed，所以多读一个
+        fetch_limit = limit + 1
+        newsfeed_lists = [
+            cls._load_newsfeeds_before(user_id, max_timestamp, max_tie_breaker_id, fetch_limit),
+        ]
+        for celebrity_id in celebrity_ids:
+            newsfeed_lists.append(cls._tweets_to_newsfeeds(
+                user_id,
+                cls._load_celebrity_tweets_before(celebrity_id, max_timestamp, max_tie_breaker_id, fetch_limit),
+            ))
+        has_more = any(len(newsfeeds) >= fetch_limit for newsfeeds in newsfeed_lists)
+
+        cursor_key = None
+        if max_timestamp is not None:
+            # 没有 tie breaker 的 cursor（客户端传入的 created_at__lt）只比较 created_at
+            cursor_key = (max_timestamp, max_tie_breaker_id or 0)
+        merged, tweet_ids = [], set()
+        for newsfeed in heapq.merge(*newsfeed_lists, key=get_ordering_key, reverse=True):
+            if cursor_key is not None and get_ordering_key(newsfeed) >= cursor_key:
+                continue
+            if len(merged) >= limit:
+                break
+            # 成为 celebrity 之前发的 tweets 已经 fanout 过了，会同时出现在两个 list 里
+            if newsfeed.tweet_id in tweet_ids:
+                continue
+            tweet_ids.add(newsfeed.tweet_id)
+            merged.append(newsfeed)
+        return merged, has_more
+
+    @classmethod
+    def get_cached_newsfeeds_with_celebrities(cls, user_id):
+        """
+        返回 (newsfeeds, is_complete)
+        pull 模式打开的时候，把 user 自己的 newsfeeds 和 user 关注的 celebrities 的 tweets
+        合并在一起。celebrities 的 tweets 并不存在于 newsfeeds 里，所以这里临时创建
+        没有保存的 newsfeed 对象，只用于渲染。
+        is_complete 为 None 表示没有 merge，由 pagination 根据 list 的长度判断
+        """
+        newsfeeds = cls.get_cached_newsfeeds(user_id)
+        celebrity_ids = cls.get_pulled_celebrity_ids(user_id)
+        if not celebrity_ids:
+            return newsfeeds, None
+        return cls._merge_celebrity_newsfeeds(user_id, newsfeeds, celebrity_ids)
+
+    @classmethod
+    def get_cached_newsfeeds_in_range(
+        cls,
+        user_id,
+        min_timestamp=None,
+        max_timestamp=None,
+        limit=None,
+        max_tie_breaker_id=None,
+    ):
+        """
+        参数和返回值见 RedisHelper.load_objects_in_range，用于 EndlessPagination.paginate_cached_range
+        需要 merge celebrities 的 tweets 的时候仍然要读取完整的 lists，merge 之后再筛选
+        """
+        celebrity_ids = cls.get_pulled_celebrity_ids(user_id)
+        if celebrity_ids:
+            newsfeeds, is_complete = cls._merge_celebrity_newsfeeds(
+                user_id,
+                cls.get_cached_newsfeeds(user_id),
+                celebrity_ids,
+            )
+            newsfeeds = RedisHelper.filter_objects_in_range(
+                newsfeeds,
+                min_timestamp,
+                max_timestamp,
+                limit,
+                max_tie_breaker_id,
+            )
+            return newsfeeds, is_complete
+
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            serializer = HBaseModelSerializer
+        else:
+            serializer = DjangoModelSerializer
+        return RedisHelper.load_objects_in_range(
+            key,
+            lazy_load_newsfeeds(user_id),
+            min_timestamp=min_timestamp,
+            max_timestamp=max_timestamp,
+            limit=limit,
+            max_tie_breaker_id=max_tie_breaker_id,
+            serializer=serializer,
+        )
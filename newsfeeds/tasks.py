@@ -1,11 +1,13 @@
 from celery import shared_task
 from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
 from utils.time_constants import ONE_HOUR
 from newsfeeds.constants import FANOUT_BATCH_SIZE
 
+import time
 
-@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
-def fanout_newsfeeds_batch_task(tweet_id, created_at, follower_ids):
+
+def _create_newsfeeds_for_followers(tweet_id, created_at, follower_ids):
     # import 写在里面避免循环依赖
     from newsfeeds.services import NewsFeedService
 
@@ -21,9 +23,28 @@ def fanout_newsfeeds_batch_task(tweet_id, created_at, follower_ids):
         {'user_id': follower_id, 'created_at': created_at, 'tweet_id': tweet_id}
         for follower_id in follower_ids
     ]
+    start_time = time.time()
     newsfeeds = NewsFeedService.batch_create(batch_params)
-    
-    return "{} newsfeeds created".format(len(newsfeeds))
+    # 记录每个 batch 的耗时，用于根据实际数据调整 FANOUT_BATCH_SIZE
+    duration_ms = (time.time() - start_time) * 1000
+
+    return "{} newsfeeds created in {:.1f}ms".format(len(newsfeeds), duration_ms)
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def fanout_newsfeeds_range_task(tweet_id, created_at, tweet_user_id, start, stop):
+    # task 里只带了 followers 的 cursor 区间 [start, stop)，由 batch worker 自己去读取
+    # 这一段的 follower ids，这样 message queue 里的 message 大小和粉丝数无关
+    follower_ids = FriendshipService.get_follower_ids_in_range(tweet_user_id, start, stop)
+    return _create_newsfeeds_for_followers(tweet_id, created_at, follower_ids)
+
+
+# 旧版本的 batch task，参数里直接带 follower ids，新代码不再创建这个 task
+# 上线前已经进入 message queue 的 task 仍然是这个名字，worker 上必须有对应的 task 才能消费
+# 否则这些 followers 就收不到 newsfeeds 了
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def fanout_newsfeeds_batch_task(tweet_id, created_at, follower_ids):
+    return _create_newsfeeds_for_followers(tweet_id, created_at, follower_ids)
 
 
 @shared_task(routing_key='default', time_limit=ONE_HOUR)
@@ -37,17 +58,23 @@ def fanout_newsfeeds_main_task(tweet_id, created_at, tweet_user_id):
         created_at=created_at,
     )
 
-    # 获得所有的 follower ids，按照 batch size 拆分开
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index: index + FANOUT_BATCH_SIZE]
-        fanout_newsfeeds_batch_task.delay(tweet_id, created_at, batch_ids)
-        index += FANOUT_BATCH_SIZE
+    # 粉丝很多的用户不做 fanout，由粉丝读取 newsfeeds 的时候从 user_tweets cache 里拉取
+    if GateKeeper.is_switch_on('switch_newsfeed_pull_for_celebrities'):
+        if NewsFeedService.mark_celebrity_if_needed(tweet_user_id):
+            return 'user {} is a celebrity, fanout skipped.'.format(tweet_user_id)
+
+    # 流式地按 cursor 把 followers 切成若干段，每一段创建一个 batch task
+    # main task 不需要把 follower ids 放在内存里，也不需要把它们放到 task 的参数里
+    followers_count, batches_count = 0, 0
+    ranges = FriendshipService.iter_follower_ranges(tweet_user_id, FANOUT_BATCH_SIZE)
+    for start, stop, count in ranges:
+        fanout_newsfeeds_range_task.delay(tweet_id, created_at, tweet_user_id, start, stop)
+        followers_count += count
+        batches_count += 1
 
     return '{} newsfeeds going to fanout, {} batches created.'.format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
+        followers_count,
+        batches_count,
     )
 
 
@@ -2,9 +2,11 @@ from newsfeeds.services import NewsFeedService
 from testing.testcases import TestCase
 from twitter.cache import USER_NEWSFEEDS_PATTERN
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
 from newsfeeds.tasks import fanout_newsfeeds_main_task
 from gatekeeper.models import GateKeeper
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
+from newsfeeds.constants import CELEBRITY_FOLLOWERS_THRESHOLD
 
 
 class NewsFeedServiceTests(TestCase):
@@ -45,7 +47,8 @@ class NewsFeedServiceTests(TestCase):
         self.clear_cache()
         conn = RedisClient.get_connection()
 
-        key = USER_NEWSFEEDS_PATTERN.format(user_id=self.linghu.id)
+        # cache 只存在 sorted set 里
+        key = RedisHelper.get_zset_key(USER_NEWSFEEDS_PATTERN.format(user_id=self.linghu.id))
         self.assertEqual(conn.exists(key), False)
         #in this step will call post_save() signal and push new newsfeed to cache, cache updated including 1 and 2
         feed2 = self.create_newsfeed(self.linghu, self.create_tweet(self.linghu))
@@ -54,7 +57,86 @@ class NewsFeedServiceTests(TestCase):
         feeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
         self.assertEqual([f.created_at for f in feeds], [feed2.created_at, feed1.created_at])
 
-    
+    def test_batch_create_skips_cold_cache(self):
+        self.create_newsfeed(self.linghu, self.create_tweet(self.dongxie))
+        conn = RedisClient.get_connection()
+        linghu_key = RedisHelper.get_zset_key(USER_NEWSFEEDS_PATTERN.format(user_id=self.linghu.id))
+        dongxie_key = RedisHelper.get_zset_key(USER_NEWSFEEDS_PATTERN.format(user_id=self.dongxie.id))
+        self.assertEqual(conn.exists(linghu_key), True)
+        self.assertEqual(conn.exists(dongxie_key), False)
+
+        tweet = self.create_tweet(self.dongxie)
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            created_at = tweet.timestamp
+        else:
+            created_at = tweet.created_at
+        NewsFeedService.batch_create([
+            {'user_id': self.linghu.id, 'created_at': created_at, 'tweet_id': tweet.id},
+            {'user_id': self.dongxie.id, 'created_at': created_at, 'tweet_id': tweet.id},
+        ])
+        # cold key is not loaded from db during fanout
+        self.assertEqual(conn.exists(dongxie_key), False)
+
+        feeds = NewsFeedService.get_cached_newsfeeds(self.linghu.id)
+        self.assertEqual(len(feeds), 2)
+        self.assertEqual(feeds[0].tweet_id, tweet.id)
+        feeds = NewsFeedService.get_cached_newsfeeds(self.dongxie.id)
+        self.assertEqual([f.tweet_id for f in feeds], [tweet.id])
+
+    def test_celebrity_pull_mode(self):
+        GateKeeper.turn_on('switch_newsfeed_pull_for_celebrities')
+        for i in range(CELEBRITY_FOLLOWERS_THRESHOLD - 1):
+            self.create_friendship(self.create_user('user{}'.format(i)), self.dongxie)
+        self.create_friendship(self.linghu, self.dongxie)
+
+        def fanout(tweet):
+            if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+                return fanout_newsfeeds_main_task(tweet.id, tweet.timestamp, self.dongxie.id)
+            return fanout_newsfeeds_main_task(tweet.id, tweet.created_at, self.dongxie.id)
+
+        # 第一次 fanout 的时候已经达到阈值，之后不再 fanout
+        tweet1 = self.create_tweet(self.dongxie)
+        msg = fanout(tweet1)
+        self.assertEqual(msg, 'user {} is a celebrity, fanout skipped.'.format(self.dongxie.id))
+        self.assertEqual(NewsFeedService.get_followed_celebrity_ids(self.linghu.id), [self.dongxie.id])
+
+        # 成为 celebrity 之前已经 fanout 过的 tweet 不会重复出现
+        tweet0 = self.create_tweet(self.dongxie)
+        self.create_newsfeed(self.linghu, tweet0)
+        tweet2 = self.create_tweet(self.linghu)
+        self.create_newsfeed(self.linghu, tweet2)
+        tweet3 = self.create_tweet(self.dongxie)
+        fanout(tweet3)
+
+        self.assertEqual(len(NewsFeedService.get_cached_newsfeeds(self.linghu.id)), 2)
+        newsfeeds, is_complete = NewsFeedService.get_cached_newsfeeds_with_celebrities(self.linghu.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet3.id, tweet2.id, tweet0.id, tweet1.id])
+        self.assertEqual(is_complete, True)
+
+        # 没有关注 celebrity 的用户不受影响
+        newsfeeds, is_complete = NewsFeedService.get_cached_newsfeeds_with_celebrities(self.dongxie.id)
+        self.assertEqual(is_complete, None)
+
+        GateKeeper.set_kv('switch_newsfeed_pull_for_celebrities', 'percent', 0)
+        newsfeeds, is_complete = NewsFeedService.get_cached_newsfeeds_with_celebrities(self.linghu.id)
+        self.assertEqual(len(newsfeeds), 2)
+        self.assertEqual(is_complete, None)
+
+    def test_merge_newsfeed_lists_with_same_created_at(self):
+        # 所有 newsfeeds 的 created_at 都相同，merge 之后按 tweet_id 倒序排列，和翻页时 cursor 的顺序一致
+        newsfeed_lists = [
+            [HBaseNewsFeed(user_id=1, created_at=100, tweet_id=tweet_id) for tweet_id in [6, 3]],
+            [HBaseNewsFeed(user_id=1, created_at=100, tweet_id=tweet_id) for tweet_id in [5, 4, 1]],
+        ]
+        merged, is_complete = NewsFeedService.merge_newsfeed_lists(newsfeed_lists)
+        self.assertEqual([newsfeed.tweet_id for newsfeed in merged], [6, 5, 4, 3, 1])
+        self.assertEqual(is_complete, True)
+
+        # 临时创建的 newsfeeds 用 tweet_id 作为 tie breaker，翻页的时候不会丢失或者重复
+        newsfeeds = RedisHelper.filter_objects_in_range(merged, max_timestamp=100, max_tie_breaker_id=4)
+        self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [3, 1])
+
+
 class NewsFeedTaskTests(TestCase):
 
     def setUp(self):
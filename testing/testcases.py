@@ -6,6 +6,7 @@ from likes.models import Like
 from rest_framework.test import APIClient
 from tweets.models import Tweet
 from django.core.cache import caches
+from django.db import connection
 from utils.redis_client import RedisClient
 from friendships.models import Friendship
 from django_hbase.models import HBaseModel
@@ -36,8 +37,19 @@ class TestCase(DjangoTestCase):
     def clear_cache(self):
         caches['testing'].clear()
         RedisClient.clear()
+        # flushdb 不会通知 gatekeeper，需要手动丢掉本进程的 gatekeeper 缓存
+        GateKeeper.invalidate_local_cache()
         GateKeeper.turn_on('switch_newsfeed_to_hbase')
         GateKeeper.turn_on('switch_friendship_to_hbase')
+        GateKeeper.turn_on('switch_friendship_counts_reconciled')
+
+    def run_on_commit_callbacks(self):
+        # TestCase 里的每个 test 都在一个不会 commit 的 transaction 里执行
+        # transaction.on_commit 注册的 callbacks 不会被调用，这里手动执行
+        callbacks = connection.run_on_commit
+        connection.run_on_commit = []
+        for _, callback in callbacks:
+            callback()
 
     
     @property
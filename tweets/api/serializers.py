@@ -11,7 +11,7 @@ from utils.redis_helper import RedisHelper
 
 
 class TweetSerializer(serializers.ModelSerializer):
-    user = UserSerializerForTweet(source='cached_user') 
+    user = serializers.SerializerMethodField()
     comments_count = serializers.SerializerMethodField()
     likes_count = serializers.SerializerMethodField()
     has_liked = serializers.SerializerMethodField()
@@ -30,41 +30,104 @@ class TweetSerializer(serializers.ModelSerializer):
             'photo_urls',
         )
 
+    def _get_hydrated(self, name, key, load):
+        # 列表类的 API 会通过 TweetService.hydrate_tweets 把整页数据预先取好放在 context 里
+        # 没有预取的情况（比如 retrieve / create）下退回到单个 object 的读取方式
+        hydrated = self.context.get('hydrated')
+        if hydrated is not None and key in hydrated[name]:
+            return hydrated[name][key]
+        return load()
+
+    def get_user(self, obj):
+        user = self._get_hydrated('users', obj.user_id, lambda: obj.cached_user)
+        return UserSerializerForTweet(user).data
+
     def get_likes_count(self, obj):
-        return RedisHelper.get_count(obj, 'likes_count')
+        return self._get_hydrated(
+            'likes_count',
+            obj.id,
+            lambda: RedisHelper.get_count(obj, 'likes_count'),
+        )
 
     def get_comments_count(self, obj):
-        return RedisHelper.get_count(obj, 'comments_count')
+        return self._get_hydrated(
+            'comments_count',
+            obj.id,
+            lambda: RedisHelper.get_count(obj, 'comments_count'),
+        )
 
     def get_has_liked(self, obj):
-        return LikeService.has_liked(self.context['request'].user, obj)
+        return self._get_hydrated(
+            'has_liked',
+            obj.id,
+            lambda: LikeService.has_liked(self.context['request'].user, obj),
+        )
     
     def get_photo_urls(self, obj):
-        photo_urls = []
-        for photo in obj.tweetphoto_set.all().order_by('order'):
-            photo_urls.append(photo.file.url)
-        return photo_urls
+        return self._get_hydrated('photo_urls', obj.id, lambda: [
+            photo.file.url
+            for photo in obj.tweetphoto_set.all().order_by('order')
+        ])
 
 class TweetSerializerForDetail(TweetSerializer):
-    comments = CommentSerializer(source='comment_set', many=True)
-    likes = LikeSerializer(source='like_set', many=True)
+    comments = serializers.SerializerMethodField()
+    comments_next_cursor = serializers.SerializerMethodField()
+    likes = serializers.SerializerMethodField()
+    likes_next_cursor = serializers.SerializerMethodField()
 
     class Meta:
         model = Tweet
         fields = (
             'id',
             'user',
-            'comments',
             'created_at',
             'content',
-            'likes',
             'comments',
+            'comments_next_cursor',
+            'likes',
+            'likes_next_cursor',
             'likes_count',
             'comments_count',
             'has_liked',
             'photo_urls',
         )
 
+    def _get_preview(self, obj):
+        # 见 TweetService.get_detail_preview，context['previews'] 按 tweet id 保存
+        # view 里没有预先取好的时候在这里读取一次，many=True 的时候每个 tweet 各自读取
+        previews = self.context.setdefault('previews', {})
+        if obj.id not in previews:
+            previews[obj.id] = TweetService.get_detail_preview(
+                obj,
+                self.context['request'].user,
+            )
+        return previews[obj.id]
+
+    def get_comments(self, obj):
+        preview = self._get_preview(obj)
+        return CommentSerializer(
+            preview['comments'],
+            context={
+                'request': self.context['request'],
+                'hydrated': preview['comments_hydrated'],
+            },
+            many=True,
+        ).data
+
+    def get_comments_next_cursor(self, obj):
+        return self._get_preview(obj)['comments_next_cursor']
+
+    def get_likes(self, obj):
+        preview = self._get_preview(obj)
+        return LikeSerializer(
+            preview['likes'],
+            context={'hydrated': preview['likes_hydrated']},
+            many=True,
+        ).data
+
+    def get_likes_next_cursor(self, obj):
+        return self._get_preview(obj)['likes_next_cursor']
+
 
 class TweetSerializerForCreate(serializers.ModelSerializer):
     content = serializers.CharField(min_length=6, max_length=140)
@@ -1,8 +1,11 @@
-from rest_framework.test import APIClient
+from rest_framework.test import APIClient, APIRequestFactory
 from testing.testcases import TestCase
 from tweets.models import Tweet
+from tweets.api.serializers import TweetSerializerForDetail
+from django.contrib.auth.models import AnonymousUser
 from django.core.files.uploadedfile import SimpleUploadedFile
 from tweets.models import Tweet, TweetPhoto
+from tweets.constants import TWEET_DETAIL_PREVIEW_SIZE
 from utils.paginations import EndlessPagination
 
 
@@ -10,6 +13,8 @@ from utils.paginations import EndlessPagination
 TWEET_LIST_API = '/api/tweets/'
 TWEET_CREATE_API = '/api/tweets/'
 TWEET_RETRIEVE_API = '/api/tweets/{}/'
+TWEET_LIKES_API = '/api/tweets/{}/likes/'
+COMMENT_LIST_API = '/api/comments/'
 
 
 class TweetApiTests(TestCase):
@@ -161,6 +166,70 @@ class TweetApiTests(TestCase):
             response = self.anonymous_client.get(url)
             self.assertEqual(len(response.data['comments']), 2)
             
+    def test_retrieve_preview(self):
+        preview_size = TWEET_DETAIL_PREVIEW_SIZE
+        tweet = self.create_tweet(self.user1)
+        comments = [
+            self.create_comment(self.user2, tweet, 'comment{}'.format(i))
+            for i in range(preview_size + 2)
+        ]
+        likers = [
+            self.create_user('liker{}'.format(i))
+            for i in range(preview_size + 2)
+        ]
+        for liker in likers:
+            self.create_like(liker, tweet)
+
+        # 详情页只包含最新的 comments 和 likes
+        url = TWEET_RETRIEVE_API.format(tweet.id)
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [comment['id'] for comment in response.data['comments']],
+            [comment.id for comment in comments[2:]],
+        )
+        self.assertEqual(
+            [like['user']['id'] for like in response.data['likes']],
+            [liker.id for liker in likers[:1:-1]],
+        )
+
+        # 用 next_cursor 翻页拿到剩下的 comments 和 likes
+        comments_response = self.anonymous_client.get(COMMENT_LIST_API, {
+            'tweet_id': tweet.id,
+            'cursor': response.data['comments_next_cursor'],
+        })
+        self.assertEqual(comments_response.data['has_next_page'], False)
+        self.assertEqual(
+            [comment['id'] for comment in comments_response.data['comments']],
+            [comment.id for comment in comments[:2]],
+        )
+        likes_response = self.anonymous_client.get(TWEET_LIKES_API.format(tweet.id), {
+            'cursor': response.data['likes_next_cursor'],
+        })
+        self.assertEqual(likes_response.data['has_next_page'], False)
+        self.assertEqual(
+            [like['user']['id'] for like in likes_response.data['results']],
+            [likers[1].id, likers[0].id],
+        )
+
+        # 取消 like 之后详情页里不再包含
+        likers[-1].like_set.all().delete()
+        likers[0].like_set.all().delete()
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.data['likes'][0]['user']['id'], likers[-2].id)
+        self.assertEqual(response.data['likes_next_cursor'], None)
+
+    def test_detail_serializer_with_many_tweets(self):
+        tweets = [self.create_tweet(self.user1) for _ in range(2)]
+        comment = self.create_comment(self.user2, tweets[1])
+        request = APIRequestFactory().get(TWEET_LIST_API)
+        request.user = AnonymousUser()
+
+        # 每个 tweet 使用自己的 preview，不会用到第一个 tweet 的
+        data = TweetSerializerForDetail(tweets, context={'request': request}, many=True).data
+        self.assertEqual(data[0]['comments'], [])
+        self.assertEqual([c['id'] for c in data[1]['comments']], [comment.id])
+
     def test_pagination(self):
         page_size = EndlessPagination.page_size
 
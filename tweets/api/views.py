@@ -1,4 +1,5 @@
 from rest_framework import viewsets
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from tweets.api.serializers import (
@@ -7,12 +8,17 @@ from tweets.api.serializers import (
     TweetSerializerForDetail,
 )
 from tweets.models import Tweet
+from likes.api.serializers import LikeSerializer
+from likes.models import Like
+from likes.services import LikeService
+from django.contrib.contenttypes.models import ContentType
 from newsfeeds.services import NewsFeedService
 from utils.decorators import required_params
 from utils.paginations import EndlessPagination
 from tweets.services import TweetService
 from ratelimit.decorators import ratelimit
 from django.utils.decorators import method_decorator
+from functools import partial
 
 
 class TweetViewSet(viewsets.GenericViewSet):
@@ -24,7 +30,7 @@ class TweetViewSet(viewsets.GenericViewSet):
     pagination_class = EndlessPagination
 
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'likes']:
             return [AllowAny()]
         return [IsAuthenticated()]
     
@@ -45,8 +51,11 @@ class TweetViewSet(viewsets.GenericViewSet):
         # tweets = self.paginate_queryset(tweets)
         user_id = request.query_params['user_id']
         #tweets = Tweet.objects.filter(user_id=user_id).prefetch_related('user')
-        cached_tweets = TweetService.get_cached_tweets(user_id)
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
+        # 只从 cache 里读取需要的那一页，不需要反序列化整个 list
+        page = self.paginator.paginate_cached_range(
+            partial(TweetService.get_cached_tweets_in_range, user_id),
+            request,
+        )
         if page is None:
             # 这句查询会被翻译为
             # select * from twitter_tweets
@@ -59,7 +68,10 @@ class TweetViewSet(viewsets.GenericViewSet):
 
         serializer = TweetSerializer(
             page, 
-            context={'request':request}, 
+            context={
+                'request': request,
+                'hydrated': TweetService.hydrate_tweets(page, request.user),
+            },
             many=True
         )
         # 一般来说 json 格式的 response 默认都要用 hash 的格式
@@ -69,12 +81,42 @@ class TweetViewSet(viewsets.GenericViewSet):
     @method_decorator(ratelimit(key='user_or_ip', rate='5/s', method='GET', block=True))
     def retrieve(self, request, *args, **kwargs):
         tweet = self.get_object()
+        # comments 和 likes 只返回最新的一小部分，都从 redis 里读取，见 TweetService.get_detail_preview
         serializer = TweetSerializerForDetail(
             tweet,
-            context={'request': request},
+            context={
+                'request': request,
+                'previews': {tweet.id: TweetService.get_detail_preview(tweet, request.user)},
+            },
         )
         return Response(serializer.data)
         
+    @action(methods=['GET'], detail=True)
+    @method_decorator(ratelimit(key='user_or_ip', rate='5/s', method='GET', block=True))
+    def likes(self, request, *args, **kwargs):
+        """
+        详情页里只有最新的几个 likes，用返回的 likes_next_cursor 在这里继续往下翻页
+        """
+        tweet_id = self.get_object().id
+        page = self.paginator.paginate_cached_range(
+            partial(LikeService.get_cached_tweet_likes_in_range, tweet_id),
+            request,
+        )
+        if page is None:
+            # 可以用到 <content_type, object_id, created_at> 的索引
+            queryset = Like.objects.filter(
+                content_type=ContentType.objects.get_for_model(Tweet),
+                object_id=tweet_id,
+            )
+            page = self.paginate_queryset(queryset)
+
+        serializer = LikeSerializer(
+            page,
+            context={'hydrated': LikeService.hydrate_likes(page)},
+            many=True,
+        )
+        return self.get_paginated_response(serializer.data)
+
     @method_decorator(ratelimit(key='user', rate='1/s', method='POST', block=True))
     @method_decorator(ratelimit(key='user', rate='5/m', method='POST', block=True))
     def create(self, request, *args, **kwargs):
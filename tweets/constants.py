@@ -11,4 +11,7 @@ TWEET_PHOTO_STATUS_CHOICES = (
 )
 
 
-TWEET_PHOTOS_UPLOAD_LIMIT = 9
\ No newline at end of file
+TWEET_PHOTOS_UPLOAD_LIMIT = 9
+
+# tweet 详情页里最多展示的 comments 和 likes 的数量，更多的通过 comments / likes 的 list API 翻页
+TWEET_DETAIL_PREVIEW_SIZE = 10
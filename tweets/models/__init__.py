@@ -1,2 +1,3 @@
 from .tweet import Tweet
-from .tweet_photo import TweetPhoto
\ No newline at end of file
+from .tweet_photo import TweetPhoto
+from .count_flush_batch import CountFlushBatch
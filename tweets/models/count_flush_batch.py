@@ -0,0 +1,12 @@
+from django.db import models
+
+
+class CountFlushBatch(models.Model):
+    # RedisHelper.flush_dirty_counts 写回数据库的每一批增量的 token
+    # 和这一批的 UPDATE 在同一个 transaction 里写入，重试的时候看到 token 已经存在就不会再写一次
+    # redis 里的这一批增量清理掉之后删除，表里只会留下很少的 rows
+    token = models.CharField(max_length=32, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return 'count flush batch {}'.format(self.token)
@@ -1,6 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
-from utils.time_helpers import utc_now
+from utils.time_helpers import utc_now, to_timestamp
 from likes.models import Like
 from django.contrib.contenttypes.models import ContentType
 from utils.memcached_helper import MemcachedHelper
@@ -54,7 +54,7 @@ class Tweet(models.Model):
 
     @property
     def timestamp(self):
-        return int(self.created_at.timestamp() * 1000000)
+        return to_timestamp(self.created_at)
 
 post_save.connect(invalidate_object_cache, sender=Tweet)
 pre_delete.connect(invalidate_object_cache, sender=Tweet)
@@ -2,11 +2,18 @@ from tweets.models import TweetPhoto
 from twitter.cache import USER_TWEETS_PATTERN
 from utils.redis_helper import RedisHelper
 from tweets.models import Tweet
+from tweets.constants import TWEET_DETAIL_PREVIEW_SIZE
+from accounts.services import UserService
+from comments.services import CommentService
+from likes.services import LikeService
+from utils.paginations import EndlessPagination
+from functools import partial
 
 
 def lazy_load_tweets(user_id):
     def _lazy_load(limit):
-        return Tweet.objects.filter(user_id=user_id).order_by('-created_at')[:limit]
+        # created_at 相同的时候按 id 倒序，和 EndlessPagination 的 cursor 的顺序一致
+        return Tweet.objects.filter(user_id=user_id).order_by('-created_at', '-id')[:limit]
     return _lazy_load
 
 class TweetService(object):
@@ -29,7 +36,67 @@ class TweetService(object):
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
         return RedisHelper.load_objects(key, lazy_load_tweets(user_id))
 
+    @classmethod
+    def get_cached_tweets_in_range(cls, user_id, **kwargs):
+        # 参数见 RedisHelper.load_objects_in_range，用于 EndlessPagination.paginate_cached_range
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        return RedisHelper.load_objects_in_range(key, lazy_load_tweets(user_id), **kwargs)
+
     @classmethod
     def push_tweet_to_cache(cls, tweet):
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
-        RedisHelper.push_object(key, tweet, lazy_load_tweets(tweet.user_id))
\ No newline at end of file
+        RedisHelper.push_object(key, tweet, lazy_load_tweets(tweet.user_id))
+
+    @classmethod
+    def hydrate_tweets(cls, tweets, user):
+        """
+        把渲染一页 tweets 需要的数据一次性批量取出来，放在 serializer 的 context['hydrated'] 里
+        TweetSerializer 会优先从这里读，避免每个 tweet 都单独访问 memcached / redis / mysql
+        user 是当前发请求的用户，用于计算 has_liked
+        """
+        tweets = [tweet for tweet in tweets if tweet is not None]
+        tweet_ids = [tweet.id for tweet in tweets]
+
+        users = UserService.get_users_through_cache([tweet.user_id for tweet in tweets])
+
+        photo_urls = {tweet_id: [] for tweet_id in tweet_ids}
+        photos = TweetPhoto.objects.filter(tweet_id__in=tweet_ids).order_by('order')
+        for photo in photos:
+            photo_urls[photo.tweet_id].append(photo.file.url)
+
+        counts = RedisHelper.get_counts_multi(tweets, ['likes_count', 'comments_count'])
+        return {
+            'users': users,
+            'likes_count': counts['likes_count'],
+            'comments_count': counts['comments_count'],
+            'has_liked': LikeService.has_liked_many(user, tweets),
+            'photo_urls': photo_urls,
+        }
+
+    @classmethod
+    def get_detail_preview(cls, tweet, user):
+        """
+        tweet 详情页里只展示最新的 TWEET_DETAIL_PREVIEW_SIZE 个 comments 和 likes
+        comments 也取最新的而不是最早的，cache 里只有最新的那些，最早的 comments 需要访问数据库
+        都从 redis 里读取并且批量 hydrate，不管 tweet 有多少 comments / likes，耗时都是固定的
+        更多的 comments / likes 用返回的 next_cursor 通过对应的 list API 继续翻页
+        """
+        comments_paginator = EndlessPagination()
+        comments = comments_paginator.paginate_cached_preview(
+            partial(CommentService.get_cached_comments_in_range, tweet.id),
+            TWEET_DETAIL_PREVIEW_SIZE,
+        )
+        likes_paginator = EndlessPagination()
+        likes = likes_paginator.paginate_cached_preview(
+            partial(LikeService.get_cached_tweet_likes_in_range, tweet.id),
+            TWEET_DETAIL_PREVIEW_SIZE,
+        )
+        return {
+            # 和 comments 的 list API 一致，页内按照时间顺序排列
+            'comments': comments[::-1],
+            'comments_next_cursor': comments_paginator.next_cursor,
+            'comments_hydrated': CommentService.hydrate_comments(comments, user),
+            'likes': likes,
+            'likes_next_cursor': likes_paginator.next_cursor,
+            'likes_hydrated': LikeService.hydrate_likes(likes),
+        }
@@ -0,0 +1,10 @@
+from celery import shared_task
+from django.conf import settings
+from utils.redis_helper import RedisHelper
+
+
+@shared_task(routing_key='default', time_limit=settings.REDIS_COUNTS_FLUSH_LOCK_TIMEOUT)
+def flush_dirty_counts_task():
+    # 由 celery beat 每隔 REDIS_COUNTS_FLUSH_INTERVAL 触发，见 CELERY_BEAT_SCHEDULE
+    flushed = RedisHelper.flush_dirty_counts()
+    return '{} counts flushed'.format(flushed)
@@ -4,6 +4,7 @@ from testing.testcases import TestCase
 from tweets.constants import TweetPhotoStatus
 from tweets.models import TweetPhoto
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
 from utils.redis_serializers import DjangoModelSerializer
 from tweets.services import TweetService
 from twitter.cache import USER_TWEETS_PATTERN
@@ -91,7 +92,8 @@ class TweetServiceTests(TestCase):
         RedisClient.clear()
         conn = RedisClient.get_connection()
 
-        key = USER_TWEETS_PATTERN.format(user_id=self.linghu.id)
+        # cache 只存在 sorted set 里
+        key = RedisHelper.get_zset_key(USER_TWEETS_PATTERN.format(user_id=self.linghu.id))
         self.assertEqual(conn.exists(key), False)
         tweet2 = self.create_tweet(self.linghu, 'tweet2')
         self.assertEqual(conn.exists(key), True)
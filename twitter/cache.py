@@ -1,8 +1,40 @@
 #memcached
-FOLLOWINGS_PATTERN = 'followings:{user_id}'
 USER_PROFILE_PATTERN = 'userprofile:{user_id}'
 
 
 # redis
+# redis set，包含 user 关注的所有人的 id，见 FriendshipService.get_following_user_id_set
+FOLLOWINGS_PATTERN = 'followings:{user_id}'
+# redis set，包含 user like 过的某一种 objects 的 id，model 为 tweet / comment，见 LikeService.has_liked_many
+LIKED_OBJECTS_PATTERN = 'liked_objects:{user_id}:{model}'
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
-USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
\ No newline at end of file
+USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+# redis sorted set，tweet 最新的 comments，修改或者删除 comment 的时候整个删掉，见 CommentService
+TWEET_COMMENTS_PATTERN = 'tweet_comments:{tweet_id}'
+# redis sorted set，tweet 最新的 likes，取消 like 的时候只删掉这一个 like，见 LikeService
+TWEET_LIKES_PATTERN = 'tweet_likes:{tweet_id}'
+# redis hash，记录 RedisHelper 重建 cache 的次数，见 RedisHelper.get_cache_rebuild_metrics
+CACHE_REBUILD_METRICS_KEY = 'cache_rebuild_metrics'
+# redis hash，还没有写回数据库的计数的增量，field 是 model + attr + id，见 RedisHelper.flush_dirty_counts
+# 计数本身的 key 过期或者被删掉都不会丢失这里的增量
+DIRTY_COUNTS_KEY = 'dirty_count_deltas'
+# flush 的时候把 dirty hash RENAME 成这个 key，每一批写回数据库之前移到 FLUSH_BATCH_COUNTS_KEY 里
+FLUSHING_COUNTS_KEY = 'dirty_count_deltas:flushing'
+# redis hash，正在写回数据库的那一批增量，FLUSH_BATCH_TOKEN_KEY 是这一批的 token，见 tweets.models.CountFlushBatch
+FLUSH_BATCH_COUNTS_KEY = 'dirty_count_deltas:batch'
+FLUSH_BATCH_TOKEN_KEY = 'dirty_count_deltas:batch:token'
+# flush 每一批写回数据库之前和清理掉 batch 之后各加一，奇数表示有一批增量正在写回
+# 从数据库 load 计数的前后读到的值不一样，说明读到的增量和数据库里的计数可能重复或者缺少了一批
+DIRTY_COUNTS_VERSION_KEY = 'dirty_count_deltas:version'
+# 粉丝数超过 CELEBRITY_FOLLOWERS_THRESHOLD 的用户，redis set，不设置过期时间
+CELEBRITY_USER_IDS_KEY = 'celebrity_user_ids'
+
+# 使用 CompactModelSerializer 二进制格式写入的 redis sorted set，其余的 key 仍然使用 json 格式
+# 读取的时候会根据数据本身判断格式，所以修改这里不需要清空 cache
+# value 是 sorted set 里可能出现的 models，每个 object 只存 model 在 tuple 里的下标，新的 model 只能加在最后
+COMPACT_SERIALIZED_PATTERNS = {
+    USER_TWEETS_PATTERN: ('tweets.Tweet',),
+    USER_NEWSFEEDS_PATTERN: ('newsfeeds.NewsFeed', 'hbase.HBaseNewsFeed'),
+    TWEET_COMMENTS_PATTERN: ('comments.Comment',),
+    TWEET_LIKES_PATTERN: ('likes.Like',),
+}
@@ -57,6 +57,7 @@ INSTALLED_APPS = [
     'comments',
     'likes',
     'inbox',
+    'gatekeeper',
 ]
 
 #翻页机制
@@ -223,6 +224,28 @@ REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds
 REDIS_LIST_LENGTH_LIMIT = 1000 if not TESTING else 20
+# 每个进程的 redis connection pool 里最多的连接数，用完的时候最多等待 REDIS_POOL_TIMEOUT 秒
+# 注意 gatekeeper 订阅 pub/sub 的后台线程会一直占用一个连接
+REDIS_MAX_CONNECTIONS = 50
+REDIS_POOL_TIMEOUT = 5  # in seconds
+REDIS_SOCKET_TIMEOUT = 5  # in seconds
+REDIS_SOCKET_CONNECT_TIMEOUT = 2  # in seconds
+# 连接空闲超过这个时间之后，再使用之前先 PING 一下，避免用到已经被断开的连接
+REDIS_HEALTH_CHECK_INTERVAL = 30  # in seconds
+# cache miss 的时候只有拿到 lock 的请求去数据库重建 cache，其他请求每隔 POLL_INTERVAL 检查一次
+# 最多等待 WAIT_TIMEOUT，之后自己去数据库读取
+REDIS_REBUILD_LOCK_TIMEOUT = 10  # in seconds
+REDIS_REBUILD_WAIT_TIMEOUT = 2  # in seconds
+REDIS_REBUILD_POLL_INTERVAL = 0.05  # in seconds
+# likes_count / comments_count 只在 redis 里修改，每隔 FLUSH_INTERVAL 批量写回数据库
+# 数据库里的计数最多落后 FLUSH_INTERVAL 加上一次 flush 的耗时，API 读取的都是 redis 里的计数
+REDIS_COUNTS_FLUSH_INTERVAL = 5  # in seconds
+REDIS_COUNTS_FLUSH_BATCH_SIZE = 500
+REDIS_COUNTS_FLUSH_LOCK_TIMEOUT = 60  # in seconds
+# 从数据库 load 计数的时候正好有一批增量在写回，重新读取的次数，还是读不到一致的值就不写入 cache
+REDIS_COUNTS_LOAD_RETRY_TIMES = 3
+# 每个进程在本地缓存所有 gatekeeper 的时间，修改的时候会通过 redis pub/sub 立刻通知所有进程
+GATEKEEPER_LOCAL_CACHE_TTL = 5  # in seconds
 
 # Celery Configuration Options
 # 使用如下命令把 worker 进程（只执行异步任务的进程，可以在不同的机器上）单独跑起来
@@ -234,6 +257,16 @@ CELERY_QUEUES = (
     Queue('default', routing_key='default'),
     Queue('newsfeeds', routing_key='newsfeeds'),
 )
+# 定时任务需要单独跑一个 beat 进程
+#   celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    'flush-dirty-counts': {
+        'task': 'tweets.tasks.flush_dirty_counts_task',
+        'schedule': REDIS_COUNTS_FLUSH_INTERVAL,
+        # worker 忙不过来的时候，过期的任务直接丢掉，下一次 flush 会把它们的计数一起写回
+        'options': {'expires': REDIS_COUNTS_FLUSH_INTERVAL},
+    },
+}
 
 # Rate Limiter
 RATELIMIT_USE_CACHE = 'ratelimit'
@@ -242,6 +275,12 @@ RATELIMIT_ENABLE = not TESTING  # 在某些环境下，比如内部测试等环
 
 # HBase Database
 HBASE_HOST = '127.0.0.1'
+# 每个进程里 hbase connection pool 的大小，一般设置成和 web server 每个进程的线程数一样
+HBASE_POOL_SIZE = 10
+# 从 pool 里拿 connection 最多等待的时间，超时会 raise NoConnectionsAvailable
+HBASE_POOL_TIMEOUT = 5  # in seconds
+# 遇到 TTransportException（比如 thrift server 重启）的时候，幂等的操作最多重试的次数
+HBASE_RETRY_TIMES = 2
 
 try:
     from .local_settings import *
@@ -0,0 +1,153 @@
+"""
+一些不依赖数据库的性能测试，用于比较不同实现的耗时
+在 python manage.py shell 里运行，比如：
+    from utils.benchmarks import benchmark_redis_serializers
+    benchmark_redis_serializers()
+"""
+from utils.time_helpers import utc_now
+
+import time
+
+
+def _timeit_us(func, rounds):
+    # 返回平均每次调用的耗时，单位是 microseconds
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) * 1000000 / rounds
+
+
+def _print_table(headers, rows):
+    widths = [
+        max(len(str(row[i])) for row in [headers] + rows)
+        for i in range(len(headers))
+    ]
+    for row in [headers] + rows:
+        print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+def benchmark_redis_serializers(rounds=10000):
+    """
+    比较 redis list 里缓存 objects 时 json 格式和 compact 格式的大小以及编解码耗时
+    """
+    from newsfeeds.models import NewsFeed, HBaseNewsFeed
+    from tweets.models import Tweet
+    from twitter.cache import (
+        COMPACT_SERIALIZED_PATTERNS,
+        USER_NEWSFEEDS_PATTERN,
+        USER_TWEETS_PATTERN,
+    )
+    from utils.redis_serializers import (
+        CompactModelSerializer,
+        DjangoModelSerializer,
+        HBaseModelSerializer,
+    )
+
+    now = utc_now()
+    timestamp = int(now.timestamp() * 1000000)
+    samples = [
+        ('Tweet', Tweet(
+            id=123456789,
+            user_id=1234567,
+            content='a tweet with some normal length content, ' * 2,
+            created_at=now,
+            likes_count=42,
+            comments_count=7,
+        ), DjangoModelSerializer, USER_TWEETS_PATTERN),
+        ('NewsFeed', NewsFeed(
+            id=123456789,
+            user_id=1234567,
+            tweet_id=7654321,
+            created_at=now,
+        ), DjangoModelSerializer, USER_NEWSFEEDS_PATTERN),
+        ('HBaseNewsFeed', HBaseNewsFeed(
+            user_id=1234567,
+            created_at=timestamp,
+            tweet_id=7654321,
+        ), HBaseModelSerializer, USER_NEWSFEEDS_PATTERN),
+    ]
+
+    rows = []
+    for name, instance, json_serializer, pattern in samples:
+        compact_serializer = CompactModelSerializer(COMPACT_SERIALIZED_PATTERNS[pattern])
+        for serializer_name, serializer in [
+            (json_serializer.__name__, json_serializer),
+            ('CompactModelSerializer', compact_serializer),
+        ]:
+            data = serializer.serialize(instance)
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            rows.append([
+                name,
+                serializer_name,
+                len(data),
+                '{:.2f}'.format(_timeit_us(lambda: serializer.serialize(instance), rounds)),
+                '{:.2f}'.format(_timeit_us(lambda: serializer.deserialize(data), rounds)),
+            ])
+    _print_table(['model', 'serializer', 'bytes', 'encode us', 'decode us'], rows)
+    return rows
+
+
+def benchmark_newsfeed_fanout_modes(followers_count=1000000, celebrities_counts=(1, 5, 20), rounds=100):
+    """
+    比较粉丝很多的用户发一条 tweet 时 push（fanout）和 pull 两种模式的写放大
+    以及读取一页 newsfeeds 时，pull 模式需要 merge 多少个 list 带来的额外耗时
+    storage calls 为读取时访问 redis / hbase 的次数（不包含 cache miss）
+    """
+    from django.conf import settings
+    from newsfeeds.constants import FANOUT_BATCH_SIZE
+    from newsfeeds.models import HBaseNewsFeed
+    from newsfeeds.services import NewsFeedService
+    from utils.paginations import EndlessPagination
+
+    batches_count = (followers_count - 1) // FANOUT_BATCH_SIZE + 1
+    _print_table(
+        ['mode', 'newsfeed rows', 'redis pushes', 'celery tasks'],
+        [
+            ['push', followers_count + 1, followers_count + 1, batches_count + 1],
+            ['pull', 1, 1, 1],
+        ],
+    )
+    print()
+
+    limit = settings.REDIS_LIST_LENGTH_LIMIT
+    page_size = EndlessPagination.page_size
+    timestamp = int(utc_now().timestamp() * 1000000)
+
+    def build_list(user_id, offset):
+        # 每个 list 里的 created_at 互相交错，模拟不同用户交替发 tweet
+        return [
+            HBaseNewsFeed(
+                user_id=1,
+                created_at=timestamp - (i * 1000 + offset),
+                tweet_id=user_id * limit + i,
+            )
+            for i in range(limit)
+        ]
+
+    newsfeeds = build_list(0, 0)
+    rows = [[
+        'push',
+        0,
+        1,
+        '{:.2f}'.format(_timeit_us(lambda: newsfeeds[:page_size], rounds)),
+    ]]
+    for celebrities_count in celebrities_counts:
+        newsfeed_lists = [newsfeeds] + [
+            build_list(user_id, user_id)
+            for user_id in range(1, celebrities_count + 1)
+        ]
+
+        def read_page():
+            merged, _ = NewsFeedService.merge_newsfeed_lists(newsfeed_lists)
+            return merged[:page_size]
+
+        rows.append([
+            'pull',
+            celebrities_count,
+            # newsfeeds + celebrity set + followings + 每个 celebrity 的 user_tweets
+            3 + celebrities_count,
+            '{:.2f}'.format(_timeit_us(read_page, rounds)),
+        ])
+    _print_table(['mode', 'celebrities', 'storage calls', 'merge us'], rows)
+    return rows
@@ -24,7 +24,35 @@ class MemcachedHelper:
         cache.set(key, obj)
         return obj
 
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        批量版本的 get_object_through_cache，返回 {object_id: obj}
+        一次 get_many 读出所有的 key，cache miss 的部分用一条 IN query 补齐之后 set_many 写回
+        数据库里不存在的 object_id 不会出现在返回结果里
+        """
+        object_ids = {object_id for object_id in object_ids if object_id is not None}
+        if not object_ids:
+            return {}
+
+        key_to_id = {cls.get_key(model_class, object_id): object_id for object_id in object_ids}
+        cached = cache.get_many(list(key_to_id.keys()))
+        objects = {key_to_id[key]: obj for key, obj in cached.items()}
+
+        # cache miss
+        missing_ids = object_ids - objects.keys()
+        if not missing_ids:
+            return objects
+        missing_objects = list(model_class.objects.filter(id__in=missing_ids))
+        cache.set_many({
+            cls.get_key(model_class, obj.id): obj
+            for obj in missing_objects
+        })
+        for obj in missing_objects:
+            objects[obj.id] = obj
+        return objects
+
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        cache.delete(key)
\ No newline at end of file
+        cache.delete(key)
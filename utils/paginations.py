@@ -1,8 +1,89 @@
 from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
 from dateutil import parser
 from django.conf import settings
+from django.core import signing
+from django.db.models import Q
 from utils.time_constants import MAX_TIMESTAMP
+from utils.time_helpers import (
+    to_timestamp,
+    from_timestamp,
+    reverse_ordered_range,
+    get_tie_breaker_id,
+)
+
+import pytz
+
+
+CURSOR_SOURCE_CACHE = 'cache'
+CURSOR_SOURCE_HBASE = 'hbase'
+CURSOR_SOURCE_MYSQL = 'mysql'
+
+
+class TimestampCursor:
+    """
+    翻页用的 cursor
+    mysql 的 models 使用 iso 格式的时间，hbase 的 models 使用 int 格式的时间戳
+    统一转换成 int 类型的 microseconds（和 Tweet.timestamp 以及 hbase 的 created_at 一致）
+    tie_breaker_id 用于区分 created_at 相同的 objects，source 表示上一页是从哪里读取的
+    客户端传入的 created_at__gt / created_at__lt 没有 tie_breaker_id 和 source
+    """
+    # signing 的 salt，避免其他地方签名的数据被当做 cursor 使用
+    SALT = 'utils.paginations.cursor'
+
+    def __init__(self, timestamp, tie_breaker_id=None, source=None):
+        self.timestamp = timestamp
+        self.tie_breaker_id = tie_breaker_id
+        self.source = source
+
+    @classmethod
+    def parse(cls, value, name='created_at'):
+        # 大部分请求来自 hbase 的 int 时间戳，先尝试 int，不行再用 dateutil 解析 iso 格式
+        # 客户端传入的值格式不对的时候返回 400，而不是在后面的查询里出错变成 500
+        try:
+            timestamp = int(value)
+        except ValueError:
+            try:
+                created_at = parser.isoparse(value)
+            except (ValueError, OverflowError):
+                raise ValidationError({name: 'Invalid timestamp'})
+            # 没有时区的时间当做 UTC，和数据库里存储的时间一致
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=pytz.utc)
+            timestamp = to_timestamp(created_at)
+        if not 0 <= timestamp <= MAX_TIMESTAMP:
+            raise ValidationError({name: 'Invalid timestamp'})
+        return cls(timestamp)
+
+    @classmethod
+    def from_request(cls, request, name):
+        value = request.query_params.get(name)
+        if value is None:
+            return None
+        return cls.parse(value, name)
+
+    @classmethod
+    def from_object(cls, obj, source):
+        return cls(to_timestamp(obj.created_at), get_tie_breaker_id(obj), source)
+
+    def encode(self):
+        # 签名之后客户端无法伪造 cursor，也不需要关心 cursor 的格式
+        return signing.dumps([self.timestamp, self.tie_breaker_id, self.source], salt=self.SALT)
+
+    @classmethod
+    def decode(cls, token):
+        try:
+            timestamp, tie_breaker_id, source = signing.loads(token, salt=cls.SALT)
+            return cls(int(timestamp), int(tie_breaker_id), source)
+        except (signing.BadSignature, ValueError, TypeError):
+            raise ValidationError({'cursor': 'Invalid cursor'})
+
+    @property
+    def datetime(self):
+        # 用于 mysql 的查询
+        return from_timestamp(self.timestamp)
+
 
 class EndlessPagination(BasePagination):
     page_size = 20 if not settings.TESTING else 10
@@ -10,44 +91,44 @@ class EndlessPagination(BasePagination):
     def __init__(self):
         super(EndlessPagination, self).__init__()
         self.has_next_page = False
+        self.next_cursor = None
 
     def to_html(self):
         pass
 
+    def get_next_page_cursor(self, request):
+        # 往下翻页的 cursor，优先使用上一页返回的 next_cursor，兼容客户端传入的 created_at__lt
+        if 'cursor' in request.query_params:
+            return TimestampCursor.decode(request.query_params['cursor'])
+        return TimestampCursor.from_request(request, 'created_at__lt')
+
+    def _set_next_cursor(self, page, source):
+        self.next_cursor = None
+        if self.has_next_page and len(page):
+            self.next_cursor = TimestampCursor.from_object(page[-1], source).encode()
+
     def paginate_ordered_list(self, reverse_ordered_list, request):
-        if 'created_at__gt' in request.query_params:
-            #created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
-            # 兼容 iso 格式和 int 格式的时间戳
-            try:
-                created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
-            except ValueError:
-                created_at__gt = int(request.query_params['created_at__gt'])
-            objects = []
-            for obj in reverse_ordered_list:
-                if obj.created_at > created_at__gt:
-                    objects.append(obj)
-                else:
-                    break
+        # reverse_ordered_list 按 (created_at, id) 倒序排列，用二分查找定位 cursor 的位置
+        # 翻到很深的页数的时候也不需要从头开始逐个比较 created_at
+        created_at__gt = TimestampCursor.from_request(request, 'created_at__gt')
+        if created_at__gt is not None:
+            _, stop = reverse_ordered_range(reverse_ordered_list, min_timestamp=created_at__gt.timestamp)
             self.has_next_page = False
-            return objects
+            return reverse_ordered_list[:stop]
 
         index = 0
-        if 'created_at__lt' in request.query_params:
-            # 兼容 iso 格式和 int 格式的时间戳
-            try:
-                created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
-            except ValueError:
-                created_at__lt = int(request.query_params['created_at__lt'])
-                
-            for index, obj in enumerate(reverse_ordered_list):
-                if obj.created_at < created_at__lt:
-                    break
-            else:
-                # 没找到任何满足条件的 objects, 返回空数组
-                # 注意这个 else 对应的是 for，参见 python 的 for else 语法
-                reverse_ordered_list = []
+        cursor = self.get_next_page_cursor(request)
+        if cursor is not None:
+            # 没找到任何满足条件的 objects 的时候 index 为 len(reverse_ordered_list)，返回空数组
+            index, _ = reverse_ordered_range(
+                reverse_ordered_list,
+                max_timestamp=cursor.timestamp,
+                max_tie_breaker_id=cursor.tie_breaker_id,
+            )
         self.has_next_page = len(reverse_ordered_list) > index + self.page_size
-        return reverse_ordered_list[index: index + self.page_size]
+        page = reverse_ordered_list[index: index + self.page_size]
+        self._set_next_cursor(page, CURSOR_SOURCE_CACHE)
+        return page
 
     def paginate_queryset(self, queryset, request, view=None):
 
@@ -55,71 +136,73 @@ class EndlessPagination(BasePagination):
             # created_at__gt 用于下拉刷新的时候加载最新的内容进来
             # 为了简便起见，下拉刷新不做翻页机制，直接加载所有更新的数据
             # 因为如果数据很久没有更新的话，不会采用下拉刷新的方式进行更新，而是重新加载最新的数据
-            created_at__gt = request.query_params['created_at__gt']
-            queryset = queryset.filter(created_at__gt=created_at__gt)
+            created_at__gt = TimestampCursor.from_request(request, 'created_at__gt')
+            queryset = queryset.filter(created_at__gt=created_at__gt.datetime)
             self.has_next_page = False
-            return queryset.order_by('-created_at')
+            return queryset.order_by('-created_at', '-id')
 
-        if 'created_at__lt' in request.query_params:
-            # created_at__lt 用于向上滚屏（往下翻页）的时候加载下一页的数据
-            # 寻找 created_at < created_at__lt 的 objects 里按照 created_at 倒序的前
-            # page_size + 1 个 objects
-            # 比如目前的 created_at 列表是 [10, 9, 8, 7 .. 1] 如果 created_at__lt=10
+        cursor = self.get_next_page_cursor(request)
+        if cursor is not None:
+            # 往下翻页的时候加载下一页的数据
+            # 寻找 (created_at, id) < cursor 的 objects 里按照 (created_at, id) 倒序的前
+            # page_size + 1 个 objects，这里的查询可以用到 created_at 的索引
+            # 比如目前的 created_at 列表是 [10, 9, 8, 7 .. 1] 如果 cursor 是 10
             # page_size = 2 则应该返回 [9, 8, 7]，多返回一个 object 的原因是为了判断是否
             # 还有下一页从而减少一次空加载。
-            created_at__lt = request.query_params['created_at__lt']
-            queryset = queryset.filter(created_at__lt=created_at__lt)
+            # 客户端传入的 created_at__lt 没有 tie_breaker_id，只比较 created_at
+            condition = Q(created_at__lt=cursor.datetime)
+            if cursor.tie_breaker_id is not None:
+                condition |= Q(created_at=cursor.datetime, id__lt=cursor.tie_breaker_id)
+            queryset = queryset.filter(condition)
 
-        queryset = queryset.order_by('-created_at')[:self.page_size + 1]
+        queryset = queryset.order_by('-created_at', '-id')[:self.page_size + 1]
         self.has_next_page = len(queryset) > self.page_size
-        return queryset[:self.page_size]
+        page = queryset[:self.page_size]
+        self._set_next_cursor(page, CURSOR_SOURCE_MYSQL)
+        return page
     
     def paginate_hbase(self, hb_model, row_key_prefix, request):
+        # hbase 的 row key 里包含了 created_at，同一个 row_key_prefix 下 created_at 不会重复
+        # created_at 是 int，所以 < t 等价于 <= t - 1，可以直接从 cursor 的下一个 row key 开始 scan
+        # 不需要多取一个 item 再把 created_at == t 的 item 去掉
         if 'created_at__gt' in request.query_params:
             # created_at__gt 用于下拉刷新的时候加载最新的内容进来
             # 为了简便起见，下拉刷新不做翻页机制，直接加载所有更新的数据
             # 因为如果数据很久没有更新的话，不会采用下拉刷新的方式进行更新，而是重新加载最新的数据
-            created_at__gt = request.query_params['created_at__gt']
-            start = (*row_key_prefix, created_at__gt)
+            created_at__gt = TimestampCursor.from_request(request, 'created_at__gt').timestamp
+            start = (*row_key_prefix, created_at__gt + 1)
             stop = (*row_key_prefix, MAX_TIMESTAMP)
             objects = hb_model.filter(start=start, stop=stop)
-            if len(objects) and objects[0].created_at == int(created_at__gt):
-                objects = objects[:0:-1]
-            else:
-                objects = objects[::-1]
             self.has_next_page = False
-            return objects
+            return objects[::-1]
 
-        if 'created_at__lt' in request.query_params:
-            # created_at__lt 用于向上滚屏（往下翻页）的时候加载下一页的数据
-            # 寻找 timestamp < created_at__lt 的 objects 里按照 timestamp 倒序的前 page_size + 1 个 objects
-            # 比如目前的 timestamp 列表是 [1, 2, 3, 4, 5, 6, 7, 8, 9, 10] 如果 created_at__lt=5, page_size = 2
+        cursor = self.get_next_page_cursor(request)
+        if cursor is not None:
+            # 往下翻页的时候加载下一页的数据
+            # 寻找 timestamp < cursor 的 objects 里按照 timestamp 倒序的前 page_size + 1 个 objects
+            # 比如目前的 timestamp 列表是 [1, 2, 3, 4, 5, 6, 7, 8, 9, 10] 如果 cursor 是 5, page_size = 2
             # 则应该返回 [4, 3, 2]，多返回一个 object 的原因是为了判断是否还有下一页从而减少一次空加载。
-            # 由于 hbase 只支持 <= 的查询而不支持 <, 因此我们还需要再多取一个 item 保证 < 的 item 有 page_size + 1 个
-            created_at__lt = request.query_params['created_at__lt']
-            start = (*row_key_prefix, created_at__lt)
+            start = (*row_key_prefix, cursor.timestamp - 1)
             stop = (*row_key_prefix, None)
-            objects = hb_model.filter(start=start, stop=stop, limit=self.page_size + 2, reverse=True)
-            if len(objects) and objects[0].created_at == int(created_at__lt):
-                objects = objects[1:]
-            if len(objects) > self.page_size:
-                self.has_next_page = True
-                objects = objects[:-1]
-            else:
-                self.has_next_page = False
-            return objects
-
-        # 没有任何参数，默认加载最新的一页
-        prefix = (*row_key_prefix, None)
-        objects = hb_model.filter(prefix=prefix, limit=self.page_size + 1, reverse=True)
+            objects = hb_model.filter(start=start, stop=stop, limit=self.page_size + 1, reverse=True)
+        else:
+            # 没有任何参数，默认加载最新的一页
+            prefix = (*row_key_prefix, None)
+            objects = hb_model.filter(prefix=prefix, limit=self.page_size + 1, reverse=True)
         if len(objects) > self.page_size:
             self.has_next_page = True
             objects = objects[:-1]
         else:
             self.has_next_page = False
+        self._set_next_cursor(objects, CURSOR_SOURCE_HBASE)
         return objects
 
-    def paginate_cached_list(self, cached_list, request):
+    def paginate_cached_list(self, cached_list, request, is_complete=None):
+        # 上一页是从数据库里读取的，说明 cache 里已经没有更多的数据了，直接去数据库查询
+        cursor = self.get_next_page_cursor(request)
+        if cursor is not None and cursor.source not in (None, CURSOR_SOURCE_CACHE):
+            return None
+        # is_complete 表示 cached_list 里是否已经包含了所有数据，为 None 时根据 list 长度判断
         paginated_list = self.paginate_ordered_list(cached_list, request)
         # 如果是上翻页，paginated_list 里是所有的最新的数据，直接返回
         if 'created_at__gt' in request.query_params:
@@ -128,13 +211,83 @@ class EndlessPagination(BasePagination):
         if self.has_next_page:
             return paginated_list
         # 如果 cached_list 的长度不足最大限制，说明 cached_list 里已经是所有数据了
-        if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
+        if is_complete is None:
+            is_complete = len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT
+        if is_complete:
             return paginated_list
         # 如果进入这里，说明可能存在在数据库里没有 load 在 cache 里的数据，需要直接去数据库查询
         return None
 
+    def paginate_cached_range(self, load_cached_range, request):
+        """
+        和 paginate_cached_list 一样从 cache 里翻页，区别是只从 cache 里读取需要的那一页
+        load_cached_range(min_timestamp=, max_timestamp=, limit=) 返回 (objects, is_complete)
+        返回 None 表示需要直接去数据库查询
+        """
+        if 'created_at__gt' in request.query_params:
+            # 下拉刷新不做翻页机制，返回 cache 里所有更新的数据
+            objects, _ = load_cached_range(
+                min_timestamp=TimestampCursor.from_request(request, 'created_at__gt').timestamp,
+            )
+            self.has_next_page = False
+            return objects
+
+        cursor = self.get_next_page_cursor(request)
+        if cursor is None:
+            cursor = TimestampCursor(None)
+        elif cursor.source not in (None, CURSOR_SOURCE_CACHE):
+            # 上一页是从数据库里读取的，说明 cache 里已经没有更多的数据了，不需要再读取 cache
+            return None
+        # 多取一个 object 用来判断是否还有下一页
+        objects, is_complete = load_cached_range(
+            max_timestamp=cursor.timestamp,
+            max_tie_breaker_id=cursor.tie_breaker_id,
+            limit=self.page_size + 1,
+        )
+        self.has_next_page = len(objects) > self.page_size
+        # 如果还有下一页，或者 cache 里已经是所有的数据了，直接返回
+        if self.has_next_page or is_complete:
+            page = objects[:self.page_size]
+            self._set_next_cursor(page, CURSOR_SOURCE_CACHE)
+            return page
+        # 如果进入这里，说明可能存在在数据库里没有 load 在 cache 里的数据，需要直接去数据库查询
+        return None
+
+    def paginate_merged_range(self, load_range, request, source):
+        """
+        cache 里没有的部分由 load_range 从多个数据源读取，合并成一页
+        load_range(max_timestamp=, max_tie_breaker_id=, limit=) 返回 (objects, has_more)
+        has_more 表示数据源里是否还有没有读取的 objects，去重之后一页可能不满 page_size + 1 个
+        source 是 next_cursor 里记录的数据源，下一页不会再读取 cache
+        """
+        cursor = self.get_next_page_cursor(request)
+        if cursor is None:
+            cursor = TimestampCursor(None)
+        objects, has_more = load_range(
+            max_timestamp=cursor.timestamp,
+            max_tie_breaker_id=cursor.tie_breaker_id,
+            limit=self.page_size + 1,
+        )
+        page = objects[:self.page_size]
+        self.has_next_page = len(page) > 0 and (len(objects) > self.page_size or has_more)
+        self._set_next_cursor(page, source)
+        return page
+
+    def paginate_cached_preview(self, load_cached_range, page_size):
+        """
+        详情页里嵌入的预览，只读取 cache 里最新的 page_size 个 objects
+        cache 里总是有最新的 REDIS_LIST_LENGTH_LIMIT 个 objects，不需要访问数据库
+        next_cursor 可以传给对应的 list API 继续往下翻页
+        """
+        objects, _ = load_cached_range(limit=page_size + 1)
+        self.has_next_page = len(objects) > page_size
+        page = objects[:page_size]
+        self._set_next_cursor(page, CURSOR_SOURCE_CACHE)
+        return page
+
     def get_paginated_response(self, data):
         return Response({
             'has_next_page': self.has_next_page,
+            'next_cursor': self.next_cursor,
             'results': data,
-        })
\ No newline at end of file
+        })
@@ -1,26 +1,56 @@
+from contextlib import contextmanager
 from django.conf import settings
+
+import os
 import redis
 
 
 class RedisClient:
     conn = None
+    # 创建 conn 的进程，fork 出来的子进程需要重新创建 connection pool，不能共用父进程的 sockets
+    pid = None
 
     @classmethod
     def get_connection(cls):
-        # 使用 singleton 模式，全局只创建一个 connection
-        if cls.conn:
+        # 使用 singleton 模式，每个进程只创建一个 connection pool
+        pid = os.getpid()
+        if cls.conn and cls.pid == pid:
             return cls.conn
-        cls.conn = redis.Redis(
+        pool = redis.BlockingConnectionPool(
             host=settings.REDIS_HOST,
             port=settings.REDIS_PORT,
             db=settings.REDIS_DB,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            socket_keepalive=True,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
         )
+        cls.conn = redis.Redis(connection_pool=pool)
+        cls.pid = pid
         return cls.conn
 
+    @classmethod
+    @contextmanager
+    def pipeline(cls, transaction=False):
+        """
+        把多个 redis 命令合并成一次请求发送
+        transaction=True 的时候使用 MULTI / EXEC，其他的客户端不会看到执行了一半的结果
+        需要返回值的时候在 with 里面调用 pipeline.execute()，否则退出 with 的时候自动执行
+        """
+        pipeline = cls.get_connection().pipeline(transaction=transaction)
+        try:
+            yield pipeline
+            if len(pipeline):
+                pipeline.execute()
+        finally:
+            pipeline.reset()
+
     @classmethod
     def clear(cls):
         # clear all keys in redis, for testing purpose
         if not settings.TESTING:
             raise Exception("You can not flush redis in production environment")
         conn = cls.get_connection()
-        conn.flushdb()
\ No newline at end of file
+        conn.flushdb()
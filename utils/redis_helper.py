@@ -1,47 +1,295 @@
+from collections import defaultdict
+from django.apps import apps
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Coalesce
+from twitter.cache import (
+    CACHE_REBUILD_METRICS_KEY,
+    COMPACT_SERIALIZED_PATTERNS,
+    DIRTY_COUNTS_KEY,
+    DIRTY_COUNTS_VERSION_KEY,
+    FLUSH_BATCH_COUNTS_KEY,
+    FLUSH_BATCH_TOKEN_KEY,
+    FLUSHING_COUNTS_KEY,
+)
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
+from utils.redis_serializers import (
+    CompactModelSerializer,
+    DjangoModelSerializer,
+    HBaseModelSerializer,
+    SchemaMismatchError,
+)
 from django_hbase.models import HBaseModel
+from utils.time_helpers import (
+    to_timestamp,
+    reverse_ordered_range,
+    get_tie_breaker_id,
+    get_ordering_key,
+)
+
+import time
+import uuid
+
+# user_tweets:{user_id} => (user_tweets:, 这个 key 使用的 CompactModelSerializer)
+COMPACT_SERIALIZERS = tuple(
+    (pattern[:pattern.find('{')], CompactModelSerializer(labels))
+    for pattern, labels in COMPACT_SERIALIZED_PATTERNS.items()
+)
+
+
+# 在 redis server 端原子地完成 exists 判断 + zadd + 长度限制 + expire
+# 避免 exists 检查之后 key 刚好过期，导致 push 到一个只有一个元素的新 sorted set 里
+# KEYS 是 sorted set 的 key，KEYS[i] 对应的 member 是 ARGV[i + 2]，score 是 ARGV[i + 2 + n]
+# ARGV[1] 是长度限制，ARGV[2] 是过期时间
+# 返回每个 key 是否 push 成功（1 表示 key 存在并且 push 成功，0 表示 key 不存在）
+# member 已经存在的时候 ZADD 不会重复写入（比如 cache 重建的时候已经从数据库里读到了）
+PUSH_OBJECTS_SCRIPT = """
+local n = #KEYS
+local pushed = {}
+for i = 1, n do
+    local key = KEYS[i]
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('ZADD', key, ARGV[i + 2 + n], ARGV[i + 2])
+        redis.call('ZREMRANGEBYRANK', key, 0, -tonumber(ARGV[1]) - 1)
+        redis.call('EXPIRE', key, ARGV[2])
+        pushed[i] = 1
+    else
+        pushed[i] = 0
+    end
+end
+return pushed
+"""
+
+# 从 sorted set 里删除一个 member，KEYS[1] 是 sorted set 的 key，ARGV[1] 是 member，ARGV[2] 是长度限制
+# sorted set 已经达到长度上限的时候，删除之后比上限短，读取的时候会被当成已经包含了所有的数据
+# 但更早的数据只在数据库里，这种情况下直接删掉整个 sorted set，下次读取的时候重新 load
+REMOVE_OBJECT_SCRIPT = """
+local count = redis.call('ZCARD', KEYS[1])
+local removed = redis.call('ZREM', KEYS[1], ARGV[1])
+if removed == 1 and count >= tonumber(ARGV[2]) then
+    redis.call('DEL', KEYS[1])
+end
+return removed
+"""
+
+# 只有持有 lock 的人（value 相同）才能释放 lock，避免 lock 过期之后删掉别人的 lock
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+# 只有 set 里已经有 ARGV[1]（表示 set 已经完整地 load 过了）的时候才加入新的 member ARGV[2]
+# 否则会创建出一个不完整的 set（并且没有过期时间）
+# KEYS[2] 是 set 的版本号，每次修改都加一，ARGV[3] 是版本号的过期时间，见 LOAD_SET_SCRIPT
+ADD_TO_LOADED_SET_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('SADD', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# 把从数据库里读到的快照写入 set，KEYS[1] 是 set，KEYS[2] 是 set 的版本号
+# ARGV[1] 是读数据库之前的版本号，ARGV[2] 是过期时间，之后的 ARGV 都是 members
+# set 已经存在，或者读数据库期间版本号变了（有并发的修改），快照可能是旧的，不写入并返回 0
+# 每次 SADD 1000 个 members，避免 unpack 太多参数超出 lua 的栈大小
+LOAD_SET_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+for i = 3, #ARGV, 1000 do
+    redis.call('SADD', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+# write-behind 的计数，在 redis server 端原子地完成 INCRBY + HINCRBY
+# KEYS[1] 是计数的 key，KEYS[2] 是 dirty hash，ARGV[1] 是增量，ARGV[2] 是计数在 dirty hash 里的 field
+# 计数的 key 只是 cache，可以正常过期，还没有写回数据库的增量单独记在 dirty hash 里
+# key 不存在的时候返回 nil，由调用方从数据库 load 之后再执行一次
+# ARGV[3] 为 1 的时候 key 不存在也把增量记录到 dirty hash 里（调用方没办法 load 计数）
+INCR_DIRTY_COUNT_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if ARGV[3] == '1' then
+        redis.call('HINCRBY', KEYS[2], ARGV[2], ARGV[1])
+    end
+    return false
+end
+redis.call('HINCRBY', KEYS[2], ARGV[2], ARGV[1])
+return redis.call('INCRBY', KEYS[1], ARGV[1])
+"""
+
 
 class RedisHelper:
+    # register_script 返回的 Script 对象会缓存 script 的 sha，调用时使用 EVALSHA
+    # 如果 redis server 上没有这个 script（比如重启过）会自动 SCRIPT LOAD 之后再执行
+    _push_objects_script = None
+    _remove_object_script = None
+    _release_lock_script = None
+    _add_to_loaded_set_script = None
+    _load_set_script = None
+    _incr_dirty_count_script = None
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects, serializer):
-        conn = RedisClient.get_connection()
+    def get_zset_key(cls, key):
+        # cache 里的 objects 只存在这个 sorted set 里，member 是序列化之后的 object，score 是 created_at 的 microseconds
+        # 翻页的时候用 ZREVRANGEBYSCORE 只取出需要的那一页，不需要反序列化所有的 objects
+        # 旧版本还会在 key 上存一份内容一样的 list，现在不再读写，重建的时候删掉
+        return '{}:zset'.format(key)
 
-        serialized_list = []
+    @classmethod
+    def _sort_objects(cls, objects):
+        # sorted set 里 score 相同的 members 按照 member 的字节序排列，而不是 id，重新按照 (created_at, id) 倒序排列
+        return sorted(objects, key=get_ordering_key, reverse=True)
+
+    @classmethod
+    def _load_objects_to_cache(cls, key, objects):
+        members = {}
         for obj in objects:
-            serialized_data = serializer.serialize(obj)
-            serialized_list.append(serialized_data)
+            serialized_data = cls._get_serializer(key, obj).serialize(obj)
+            members[serialized_data] = to_timestamp(obj.created_at)
 
-        if serialized_list:
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        if members:
+            # 先写到一个临时的 key 里再 RENAME，整个 sorted set 原子地替换掉旧的
+            # 放在一个 transaction 里，不会出现没有设置过期时间的 sorted set
+            zset_key = cls.get_zset_key(key)
+            rebuild_key = '{}:rebuild:{}'.format(zset_key, uuid.uuid4().hex)
+            with RedisClient.pipeline(transaction=True) as pipeline:
+                pipeline.zadd(rebuild_key, members)
+                pipeline.expire(rebuild_key, settings.REDIS_KEY_EXPIRE_TIME)
+                pipeline.rename(rebuild_key, zset_key)
+                pipeline.delete(key)
+
+    @classmethod
+    def _incr_metric(cls, name):
+        RedisClient.get_connection().hincrby(CACHE_REBUILD_METRICS_KEY, name, 1)
+
+    @classmethod
+    def get_cache_rebuild_metrics(cls):
+        """
+        rebuilds: 从数据库重建 cache 的次数
+        herd_suppressed: 等待别人重建 cache 而没有访问数据库的次数
+        wait_timeouts: 等待超时之后自己访问数据库的次数
+        """
+        metrics = RedisClient.get_connection().hgetall(CACHE_REBUILD_METRICS_KEY)
+        return {
+            name: int(metrics.get(name.encode('utf-8'), 0))
+            for name in ['rebuilds', 'herd_suppressed', 'wait_timeouts']
+        }
+
+    @classmethod
+    def _release_lock(cls, lock_key, token):
+        if cls._release_lock_script is None:
+            conn = RedisClient.get_connection()
+            cls._release_lock_script = conn.register_script(RELEASE_LOCK_SCRIPT)
+        cls._release_lock_script(
+            keys=[lock_key],
+            args=[token],
+            client=RedisClient.get_connection(),
+        )
+
+    @classmethod
+    def _get_lock_key(cls, key):
+        return '{}:lock'.format(key)
+
+    @classmethod
+    def _rebuild_cache(cls, key, lazy_load_objects, serializer, wait=True):
+        """
+        cache miss 的时候只让一个请求去数据库读取并重建 cache（single flight）
+        其他的请求轮询等待 cache 重建好之后直接从 cache 里读，避免同时访问数据库
+        wait=False 的时候拿不到 lock 直接返回 (None, False)，不等待也不访问数据库
+        返回 (objects, rebuilt)，rebuilt 表示是否是自己从数据库里读取的
+        """
+        conn = RedisClient.get_connection()
+        lock_key = cls._get_lock_key(key)
+        token = uuid.uuid4().hex
+        if conn.set(lock_key, token, nx=True, ex=settings.REDIS_REBUILD_LOCK_TIMEOUT):
+            try:
+                objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
+                cls._load_objects_to_cache(key, objects)
+            finally:
+                cls._release_lock(lock_key, token)
+            cls._incr_metric('rebuilds')
+            return list(objects), True
+        if not wait:
+            return None, False
+
+        deadline = time.time() + settings.REDIS_REBUILD_WAIT_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(settings.REDIS_REBUILD_POLL_INTERVAL)
+            serialized_list = conn.zrevrange(cls.get_zset_key(key), 0, -1)
+            if serialized_list:
+                try:
+                    objects = [
+                        cls._deserialize(key, serialized_data, serializer)
+                        for serialized_data in serialized_list
+                    ]
+                except SchemaMismatchError:
+                    # 读到的是其他版本的代码写入的 cache，不能用，直接去数据库里读取
+                    break
+                cls._incr_metric('herd_suppressed')
+                return cls._sort_objects(objects), False
+            if not conn.exists(lock_key):
+                # 重建完成了但是没有数据（没有 objects 的时候不会写入 cache）或者重建失败了
+                break
+
+        # 等不到的时候自己去数据库里读取，但是不写 cache，写 cache 的事情留给持有 lock 的人
+        cls._incr_metric('wait_timeouts')
+        return list(lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)), False
+
+    @classmethod
+    def _get_compact_serializer(cls, key):
+        for prefix, serializer in COMPACT_SERIALIZERS:
+            if key.startswith(prefix):
+                return serializer
+        return None
+
+    @classmethod
+    def _deserialize(cls, key, serialized_data, serializer):
+        # 同一个 cache 里可能同时存在 json 和 compact 两种格式的数据，按数据本身的格式来反序列化
+        if CompactModelSerializer.is_compact(serialized_data):
+            compact_serializer = cls._get_compact_serializer(key)
+            if compact_serializer is None:
+                raise SchemaMismatchError('{} is not a compact serialized key'.format(key))
+            return compact_serializer.deserialize(serialized_data)
+        return serializer.deserialize(serialized_data)
 
     @classmethod
     def load_objects(cls, key, lazy_load_objects, serializer=DjangoModelSerializer):
         conn = RedisClient.get_connection()
 
         # 如果在 cache 里存在，则直接拿出来，然后返回, cache hit
-        if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
-            for serialized_data in serialized_list:
-                deserialized_obj = serializer.deserialize(serialized_data)
-                objects.append(deserialized_obj)
-            # print(f'cache hit {key}, len(objects)={len(objects)}')
-            return objects
+        # 旧版本写入的只有 list 没有 sorted set 的 cache 当做 cache miss，重建的时候会删掉旧的 list
+        serialized_list = conn.zrevrange(cls.get_zset_key(key), 0, -1)
+        if serialized_list:
+            try:
+                objects = [
+                    cls._deserialize(key, serialized_data, serializer)
+                    for serialized_data in serialized_list
+                ]
+                # print(f'cache hit {key}, len(objects)={len(objects)}')
+                return cls._sort_objects(objects)
+            except SchemaMismatchError:
+                # model 的 fields 发生了变化，cache 里的数据已经不能用了，当做 cache miss 处理
+                conn.delete(key, cls.get_zset_key(key))
         
         #cache miss 
         # 最多只 cache REDIS_LIST_LENGTH_LIMIT 那么多个 objects
         # 超过这个限制的 objects，就去数据库里读取。一般这个限制会比较大，比如 1000
         # 因此翻页翻到 1000 的用户访问量会比较少，从数据库读取也不是大问题
-        objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
-        cls._load_objects_to_cache(key, objects, serializer)
-
         # 转换为 list 的原因是保持返回类型的统一，因为存在 redis 里的数据是 list 的形式
-        # print(f'cache miss {key}, len(objects)={len(objects)}')
-        return list(objects)
+        objects, _ = cls._rebuild_cache(key, lazy_load_objects, serializer)
+        return objects
         
         # #cache miss
         # cls._load_objects_to_cache(key, queryset)
@@ -49,58 +297,479 @@ class RedisHelper:
         # return list(queryset)
 
     @classmethod
-    def push_object(cls, key, obj, lazy_load_objects):
-        if isinstance(obj, HBaseModel):
-            serializer = HBaseModelSerializer
-        else:
-            serializer = DjangoModelSerializer
+    def filter_objects_in_range(
+        cls,
+        objects,
+        min_timestamp=None,
+        max_timestamp=None,
+        limit=None,
+        max_tie_breaker_id=None,
+    ):
+        """
+        从按 (created_at, id) 倒序排列的 objects 里筛选出 min_timestamp < created_at < max_timestamp 的前 limit 个
+        max_tie_breaker_id 的含义见 utils.time_helpers.reverse_ordered_range
+        """
+        start, stop = reverse_ordered_range(objects, min_timestamp, max_timestamp, max_tie_breaker_id)
+        if limit is not None:
+            stop = min(stop, start + limit)
+        return list(objects[start:stop])
+
+    @classmethod
+    def load_objects_in_range(
+        cls,
+        key,
+        lazy_load_objects,
+        min_timestamp=None,
+        max_timestamp=None,
+        limit=None,
+        max_tie_breaker_id=None,
+        serializer=DjangoModelSerializer,
+    ):
+        """
+        只从 cache 里读取 min_timestamp < created_at < max_timestamp 的那一段 objects
+        按 (created_at, id) 倒序最多返回 limit 个，翻一页只需要反序列化 page_size + 1 个 objects
+        max_tie_breaker_id 不为 None 的时候，created_at == max_timestamp 并且 id 更小的 objects 也包含在内
+        返回 (objects, is_complete)，is_complete 表示 cache 里是否已经包含了所有的数据
+        """
         conn = RedisClient.get_connection()
-        # 如果在 cache 里存在，直接把 obj 放在 list 的最前面，然后 trim 一下长度
-        if conn.exists(key):
-            # print(f'push cache hit {key}')
-            serialized_data = serializer.serialize(obj)
-            conn.lpush(key, serialized_data)
-            conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+        zset_key = cls.get_zset_key(key)
+        max_score = '+inf' if max_timestamp is None else '({}'.format(max_timestamp)
+        min_score = '-inf' if min_timestamp is None else '({}'.format(min_timestamp)
+        with RedisClient.pipeline() as pipeline:
+            # sorted set 里 score 相同的 members 按照 member 的字节序排列，而不是 id
+            # 所以 created_at 和 cursor 相同的那些单独取出来，按 id 筛选和排序
+            if max_tie_breaker_id is not None:
+                pipeline.zrevrangebyscore(zset_key, max_timestamp, max_timestamp)
+            if limit is None:
+                pipeline.zrevrangebyscore(zset_key, max_score, min_score, withscores=True)
+            else:
+                pipeline.zrevrangebyscore(zset_key, max_score, min_score, start=0, num=limit, withscores=True)
+            pipeline.zcard(zset_key)
+            results = pipeline.execute()
+        tied_list = results[0] if max_tie_breaker_id is not None else []
+        scored_list, cached_count = results[-2:]
+
+        serialized_list = [serialized_data for serialized_data, _ in scored_list]
+        if limit is not None and len(scored_list) == limit:
+            # 同样的原因，num=limit 截断的时候 score 最小的那些 members 里留下的不一定是 id 最大的
+            # 把这个 score 的所有 members 都取出来，和其他的 objects 一起排序之后再截断
+            lowest_score = int(scored_list[-1][1])
+            serialized_list = [
+                serialized_data
+                for serialized_data, score in scored_list
+                if int(score) != lowest_score
+            ]
+            serialized_list += conn.zrevrangebyscore(zset_key, lowest_score, lowest_score)
+
+        if cached_count:
+            try:
+                tied_objects = [
+                    cls._deserialize(key, serialized_data, serializer)
+                    for serialized_data in tied_list
+                ]
+                tied_objects = [
+                    obj for obj in tied_objects
+                    if get_tie_breaker_id(obj) < max_tie_breaker_id
+                ]
+                objects = cls._sort_objects(tied_objects + [
+                    cls._deserialize(key, serialized_data, serializer)
+                    for serialized_data in serialized_list
+                ])
+                if limit is not None:
+                    objects = objects[:limit]
+                return objects, cached_count < settings.REDIS_LIST_LENGTH_LIMIT
+            except SchemaMismatchError:
+                conn.delete(key, zset_key)
+
+        # sorted set 不存在，cache miss 的时候重建整个 sorted set 之后再筛选
+        objects = cls.load_objects(key, lazy_load_objects, serializer)
+        return (
+            cls.filter_objects_in_range(objects, min_timestamp, max_timestamp, limit, max_tie_breaker_id),
+            len(objects) < settings.REDIS_LIST_LENGTH_LIMIT,
+        )
+
+    @classmethod
+    def _get_serializer(cls, key, obj):
+        # 写入 cache 时使用的格式由 key pattern 决定，见 twitter.cache.COMPACT_SERIALIZED_PATTERNS
+        compact_serializer = cls._get_compact_serializer(key)
+        if compact_serializer is not None:
+            return compact_serializer
+        if isinstance(obj, HBaseModel):
+            return HBaseModelSerializer
+        return DjangoModelSerializer
+
+    @classmethod
+    def _push_serialized_to_keys(cls, keys, serialized_list, scores):
+        if cls._push_objects_script is None:
+            conn = RedisClient.get_connection()
+            cls._push_objects_script = conn.register_script(PUSH_OBJECTS_SCRIPT)
+        args = [settings.REDIS_LIST_LENGTH_LIMIT, settings.REDIS_KEY_EXPIRE_TIME]
+        pushed = cls._push_objects_script(
+            keys=[cls.get_zset_key(key) for key in keys],
+            args=args + serialized_list + scores,
+            client=RedisClient.get_connection(),
+        )
+        return [bool(flag) for flag in pushed]
+
+    @classmethod
+    def push_object(cls, key, obj, lazy_load_objects):
+        # 如果在 cache 里存在，直接把 obj 加到 sorted set 里，然后 trim 一下长度
+        serialized_data = cls._get_serializer(key, obj).serialize(obj)
+        score = to_timestamp(obj.created_at)
+        if cls._push_serialized_to_keys([key], [serialized_data], [score])[0]:
             return
         # 如果 key 不存在，直接从数据库里 load
         # 就不走单个 push 的方式加到 cache 里了
-        objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
-        cls._load_objects_to_cache(key, objects, serializer)
-        # print(f'push cache miss {key}, len={len(objects)}')
+        _, rebuilt = cls._rebuild_cache(key, lazy_load_objects, cls._get_serializer(key, obj), wait=False)
+        if not rebuilt:
+            # 别人正在重建，可能在 obj 写入数据库之前就已经读完了，等重建结束之后再 push 一次
+            cls._push_after_rebuild([key], [serialized_data], [score])
 
+    @classmethod
+    def _push_after_rebuild(cls, keys, serialized_list, scores):
+        """
+        keys 不在 cache 里的时候，别人可能正在重建，并且在 objects 写入数据库之前就已经读完了数据库
+        直接跳过的话重建出来的 cache 里会少掉这些 objects，所以等重建结束（lock 被释放）之后再 push 一次
+        重建时已经读到的 objects ZADD 不会重复写入，没有人在重建的 keys 下次读取的时候会完整地 load
+        返回最后仍然没有 push 成功的 keys
+        """
+        conn = RedisClient.get_connection()
+        with RedisClient.pipeline() as pipeline:
+            for key in keys:
+                pipeline.exists(cls._get_lock_key(key))
+            locked = pipeline.execute()
+        indexes = [i for i, flag in enumerate(locked) if flag]
+        if not indexes:
+            return keys
+
+        lock_keys = [cls._get_lock_key(keys[i]) for i in indexes]
+        deadline = time.time() + settings.REDIS_REBUILD_WAIT_TIMEOUT
+        while conn.exists(*lock_keys) and time.time() < deadline:
+            time.sleep(settings.REDIS_REBUILD_POLL_INTERVAL)
+        pushed = cls._push_serialized_to_keys(
+            [keys[i] for i in indexes],
+            [serialized_list[i] for i in indexes],
+            [scores[i] for i in indexes],
+        )
+        pushed_keys = {keys[i] for i, flag in zip(indexes, pushed) if flag}
+        return [key for key in keys if key not in pushed_keys]
+
+    @classmethod
+    def remove_object(cls, key, obj):
+        """
+        从 cache 里删除一个 obj，不需要删掉整个 sorted set
+        重新序列化得到的 member 和 push 的时候写入的一样，所以可以直接 ZREM
+        返回是否删除成功，obj 不在 cache 里的时候返回 False
+        """
+        if cls._remove_object_script is None:
+            conn = RedisClient.get_connection()
+            cls._remove_object_script = conn.register_script(REMOVE_OBJECT_SCRIPT)
+        removed = cls._remove_object_script(
+            keys=[cls.get_zset_key(key)],
+            args=[cls._get_serializer(key, obj).serialize(obj), settings.REDIS_LIST_LENGTH_LIMIT],
+            client=RedisClient.get_connection(),
+        )
+        return bool(removed)
+
+    @classmethod
+    def delete_objects(cls, key):
+        # 同时删除 sorted set 和旧版本的 list，下次读取的时候从数据库重新 load
+        RedisClient.get_connection().delete(key, cls.get_zset_key(key))
+
+    @classmethod
+    def batch_push_objects(cls, keys, objects):
+        """
+        把 objects[i] push 到 keys[i] 对应的 sorted set 里，所有 key 在一次 EVALSHA 中完成
+        只 push 到 cache 里已经存在的 key 上，不存在的 key 不会从数据库 load
+        正在重建的 keys 等重建结束之后再 push 一次，见 _push_after_rebuild
+        返回没有 push 成功（key 不在 cache 里）的 keys
+        """
+        if not keys:
+            return []
+        serialized_list = [
+            cls._get_serializer(key, obj).serialize(obj)
+            for key, obj in zip(keys, objects)
+        ]
+        scores = [to_timestamp(obj.created_at) for obj in objects]
+        pushed = cls._push_serialized_to_keys(keys, serialized_list, scores)
+        indexes = [i for i, flag in enumerate(pushed) if not flag]
+        if not indexes:
+            return []
+        return cls._push_after_rebuild(
+            [keys[i] for i in indexes],
+            [serialized_list[i] for i in indexes],
+            [scores[i] for i in indexes],
+        )
+
+
+    @classmethod
+    def get_set_version_key(cls, key):
+        # FriendshipService / LikeService 里带有 loaded 标记的 set 的版本号，set 每次修改或者删除都加一
+        return '{}:version'.format(key)
+
+    @classmethod
+    def get_set_version(cls, key):
+        # 从数据库 load set 之前先读取版本号，写入的时候交给 load_set 检查
+        version = RedisClient.get_connection().get(cls.get_set_version_key(key))
+        return version if version is not None else b'0'
+
+    @classmethod
+    def load_set(cls, key, version, members):
+        """
+        只有 set 不存在，并且版本号还是 version 的时候才写入 members，返回是否写入
+        load 的过程中并发的 follow / like 没办法修改还不存在的 set，但是会修改版本号
+        这时候数据库里读到的可能是修改之前的快照，不写入，下次读取的时候重新 load
+        """
+        if cls._load_set_script is None:
+            conn = RedisClient.get_connection()
+            cls._load_set_script = conn.register_script(LOAD_SET_SCRIPT)
+        return bool(cls._load_set_script(
+            keys=[key, cls.get_set_version_key(key)],
+            args=[version, settings.REDIS_KEY_EXPIRE_TIME, *members],
+            client=RedisClient.get_connection(),
+        ))
+
+    @classmethod
+    def add_to_loaded_set(cls, key, loaded_member, member):
+        """
+        用于 FriendshipService / LikeService 里带有 loaded 标记的 set
+        set 不存在（还没有 load 或者已经过期）的时候只修改版本号，下次读取的时候会从数据库完整地 load
+        """
+        if cls._add_to_loaded_set_script is None:
+            conn = RedisClient.get_connection()
+            cls._add_to_loaded_set_script = conn.register_script(ADD_TO_LOADED_SET_SCRIPT)
+        return cls._add_to_loaded_set_script(
+            keys=[key, cls.get_set_version_key(key)],
+            args=[loaded_member, member, settings.REDIS_KEY_EXPIRE_TIME],
+            client=RedisClient.get_connection(),
+        )
+
+    @classmethod
+    def remove_from_loaded_set(cls, key, member):
+        version_key = cls.get_set_version_key(key)
+        with RedisClient.pipeline(transaction=True) as pipeline:
+            pipeline.incr(version_key)
+            pipeline.expire(version_key, settings.REDIS_KEY_EXPIRE_TIME)
+            pipeline.srem(key, member)
+
+    @classmethod
+    def invalidate_loaded_set(cls, key):
+        version_key = cls.get_set_version_key(key)
+        with RedisClient.pipeline(transaction=True) as pipeline:
+            pipeline.incr(version_key)
+            pipeline.expire(version_key, settings.REDIS_KEY_EXPIRE_TIME)
+            pipeline.delete(key)
 
     @classmethod
     def get_count_key(cls, obj, attr):
-        return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
+        return cls.get_count_key_by_id(obj.__class__, attr, obj.id)
+
+    @classmethod
+    def get_count_key_by_id(cls, model_class, attr, obj_id):
+        # 计数不存储在 model 里的时候（比如 hbase 里的粉丝数），只有 id 没有 obj
+        return '{}.{}:{}'.format(model_class.__name__, attr, obj_id)
 
 
     @classmethod
-    def incr_count(cls, obj, attr):
+    def get_dirty_count_field(cls, model_class, attr, obj_id):
+        # dirty hash 里的 field，flush 的时候根据它找到 model 和 attr
+        return '{}:{}:{}'.format(model_class._meta.label, attr, obj_id)
+
+    @classmethod
+    def parse_dirty_count_field(cls, field):
+        if isinstance(field, bytes):
+            field = field.decode('utf-8')
+        label, attr, obj_id = field.rsplit(':', 2)
+        return apps.get_model(label), attr, int(obj_id)
+
+    @classmethod
+    def discard_counts(cls, model_class, attr, obj_ids):
+        """
+        数据库里的计数已经重新算过（比如 backfill），丢弃 redis 里的计数以及还没有写回的增量
+        只删掉计数的 key 是不够的，dirty hash 里的增量还在的话，flush 的时候会再加一遍
+        """
+        keys = [cls.get_count_key_by_id(model_class, attr, obj_id) for obj_id in obj_ids]
+        fields = [cls.get_dirty_count_field(model_class, attr, obj_id) for obj_id in obj_ids]
+        if not keys:
+            return
+        with RedisClient.pipeline(transaction=True) as pipeline:
+            pipeline.hdel(DIRTY_COUNTS_KEY, *fields)
+            pipeline.hdel(FLUSHING_COUNTS_KEY, *fields)
+            pipeline.hdel(FLUSH_BATCH_COUNTS_KEY, *fields)
+            pipeline.delete(*keys)
+
+    @classmethod
+    def _get_pending_deltas(cls, fields):
+        """
+        还没有写回数据库的增量，可能在 dirty hash 里，也可能在正在 flush 的 hash 或者 batch 里
+        从数据库 load 计数的时候加上这些增量，才是 cache 里应该存的值
+        返回 (flush 的版本号, 增量)，在同一个 MULTI 里读取
+        """
+        with RedisClient.pipeline(transaction=True) as pipeline:
+            pipeline.get(DIRTY_COUNTS_VERSION_KEY)
+            pipeline.hmget(DIRTY_COUNTS_KEY, fields)
+            pipeline.hmget(FLUSHING_COUNTS_KEY, fields)
+            pipeline.hmget(FLUSH_BATCH_COUNTS_KEY, fields)
+            version, *results = pipeline.execute()
+        return int(version or 0), [sum(int(delta or 0) for delta in deltas) for deltas in zip(*results)]
+
+    @classmethod
+    def _load_counts(cls, model_class, obj_attrs):
+        """
+        从数据库读取 obj_attrs = [(obj_id, attr)] 的计数并加上还没有写回的增量
+        先读增量再读数据库，前后的 flush 版本号相同并且是偶数，才说明这期间没有一批增量被写回数据库
+        否则同一批增量可能在两边都读到（或者都没读到），重新读取
+        返回 ({(obj_id, attr): count}, consistent)，已经被删除的 objects 不在结果里
+        consistent 为 False 的时候算出来的计数可能不准，不能写入 cache
+        """
+        fields = [cls.get_dirty_count_field(model_class, attr, obj_id) for obj_id, attr in obj_attrs]
+        attrs = {attr for _, attr in obj_attrs}
         conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
-        #back fill cache from db
-        if not conn.exists(key):
-            #不执行-1操作， 因为必须保证调用incr_count之前obj.attr 已经-1 过了
-            obj.refresh_from_db()
-            conn.set(key, getattr(obj, attr))
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-            return getattr(obj, attr)
-        return conn.incr(key)
+        for _ in range(settings.REDIS_COUNTS_LOAD_RETRY_TIMES):
+            version, deltas = cls._get_pending_deltas(fields)
+            rows = list(model_class.objects.filter(
+                id__in={obj_id for obj_id, _ in obj_attrs},
+            ).values('id', *attrs))
+            consistent = version % 2 == 0 and version == int(conn.get(DIRTY_COUNTS_VERSION_KEY) or 0)
+            if consistent:
+                break
+        db_rows = {row['id']: row for row in rows}
+        counts = {}
+        for (obj_id, attr), delta in zip(obj_attrs, deltas):
+            if obj_id in db_rows:
+                counts[(obj_id, attr)] = (db_rows[obj_id][attr] or 0) + delta
+        return counts, consistent
 
+    @classmethod
+    def incr_count_by_id(cls, model_class, attr, obj_id, amount):
+        """
+        write-behind：只修改 redis 里的计数，并且把增量记录到 dirty hash 里
+        由 flush_dirty_counts 定期批量写回数据库，热门 tweet 不会因为大量的 UPDATE 产生行锁竞争
+        返回修改之后的计数，object 已经被删除的时候返回 None
+        """
+        if cls._incr_dirty_count_script is None:
+            conn = RedisClient.get_connection()
+            cls._incr_dirty_count_script = conn.register_script(INCR_DIRTY_COUNT_SCRIPT)
+        key = cls.get_count_key_by_id(model_class, attr, obj_id)
+        field = cls.get_dirty_count_field(model_class, attr, obj_id)
+        while True:
+            count = cls._incr_dirty_count_script(
+                keys=[key, DIRTY_COUNTS_KEY],
+                args=[amount, field, 0],
+                client=RedisClient.get_connection(),
+            )
+            if count is not None:
+                return count
+            # 计数不在 cache 里，从数据库 load 之后加上还没有写回的增量，见 _load_counts
+            counts, consistent = cls._load_counts(model_class, [(obj_id, attr)])
+            if (obj_id, attr) not in counts:
+                return None
+            if not consistent:
+                # 读不到一致的计数，不写入 cache，只把增量记录到 dirty hash 里，下次读取的时候再 load
+                count = cls._incr_dirty_count_script(
+                    keys=[key, DIRTY_COUNTS_KEY],
+                    args=[amount, field, 1],
+                    client=RedisClient.get_connection(),
+                )
+                # 这期间别人已经 load 好了的话，增量同时加在了 cache 里，返回 cache 里的值
+                return count if count is not None else counts[(obj_id, attr)] + amount
+            # 用 SET NX 写入，同时 load 的多个请求只有一个会写入成功，不会覆盖掉别人的修改
+            RedisClient.get_connection().set(
+                key,
+                counts[(obj_id, attr)],
+                nx=True,
+                ex=settings.REDIS_KEY_EXPIRE_TIME,
+            )
 
     @classmethod
-    def decr_count(cls, obj, attr):
+    def flush_dirty_counts(cls, batch_size=None):
+        """
+        把 dirty hash 里的增量写回数据库，由 tweets.tasks.flush_dirty_counts_task 定期调用
+        1. 把 dirty hash RENAME 成 flushing hash，之后的修改会记录到新的 dirty hash 里，下一次再写回
+        2. 每 batch_size 个增量生成一个 token，和这一批增量一起原子地从 flushing hash 移到 batch hash 里
+        3. 按 model 分组，用一条 UPDATE ... SET attr = attr + CASE WHEN 写入增量
+           同一个 tweet 在两次 flush 之间被 like 了多少次，都只需要一次写入
+        4. token 和 UPDATE 在同一个 transaction 里写入 CountFlushBatch，commit 之后再清理 batch hash
+        中途退出的时候 batch hash 和 token 都还在，下一次先处理这一批
+        token 已经在数据库里说明已经 commit 过了，只清理不再写入，不会重复计算
+        写入的是增量而不是 cache 里的绝对值，计数的 key 过期或者 redis 被清空都不会把计数写错
+        返回写回数据库的计数的个数
+        """
+        batch_size = batch_size or settings.REDIS_COUNTS_FLUSH_BATCH_SIZE
         conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
-        #back fill cache from db
-        if not conn.exists(key):
-            #不执行-1操作， 因为必须保证调用decr_count之前obj.attr 已经-1 过了
-            obj.refresh_from_db()
-            conn.set(key, getattr(obj, attr))
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-            return getattr(obj, attr)
-        return conn.decr(key)
+        # 同时只能有一个 flush，否则同一批增量可能被两个 flush 重复写入
+        lock_key = '{}:lock'.format(DIRTY_COUNTS_KEY)
+        token = uuid.uuid4().hex
+        if not conn.set(lock_key, token, nx=True, ex=settings.REDIS_COUNTS_FLUSH_LOCK_TIMEOUT):
+            return 0
+        try:
+            flushed = 0
+            # 上一次 flush 中途退出留下的 batch 先处理
+            batch_token = conn.get(FLUSH_BATCH_TOKEN_KEY)
+            if batch_token is not None:
+                deltas = list(conn.hgetall(FLUSH_BATCH_COUNTS_KEY).items())
+                cls._flush_counts_batch(batch_token.decode('utf-8'), deltas)
+                flushed += len(deltas)
+
+            # 上一次 flush 中途失败留下的 flushing hash 先写回
+            if not conn.exists(FLUSHING_COUNTS_KEY):
+                if not conn.exists(DIRTY_COUNTS_KEY):
+                    return flushed
+                conn.rename(DIRTY_COUNTS_KEY, FLUSHING_COUNTS_KEY)
 
+            deltas = list(conn.hgetall(FLUSHING_COUNTS_KEY).items())
+            for i in range(0, len(deltas), batch_size):
+                batch = deltas[i: i + batch_size]
+                batch_token = uuid.uuid4().hex
+                with RedisClient.pipeline(transaction=True) as pipeline:
+                    pipeline.hset(FLUSH_BATCH_COUNTS_KEY, mapping=dict(batch))
+                    pipeline.set(FLUSH_BATCH_TOKEN_KEY, batch_token)
+                    pipeline.hdel(FLUSHING_COUNTS_KEY, *[field for field, _ in batch])
+                cls._flush_counts_batch(batch_token, batch)
+            conn.delete(FLUSHING_COUNTS_KEY)
+            return flushed + len(deltas)
+        finally:
+            cls._release_lock(lock_key, token)
+
+    @classmethod
+    def _flush_counts_batch(cls, token, deltas):
+        # model_class -> attr -> {obj_id: delta}
+        grouped = defaultdict(lambda: defaultdict(dict))
+        for field, delta in deltas:
+            model_class, attr, obj_id = cls.parse_dirty_count_field(field)
+            if int(delta):
+                grouped[model_class][attr][obj_id] = int(delta)
+
+        # 和 tweets.models 之间有循环 import
+        CountFlushBatch = apps.get_model('tweets', 'CountFlushBatch')
+        cls._set_flush_version(in_progress=True)
+        with transaction.atomic():
+            # token 是 unique 的，即使 lock 过期之后两个 flush 同时写入，也只有一个能 commit
+            if not CountFlushBatch.objects.filter(token=token).exists():
+                for model_class, attr_deltas in grouped.items():
+                    obj_ids = {obj_id for obj_deltas in attr_deltas.values() for obj_id in obj_deltas}
+                    model_class.objects.filter(id__in=obj_ids).update(**{
+                        attr: Coalesce(F(attr), 0) + Case(
+                            *[When(id=obj_id, then=Value(delta)) for obj_id, delta in obj_deltas.items()],
+                            default=Value(0),
+                            output_field=IntegerField(),
+                        )
+                        for attr, obj_deltas in attr_deltas.items()
+                    })
+                CountFlushBatch.objects.create(token=token)
+        RedisClient.get_connection().delete(FLUSH_BATCH_COUNTS_KEY, FLUSH_BATCH_TOKEN_KEY)
+        # batch 已经清理掉了，token 不会再被用到
+        CountFlushBatch.objects.filter(token=token).delete()
+        cls._set_flush_version(in_progress=False)
+
+    @classmethod
+    def _set_flush_version(cls, in_progress):
+        # 见 DIRTY_COUNTS_VERSION_KEY，只有持有 flush lock 的时候才会修改
+        # 上一次 flush 中途退出的时候版本号停留在奇数，处理剩下的 batch 的时候不再加一
+        conn = RedisClient.get_connection()
+        version = int(conn.get(DIRTY_COUNTS_VERSION_KEY) or 0)
+        if version % 2 != int(in_progress):
+            conn.incr(DIRTY_COUNTS_VERSION_KEY)
 
     @classmethod
     def get_count(cls, obj, attr):
@@ -110,8 +779,63 @@ class RedisHelper:
         if count is not None:
             return int(count)
 
+        # 数据库里的计数还没有加上 dirty hash 里的增量，见 _load_counts
+        counts, consistent = cls._load_counts(obj.__class__, [(obj.id, attr)])
+        if (obj.id, attr) not in counts:
+            # 已经从 db 里删掉了，不写回 cache
+            return getattr(obj, attr)
+        count = counts[(obj.id, attr)]
+        if consistent:
+            # 计数只在 redis 里修改，load 的同时可能有人已经写入并修改过了，用 NX 避免覆盖
+            conn.set(key, count, nx=True, ex=settings.REDIS_KEY_EXPIRE_TIME)
+        return count
+
+    @classmethod
+    def get_counts(cls, objs, attr):
+        """
+        一次 MGET 取回一页 objects 的计数，返回 {obj.id: count}
+        """
+        return cls.get_counts_multi(objs, [attr])[attr]
+
+    @classmethod
+    def get_counts_multi(cls, objs, attrs):
+        """
+        一次 MGET 取回一页 objects 的多个计数，返回 {attr: {obj.id: count}}
+        cache miss 的部分用一条 SQL 从 db 里一起查出来，再用一个 pipeline 写回 cache
+        objs 需要是同一种 model
+        """
+        counts = {attr: {} for attr in attrs}
+        if not objs:
+            return counts
+
+        conn = RedisClient.get_connection()
+        obj_attrs = [(obj, attr) for attr in attrs for obj in objs]
+        values = conn.mget([cls.get_count_key(obj, attr) for obj, attr in obj_attrs])
+        missing = []
+        for (obj, attr), value in zip(obj_attrs, values):
+            if value is None:
+                missing.append((obj, attr))
+            else:
+                counts[attr][obj.id] = int(value)
+        if not missing:
+            return counts
 
-        obj.refresh_from_db()
-        count = getattr(obj, attr)
-        conn.set(key, count)
-        return count
\ No newline at end of file
+        # back fill cache from db
+        model_class = objs[0].__class__
+        loaded, consistent = cls._load_counts(model_class, [(obj.id, attr) for obj, attr in missing])
+        with RedisClient.pipeline() as pipeline:
+            for obj, attr in missing:
+                if (obj.id, attr) not in loaded:
+                    # 已经从 db 里删掉了，不写回 cache
+                    counts[attr][obj.id] = getattr(obj, attr)
+                    continue
+                counts[attr][obj.id] = loaded[(obj.id, attr)]
+                if not consistent:
+                    continue
+                pipeline.set(
+                    cls.get_count_key(obj, attr),
+                    counts[attr][obj.id],
+                    nx=True,
+                    ex=settings.REDIS_KEY_EXPIRE_TIME,
+                )
+        return counts
@@ -1,8 +1,20 @@
+from django.apps import apps
 from django.core import serializers
+from django.db import models
+from django.utils import timezone
 from django_hbase.models import HBaseModel
 from utils.json_encoder import JSONEncoder
 
+import datetime
 import json
+import struct
+
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class SchemaMismatchError(Exception):
+    pass
 
 class DjangoModelSerializer:
 
@@ -40,4 +52,143 @@ class HBaseModelSerializer:
         json_data = json.loads(serialized_data)
         model_class = cls.get_model_class(json_data['model_class_name'])
         del json_data['model_class_name']
-        return model_class(**json_data)
\ No newline at end of file
+        return model_class(**json_data)
+
+
+class CompactModelSerializer:
+    """
+    紧凑的二进制格式，用于 redis sorted set 里缓存的 Tweet / NewsFeed / HBaseNewsFeed 等 objects
+    格式为 1 个字节的 schema version + 1 个字节的 model 下标 + 2 个字节的 field 个数 + 每个 field 的值
+    每个值用 1 个字节的类型 + struct 打包的数据表示，datetime 转换成 int 类型的 microseconds
+    一个 key pattern 的 sorted set 里可能出现的 models 由 twitter.cache.COMPACT_SERIALIZED_PATTERNS 决定
+    每个 object 里只存 model 在其中的下标，不重复存 model label
+    只解析 int / float / str / bool / None，不会像 pickle 那样执行 cache 里的数据
+    """
+    SCHEMA_VERSION = 2
+    HEADER = struct.Struct('<BBH')
+    INT = struct.Struct('<q')
+    FLOAT = struct.Struct('<d')
+    LENGTH = struct.Struct('<I')
+    TYPE_NONE, TYPE_INT, TYPE_FLOAT, TYPE_STR, TYPE_TRUE, TYPE_FALSE = range(6)
+    # label -> (model_class, attnames, datetime field 的下标, 是否为 hbase model)
+    _model_meta = {}
+
+    def __init__(self, labels):
+        # labels 的顺序就是写入 cache 的 model 下标，只能在最后追加新的 model
+        self.labels = tuple(labels)
+        self.indexes = {label: index for index, label in enumerate(self.labels)}
+
+    @classmethod
+    def is_compact(cls, serialized_data):
+        # json 格式的数据一定以 [ 或者 { 开头，借此区分 cache 里新旧两种格式的数据
+        return serialized_data[:1] not in (b'[', b'{', '[', '{')
+
+    @classmethod
+    def get_label(cls, model_class):
+        if issubclass(model_class, HBaseModel):
+            return 'hbase.{}'.format(model_class.__name__)
+        return model_class._meta.label
+
+    @classmethod
+    def get_model_meta(cls, label):
+        if label in cls._model_meta:
+            return cls._model_meta[label]
+        if label.startswith('hbase.'):
+            model_class = HBaseModelSerializer.get_model_class(label[len('hbase.'):])
+            meta = (model_class, list(model_class.get_field_hash()), [], True)
+        else:
+            model_class = apps.get_model(label)
+            fields = model_class._meta.concrete_fields
+            datetime_indexes = [
+                index
+                for index, field in enumerate(fields)
+                if isinstance(field, models.DateTimeField)
+            ]
+            meta = (model_class, [field.attname for field in fields], datetime_indexes, False)
+        cls._model_meta[label] = meta
+        return meta
+
+    @classmethod
+    def _pack_value(cls, value, chunks):
+        # bool 是 int 的子类，需要先判断
+        if value is None:
+            chunks.append(bytes([cls.TYPE_NONE]))
+        elif value is True:
+            chunks.append(bytes([cls.TYPE_TRUE]))
+        elif value is False:
+            chunks.append(bytes([cls.TYPE_FALSE]))
+        elif isinstance(value, int):
+            chunks.append(bytes([cls.TYPE_INT]) + cls.INT.pack(value))
+        elif isinstance(value, float):
+            chunks.append(bytes([cls.TYPE_FLOAT]) + cls.FLOAT.pack(value))
+        elif isinstance(value, str):
+            data = value.encode('utf-8')
+            chunks.append(bytes([cls.TYPE_STR]) + cls.LENGTH.pack(len(data)) + data)
+        else:
+            raise TypeError('{} is not supported by CompactModelSerializer'.format(type(value)))
+
+    @classmethod
+    def _unpack_value(cls, data, offset):
+        value_type = data[offset]
+        offset += 1
+        if value_type == cls.TYPE_NONE:
+            return None, offset
+        if value_type == cls.TYPE_TRUE:
+            return True, offset
+        if value_type == cls.TYPE_FALSE:
+            return False, offset
+        if value_type == cls.TYPE_INT:
+            return cls.INT.unpack_from(data, offset)[0], offset + cls.INT.size
+        if value_type == cls.TYPE_FLOAT:
+            return cls.FLOAT.unpack_from(data, offset)[0], offset + cls.FLOAT.size
+        if value_type == cls.TYPE_STR:
+            length = cls.LENGTH.unpack_from(data, offset)[0]
+            offset += cls.LENGTH.size
+            if offset + length > len(data):
+                raise SchemaMismatchError('truncated string')
+            return str(data[offset: offset + length], 'utf-8'), offset + length
+        raise SchemaMismatchError('unknown value type {}'.format(value_type))
+
+    def serialize(self, instance):
+        label = self.get_label(instance.__class__)
+        _, attnames, datetime_indexes, _ = self.get_model_meta(label)
+        values = [getattr(instance, attname) for attname in attnames]
+        for index in datetime_indexes:
+            if values[index] is not None:
+                values[index] = (values[index] - EPOCH) // datetime.timedelta(microseconds=1)
+        chunks = [self.HEADER.pack(self.SCHEMA_VERSION, self.indexes[label], len(values))]
+        for value in values:
+            self._pack_value(value, chunks)
+        return b''.join(chunks)
+
+    def deserialize(self, serialized_data):
+        try:
+            # 空的或者被截断的数据读不到 version，也按照 schema 不匹配处理
+            if serialized_data[0] != self.SCHEMA_VERSION:
+                raise SchemaMismatchError(
+                    'unknown schema version {}'.format(serialized_data[0]),
+                )
+            _, model_index, values_count = self.HEADER.unpack_from(serialized_data, 0)
+            if model_index >= len(self.labels):
+                raise SchemaMismatchError('unknown model index {}'.format(model_index))
+            label = self.labels[model_index]
+            model_class, attnames, datetime_indexes, is_hbase = self.get_model_meta(label)
+            # model 增减了 field 之后，cache 里的旧数据就不能再用了
+            if values_count != len(attnames):
+                raise SchemaMismatchError(
+                    '{} has {} fields, got {} values'.format(label, len(attnames), values_count),
+                )
+            values = []
+            offset = self.HEADER.size
+            for _ in range(values_count):
+                value, offset = self._unpack_value(serialized_data, offset)
+                values.append(value)
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            # 数据被截断或者不是这个格式写入的，当做 schema 不匹配处理，重新从数据库 load
+            raise SchemaMismatchError('malformed compact data: {}'.format(e))
+        if is_hbase:
+            return model_class(**dict(zip(attnames, values)))
+        for index in datetime_indexes:
+            if values[index] is not None:
+                values[index] = EPOCH + datetime.timedelta(microseconds=values[index])
+        return model_class.from_db(None, attnames, values)
@@ -1,5 +1,35 @@
+from django.conf import settings
 from testing.testcases import TestCase
 from utils.redis_client import RedisClient
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_helper import RedisHelper
+from utils.redis_serializers import (
+    CompactModelSerializer,
+    DjangoModelSerializer,
+    HBaseModelSerializer,
+    SchemaMismatchError,
+)
+from newsfeeds.models import HBaseNewsFeed
+from django.contrib.auth.models import User
+from tweets.models import CountFlushBatch, Tweet
+from twitter.cache import (
+    COMPACT_SERIALIZED_PATTERNS,
+    DIRTY_COUNTS_KEY,
+    DIRTY_COUNTS_VERSION_KEY,
+    FLUSH_BATCH_COUNTS_KEY,
+    FLUSH_BATCH_TOKEN_KEY,
+    FLUSHING_COUNTS_KEY,
+    USER_NEWSFEEDS_PATTERN,
+    USER_TWEETS_PATTERN,
+)
+from utils.paginations import EndlessPagination, TimestampCursor
+from utils.time_helpers import to_timestamp, utc_now
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+import threading
+import time
 
 
 class UtilsTests(TestCase):
@@ -16,4 +46,444 @@ class UtilsTests(TestCase):
 
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
-        self.assertEqual(cached_list, [])
\ No newline at end of file
+        self.assertEqual(cached_list, [])
+
+    def test_redis_pipeline(self):
+        conn = RedisClient.get_connection()
+        # 没有调用 execute 的时候，退出 with 的时候自动执行
+        with RedisClient.pipeline() as pipeline:
+            pipeline.set('key1', 1)
+            pipeline.set('key2', 2)
+            self.assertEqual(conn.get('key1'), None)
+        self.assertEqual(conn.mget(['key1', 'key2']), [b'1', b'2'])
+
+        with RedisClient.pipeline(transaction=True) as pipeline:
+            pipeline.incr('key1')
+            pipeline.get('key1')
+            self.assertEqual(pipeline.execute(), [2, b'2'])
+
+        # fork 之后重新创建 connection pool
+        RedisClient.pid = None
+        self.assertEqual(RedisClient.get_connection() is conn, False)
+        self.assertEqual(RedisClient.get_connection().get('key2'), b'2')
+
+    def test_get_objects_through_cache(self):
+        linghu = self.create_user('linghu')
+        dongxie = self.create_user('dongxie')
+        tweets = [self.create_tweet(linghu), self.create_tweet(dongxie)]
+
+        # cache miss
+        cached_users = MemcachedHelper.get_objects_through_cache(
+            User,
+            [linghu.id, dongxie.id, None],
+        )
+        self.assertEqual(set(cached_users.keys()), {linghu.id, dongxie.id})
+        self.assertEqual(cached_users[linghu.id].username, 'linghu')
+
+        # cache hit, object not exists will not be returned
+        cached_tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet,
+            [tweets[0].id, tweets[1].id, -1],
+        )
+        self.assertEqual(set(cached_tweets.keys()), {tweets[0].id, tweets[1].id})
+        self.assertEqual(cached_tweets[tweets[1].id].user_id, dongxie.id)
+
+        # cache invalidated
+        linghu.username = 'linghuchong'
+        linghu.save()
+        cached_users = MemcachedHelper.get_objects_through_cache(User, [linghu.id])
+        self.assertEqual(cached_users[linghu.id].username, 'linghuchong')
+
+    def test_get_counts_multi(self):
+        linghu = self.create_user('linghu')
+        tweets = [self.create_tweet(linghu) for _ in range(3)]
+        Tweet.objects.filter(id=tweets[0].id).update(likes_count=2, comments_count=1)
+        Tweet.objects.filter(id=tweets[1].id).update(likes_count=5)
+
+        # cache miss, back fill from db
+        counts = RedisHelper.get_counts_multi(tweets, ['likes_count', 'comments_count'])
+        self.assertEqual(counts['likes_count'], {
+            tweets[0].id: 2,
+            tweets[1].id: 5,
+            tweets[2].id: 0,
+        })
+        self.assertEqual(counts['comments_count'][tweets[0].id], 1)
+
+        conn = RedisClient.get_connection()
+        key = RedisHelper.get_count_key(tweets[1], 'likes_count')
+        self.assertEqual(conn.get(key), b'5')
+        self.assertEqual(conn.ttl(key) > 0, True)
+
+        # cache hit, db is not read again
+        Tweet.objects.filter(id=tweets[1].id).update(likes_count=6)
+        counts = RedisHelper.get_counts(tweets, 'likes_count')
+        self.assertEqual(counts[tweets[1].id], 5)
+
+    def test_flush_dirty_counts(self):
+        linghu = self.create_user('linghu')
+        tweets = [self.create_tweet(linghu) for _ in range(2)]
+        for _ in range(3):
+            RedisHelper.incr_count_by_id(Tweet, 'likes_count', tweets[0].id, 1)
+        RedisHelper.incr_count_by_id(Tweet, 'likes_count', tweets[0].id, -1)
+        RedisHelper.incr_count_by_id(Tweet, 'comments_count', tweets[1].id, 1)
+        # object 不存在的时候不写入 cache
+        self.assertEqual(RedisHelper.incr_count_by_id(Tweet, 'likes_count', -1, 1), None)
+
+        # 只修改了 redis，增量记录在 dirty hash 里，计数的 key 可以正常过期
+        conn = RedisClient.get_connection()
+        key = RedisHelper.get_count_key(tweets[0], 'likes_count')
+        self.assertEqual(conn.get(key), b'2')
+        self.assertEqual(conn.ttl(key) > 0, True)
+        self.assertEqual(Tweet.objects.get(id=tweets[0].id).likes_count, 0)
+
+        # 计数的 key 丢失之后增量仍然会写回，重新 load 的时候也会加上还没有写回的增量
+        conn.delete(key)
+        self.assertEqual(RedisHelper.get_count(tweets[0], 'likes_count'), 2)
+        self.assertEqual(RedisHelper.flush_dirty_counts(), 2)
+        self.assertEqual(Tweet.objects.get(id=tweets[0].id).likes_count, 2)
+        self.assertEqual(Tweet.objects.get(id=tweets[1].id).comments_count, 1)
+        self.assertEqual(RedisHelper.flush_dirty_counts(), 0)
+
+        # 上一次 flush 中途失败，留下的 flushing hash 下一次会先写回
+        RedisHelper.incr_count_by_id(Tweet, 'likes_count', tweets[0].id, 1)
+        conn.rename(DIRTY_COUNTS_KEY, FLUSHING_COUNTS_KEY)
+        RedisHelper.incr_count_by_id(Tweet, 'likes_count', tweets[0].id, 1)
+        self.assertEqual(RedisHelper.flush_dirty_counts(), 1)
+        self.assertEqual(Tweet.objects.get(id=tweets[0].id).likes_count, 3)
+        self.assertEqual(RedisHelper.flush_dirty_counts(), 1)
+        self.assertEqual(Tweet.objects.get(id=tweets[0].id).likes_count, 4)
+        self.assertEqual(conn.get(key), b'4')
+
+        # 上一次 flush 在 commit 之前退出，留下的 batch 下一次写回
+        field = RedisHelper.get_dirty_count_field(Tweet, 'likes_count', tweets[0].id)
+        conn.hset(FLUSH_BATCH_COUNTS_KEY, field, 2)
+        conn.set(FLUSH_BATCH_TOKEN_KEY, 'token1')
+        self.assertEqual(RedisHelper.flush_dirty_counts(), 1)
+        self.assertEqual(Tweet.objects.get(id=tweets[0].id).likes_count, 6)
+        self.assertEqual(conn.exists(FLUSH_BATCH_COUNTS_KEY, FLUSH_BATCH_TOKEN_KEY), 0)
+        self.assertEqual(CountFlushBatch.objects.count(), 0)
+
+        # 上一次 flush 在 commit 之后、清理 batch 之前退出，token 已经在数据库里，不会重复写入
+        conn.hset(FLUSH_BATCH_COUNTS_KEY, field, 2)
+        conn.set(FLUSH_BATCH_TOKEN_KEY, 'token2')
+        CountFlushBatch.objects.create(token='token2')
+        self.assertEqual(RedisHelper.flush_dirty_counts(), 1)
+        self.assertEqual(Tweet.objects.get(id=tweets[0].id).likes_count, 6)
+        self.assertEqual(conn.exists(FLUSH_BATCH_COUNTS_KEY, FLUSH_BATCH_TOKEN_KEY), 0)
+        self.assertEqual(CountFlushBatch.objects.count(), 0)
+
+        # 有一批增量正在写回数据库的时候（版本号是奇数），load 出来的计数可能不准，不写入 cache
+        conn.delete(key)
+        conn.incr(DIRTY_COUNTS_VERSION_KEY)
+        self.assertEqual(RedisHelper.get_count(tweets[0], 'likes_count'), 6)
+        self.assertEqual(conn.exists(key), 0)
+        self.assertEqual(RedisHelper.incr_count_by_id(Tweet, 'likes_count', tweets[0].id, 1), 7)
+        self.assertEqual(conn.exists(key), 0)
+        # 下一次 flush 写回增量之后版本号恢复成偶数
+        self.assertEqual(RedisHelper.flush_dirty_counts(), 1)
+        self.assertEqual(Tweet.objects.get(id=tweets[0].id).likes_count, 7)
+        self.assertEqual(RedisHelper.get_count(tweets[0], 'likes_count'), 7)
+        self.assertEqual(conn.get(key), b'7')
+
+    def test_batch_push_objects(self):
+        linghu = self.create_user('linghu')
+        tweets = [self.create_tweet(linghu) for _ in range(3)]
+        conn = RedisClient.get_connection()
+        warm_key = RedisHelper.get_zset_key('warm_key')
+        conn.zadd(warm_key, {DjangoModelSerializer.serialize(tweets[0]): to_timestamp(tweets[0].created_at)})
+
+        cold_keys = RedisHelper.batch_push_objects(
+            ['warm_key', 'cold_key'],
+            [tweets[1], tweets[2]],
+        )
+        self.assertEqual(cold_keys, ['cold_key'])
+        self.assertEqual(conn.exists(RedisHelper.get_zset_key('cold_key')), False)
+        self.assertEqual(conn.ttl(warm_key) > 0, True)
+        cached_list = conn.zrevrange(warm_key, 0, -1)
+        self.assertEqual(
+            [DjangoModelSerializer.deserialize(data).id for data in cached_list],
+            [tweets[1].id, tweets[0].id],
+        )
+
+        # 正在重建的 key 等重建结束之后再 push，不会丢失重建时还没有读到的 object
+        def stale_rebuild():
+            conn.zadd(
+                RedisHelper.get_zset_key('rebuilding_key'),
+                {DjangoModelSerializer.serialize(tweets[0]): to_timestamp(tweets[0].created_at)},
+            )
+            conn.delete('rebuilding_key:lock')
+
+        conn.set('rebuilding_key:lock', 'other', ex=10)
+        rebuild = threading.Timer(0.1, stale_rebuild)
+        rebuild.start()
+        cold_keys = RedisHelper.batch_push_objects(
+            ['rebuilding_key', 'cold_key'],
+            [tweets[2], tweets[2]],
+        )
+        rebuild.join()
+        self.assertEqual(cold_keys, ['cold_key'])
+        self.assertEqual(conn.zcard(RedisHelper.get_zset_key('rebuilding_key')), 2)
+
+    def test_remove_object(self):
+        linghu = self.create_user('linghu')
+        tweets = [self.create_tweet(linghu) for _ in range(settings.REDIS_LIST_LENGTH_LIMIT)]
+        conn = RedisClient.get_connection()
+        zset_key = RedisHelper.get_zset_key('some_key')
+        for tweet in tweets[:3]:
+            conn.zadd(zset_key, {DjangoModelSerializer.serialize(tweet): to_timestamp(tweet.created_at)})
+
+        self.assertEqual(RedisHelper.remove_object('some_key', tweets[1]), True)
+        self.assertEqual(RedisHelper.remove_object('some_key', tweets[1]), False)
+        cached_list = conn.zrevrange(zset_key, 0, -1)
+        self.assertEqual(
+            [DjangoModelSerializer.deserialize(data).id for data in cached_list],
+            [tweets[2].id, tweets[0].id],
+        )
+
+        # 达到长度上限的时候删除整个 sorted set，否则会被当成已经包含了所有的数据
+        for tweet in tweets:
+            conn.zadd(zset_key, {DjangoModelSerializer.serialize(tweet): to_timestamp(tweet.created_at)})
+        self.assertEqual(RedisHelper.remove_object('some_key', tweets[0]), True)
+        self.assertEqual(conn.exists(zset_key), False)
+
+    def test_compact_model_serializer(self):
+        linghu = self.create_user('linghu')
+        tweet = self.create_tweet(linghu, 'compact tweet')
+        serializer = CompactModelSerializer(COMPACT_SERIALIZED_PATTERNS[USER_TWEETS_PATTERN])
+        data = serializer.serialize(tweet)
+        self.assertEqual(CompactModelSerializer.is_compact(data), True)
+        self.assertEqual(CompactModelSerializer.is_compact(DjangoModelSerializer.serialize(tweet)), False)
+        # model label 由 key pattern 决定，不会存在每个 object 里
+        self.assertEqual(b'tweets.Tweet' in data, False)
+        cached_tweet = serializer.deserialize(data)
+        self.assertEqual(cached_tweet, tweet)
+        self.assertEqual(cached_tweet.content, 'compact tweet')
+        self.assertEqual(cached_tweet.created_at, tweet.created_at)
+
+        newsfeed_serializer = CompactModelSerializer(COMPACT_SERIALIZED_PATTERNS[USER_NEWSFEEDS_PATTERN])
+        newsfeed = HBaseNewsFeed(user_id=linghu.id, created_at=tweet.timestamp, tweet_id=tweet.id)
+        cached_newsfeed = newsfeed_serializer.deserialize(newsfeed_serializer.serialize(newsfeed))
+        self.assertEqual(isinstance(cached_newsfeed, HBaseNewsFeed), True)
+        self.assertEqual(cached_newsfeed.row_key, newsfeed.row_key)
+        self.assertEqual(cached_newsfeed.tweet_id, tweet.id)
+
+        # unknown schema version / truncated data / empty data
+        for bad_data in [bytes([0]) + data[1:], data[:-3], data[:1], b'']:
+            try:
+                serializer.deserialize(bad_data)
+                exception_raised = False
+            except SchemaMismatchError:
+                exception_raised = True
+            self.assertEqual(exception_raised, True)
+
+    def test_load_objects_single_flight(self):
+        linghu = self.create_user('linghu')
+        tweets = [self.create_tweet(linghu) for _ in range(3)][::-1]
+        conn = RedisClient.get_connection()
+        key = 'tweets_key'
+        zset_key = RedisHelper.get_zset_key(key)
+
+        def lazy_load(limit):
+            lazy_load.calls += 1
+            return tweets[:limit]
+        lazy_load.calls = 0
+
+        # create_tweet 的时候 push 到 user_tweets 也会重建 cache，只看这之后的次数
+        rebuilds = RedisHelper.get_cache_rebuild_metrics()['rebuilds']
+
+        # 重建 cache 的时候整个替换掉旧的 sorted set，不会出现重复的数据
+        RedisHelper.load_objects(key, lazy_load)
+        RedisHelper._load_objects_to_cache(key, tweets)
+        self.assertEqual(conn.zcard(zset_key), 3)
+        self.assertEqual(lazy_load.calls, 1)
+        self.assertEqual(RedisHelper.get_cache_rebuild_metrics()['rebuilds'], rebuilds + 1)
+
+        # 别人正在重建 cache 的时候等待，而不是去访问数据库
+        conn.delete(zset_key)
+        conn.set('{}:lock'.format(key), 'other', ex=10)
+        rebuild = threading.Timer(0.1, lambda: RedisHelper._load_objects_to_cache(key, tweets))
+        rebuild.start()
+        objects = RedisHelper.load_objects(key, lazy_load)
+        rebuild.join()
+        self.assertEqual([obj.id for obj in objects], [tweet.id for tweet in tweets])
+        self.assertEqual(lazy_load.calls, 1)
+        self.assertEqual(RedisHelper.get_cache_rebuild_metrics()['herd_suppressed'], 1)
+
+        # 重复 push 同一个 object 不会重复写入
+        RedisHelper.push_object(key, tweets[0], lazy_load)
+        self.assertEqual(conn.zcard(zset_key), 3)
+
+        # 别人正在重建 cache 并且读到的数据里还没有 tweets[0]，push 不访问数据库，等重建结束之后再 push
+        def stale_rebuild():
+            RedisHelper._load_objects_to_cache(key, tweets[1:])
+            conn.delete('{}:lock'.format(key))
+
+        conn.delete(zset_key)
+        conn.set('{}:lock'.format(key), 'other', ex=10)
+        rebuild = threading.Timer(0.1, stale_rebuild)
+        rebuild.start()
+        RedisHelper.push_object(key, tweets[0], lazy_load)
+        rebuild.join()
+        self.assertEqual(conn.zcard(zset_key), 3)
+        self.assertEqual(lazy_load.calls, 1)
+
+        # 重建的人一直不释放 lock，等待超时之后 push 失败，cache 也还不存在
+        conn.delete(zset_key)
+        conn.set('{}:lock'.format(key), 'other', ex=10)
+        started_at = time.time()
+        RedisHelper.push_object(key, tweets[0], lazy_load)
+        self.assertEqual(time.time() - started_at >= settings.REDIS_REBUILD_WAIT_TIMEOUT, True)
+        self.assertEqual(conn.exists(zset_key), 0)
+        self.assertEqual(lazy_load.calls, 1)
+
+    def test_load_objects_in_range(self):
+        linghu = self.create_user('linghu')
+        tweets = [self.create_tweet(linghu) for _ in range(5)][::-1]
+        timestamps = [to_timestamp(tweet.created_at) for tweet in tweets]
+        conn = RedisClient.get_connection()
+        key = 'tweets_key'
+
+        def lazy_load(limit):
+            lazy_load.calls += 1
+            return tweets[:limit]
+        lazy_load.calls = 0
+
+        # cache miss 的时候 list 和 sorted set 一起重建
+        objects, is_complete = RedisHelper.load_objects_in_range(key, lazy_load, limit=2)
+        self.assertEqual([obj.id for obj in objects], [tweets[0].id, tweets[1].id])
+        self.assertEqual(is_complete, True)
+        self.assertEqual(conn.zcard(RedisHelper.get_zset_key(key)), 5)
+        self.assertEqual(conn.ttl(RedisHelper.get_zset_key(key)) > 0, True)
+
+        # cache hit，只读取需要的那一段
+        objects, _ = RedisHelper.load_objects_in_range(
+            key,
+            lazy_load,
+            max_timestamp=timestamps[1],
+            limit=2,
+        )
+        self.assertEqual([obj.id for obj in objects], [tweets[2].id, tweets[3].id])
+        objects, _ = RedisHelper.load_objects_in_range(key, lazy_load, min_timestamp=timestamps[2])
+        self.assertEqual([obj.id for obj in objects], [tweets[0].id, tweets[1].id])
+        self.assertEqual(lazy_load.calls, 1)
+
+        # push 的时候同时更新 sorted set
+        new_tweet = self.create_tweet(linghu)
+        RedisHelper.push_object(key, new_tweet, lazy_load)
+        objects, _ = RedisHelper.load_objects_in_range(key, lazy_load, min_timestamp=timestamps[0])
+        self.assertEqual([obj.id for obj in objects], [new_tweet.id])
+
+        # 只有 list 没有 sorted set 的旧 cache 当做 cache miss，重建之后删掉旧的 list
+        conn.delete(RedisHelper.get_zset_key(key))
+        conn.rpush(key, DjangoModelSerializer.serialize(tweets[0]))
+        objects, _ = RedisHelper.load_objects_in_range(
+            key,
+            lazy_load,
+            max_timestamp=timestamps[0],
+            limit=2,
+        )
+        self.assertEqual([obj.id for obj in objects], [tweets[1].id, tweets[2].id])
+        self.assertEqual(lazy_load.calls, 2)
+        self.assertEqual(conn.exists(key), 0)
+        self.assertEqual(conn.zcard(RedisHelper.get_zset_key(key)), 5)
+
+    def test_load_objects_in_range_with_same_created_at(self):
+        # created_at 相同的 members 在 sorted set 里按字节序排列，json 里的 tweet_id 9 排在 12 前面
+        timestamp = to_timestamp(utc_now())
+        newsfeeds = [
+            HBaseNewsFeed(user_id=1, created_at=timestamp, tweet_id=tweet_id)
+            for tweet_id in [12, 11, 10, 9, 8, 2]
+        ]
+        key = 'newsfeeds_key'
+        RedisHelper._load_objects_to_cache(key, newsfeeds)
+
+        def lazy_load(limit):
+            return newsfeeds[:limit]
+
+        # 每一页的最后一个 object 和下一页的第一个 object 的 created_at 相同，翻页不会丢失或者重复
+        tweet_ids, max_tie_breaker_id = [], None
+        for _ in range(3):
+            objects, _ = RedisHelper.load_objects_in_range(
+                key,
+                lazy_load,
+                max_timestamp=None if max_tie_breaker_id is None else timestamp,
+                max_tie_breaker_id=max_tie_breaker_id,
+                limit=2,
+                serializer=HBaseModelSerializer,
+            )
+            self.assertEqual(len(objects), 2)
+            tweet_ids += [obj.tweet_id for obj in objects]
+            max_tie_breaker_id = objects[-1].tweet_id
+        self.assertEqual(tweet_ids, [12, 11, 10, 9, 8, 2])
+
+    def test_paginate_ordered_list(self):
+        paginator = EndlessPagination()
+        page_size = paginator.page_size
+        timestamp = to_timestamp(utc_now())
+        # 相邻的两个 newsfeeds 使用相同的 created_at
+        newsfeeds = [
+            HBaseNewsFeed(user_id=1, created_at=timestamp - i // 2, tweet_id=i)
+            for i in range(page_size * 3)
+        ]
+
+        def paginate(**params):
+            request = Request(APIRequestFactory().get('/', params))
+            return [newsfeed.tweet_id for newsfeed in paginator.paginate_ordered_list(newsfeeds, request)]
+
+        self.assertEqual(paginate(), list(range(page_size)))
+        self.assertEqual(paginator.has_next_page, True)
+        self.assertEqual(paginate(created_at__lt=timestamp - 1), list(range(4, page_size + 4)))
+        self.assertEqual(paginate(created_at__lt=timestamp - page_size), list(range(page_size * 2 + 2, page_size * 3)))
+        self.assertEqual(paginator.has_next_page, False)
+        self.assertEqual(paginate(created_at__lt=timestamp - page_size * 2), [])
+        self.assertEqual(paginate(created_at__gt=timestamp - 2), [0, 1, 2, 3])
+        self.assertEqual(paginate(created_at__gt=timestamp), [])
+
+        # iso 格式和 int 格式的 cursor 是同一个时间
+        created_at = utc_now()
+        cursor = TimestampCursor.parse(created_at.isoformat())
+        self.assertEqual(cursor.timestamp, to_timestamp(created_at))
+        self.assertEqual(cursor.datetime, created_at)
+        self.assertEqual(TimestampCursor.parse(str(cursor.timestamp)).datetime, created_at)
+        # 没有时区的时间当做 UTC
+        naive_cursor = TimestampCursor.parse(created_at.replace(tzinfo=None).isoformat())
+        self.assertEqual(naive_cursor.timestamp, cursor.timestamp)
+
+        # 格式不对的时候返回 400，而不是 500
+        request = Request(APIRequestFactory().get('/', {'created_at__lt': 'not a time'}))
+        try:
+            TimestampCursor.from_request(request, 'created_at__lt')
+            exception_raised = False
+        except ValidationError as e:
+            exception_raised = True
+            self.assertEqual('created_at__lt' in e.detail, True)
+        self.assertEqual(exception_raised, True)
+
+    def test_paginate_with_tie_breaker(self):
+        paginator = EndlessPagination()
+        page_size = paginator.page_size
+        created_at = utc_now()
+        # 所有 tweets 的 created_at 都相同，只能靠 id 区分先后
+        tweets = [
+            Tweet(id=i, user_id=1, created_at=created_at)
+            for i in range(page_size * 2, 0, -1)
+        ]
+
+        request = Request(APIRequestFactory().get('/'))
+        page = paginator.paginate_ordered_list(tweets, request)
+        self.assertEqual(page, tweets[:page_size])
+        cursor = TimestampCursor.decode(paginator.next_cursor)
+        self.assertEqual(cursor.timestamp, to_timestamp(created_at))
+        self.assertEqual(cursor.tie_breaker_id, tweets[page_size - 1].id)
+        self.assertEqual(cursor.source, 'cache')
+
+        request = Request(APIRequestFactory().get('/', {'cursor': paginator.next_cursor}))
+        page = paginator.paginate_ordered_list(tweets, request)
+        self.assertEqual(page, tweets[page_size:])
+        self.assertEqual(paginator.has_next_page, False)
+        self.assertEqual(paginator.next_cursor, None)
+
+        # 上一页是从数据库里读取的，不再读取 cache
+        cursor = TimestampCursor(to_timestamp(created_at), tweets[0].id, 'mysql').encode()
+        request = Request(APIRequestFactory().get('/', {'cursor': cursor}))
+        self.assertEqual(paginator.paginate_cached_list(tweets, request), None)
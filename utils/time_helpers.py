@@ -1,6 +1,73 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import bisect
 import pytz
 
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
 def utc_now():
-    return datetime.now().replace(tzinfo=pytz.utc)
\ No newline at end of file
+    return datetime.now().replace(tzinfo=pytz.utc)
+
+
+def to_timestamp(created_at):
+    # 把 datetime 转换成 int 类型的 microseconds，hbase 里的 created_at 本身就是 int，直接返回
+    # 用整数运算而不是 created_at.timestamp() * 1000000，避免浮点数误差导致差 1 microsecond
+    if isinstance(created_at, datetime):
+        return (created_at - EPOCH) // timedelta(microseconds=1)
+    return int(created_at)
+
+
+
+def from_timestamp(timestamp):
+    return EPOCH + timedelta(microseconds=timestamp)
+
+
+class _NegatedTimestamps:
+    # 按 created_at 倒序排列的 objects 对应的 -timestamp 是升序的，可以直接用于 bisect
+    # 只在 bisect 访问到的下标上计算 timestamp，不需要先遍历整个 list
+    def __init__(self, reverse_ordered_list):
+        self.reverse_ordered_list = reverse_ordered_list
+
+    def __len__(self):
+        return len(self.reverse_ordered_list)
+
+    def __getitem__(self, index):
+        return -to_timestamp(self.reverse_ordered_list[index].created_at)
+
+
+def get_tie_breaker_id(obj):
+    # created_at 相同的 objects 之间按照 id 倒序排列
+    # 没有 pk 的 newsfeeds（hbase 的 newsfeeds 以及 merge 的时候临时创建的 newsfeeds）用 tweet_id
+    # 同一个 user 的 newsfeeds 里 tweet_id 不会重复，并且是稳定的，每次 merge 出来的顺序都一样
+    pk = getattr(obj, 'pk', None)
+    if pk:
+        return pk
+    return getattr(obj, 'tweet_id', None) or 0
+
+
+def get_ordering_key(obj):
+    # 按 (created_at, id) 排序时使用的 key，和 reverse_ordered_range 的顺序一致
+    return to_timestamp(obj.created_at), get_tie_breaker_id(obj)
+
+
+def reverse_ordered_range(reverse_ordered_list, min_timestamp=None, max_timestamp=None, max_tie_breaker_id=None):
+    """
+    二分查找按 (created_at, id) 倒序排列的 list 里 min_timestamp < created_at < max_timestamp 的部分
+    max_tie_breaker_id 不为 None 的时候，created_at == max_timestamp 并且 id < max_tie_breaker_id 的也包含在内
+    返回下标范围 (start, stop)，只需要计算 O(log n) 个 objects 的 timestamp
+    """
+    timestamps = _NegatedTimestamps(reverse_ordered_list)
+    start = 0
+    if max_timestamp is not None:
+        start = bisect.bisect_right(timestamps, -max_timestamp)
+        if max_tie_breaker_id is not None:
+            # created_at 相同的 objects 一般只有几个，逐个比较 id 即可
+            index = bisect.bisect_left(timestamps, -max_timestamp)
+            while index < start and get_tie_breaker_id(reverse_ordered_list[index]) >= max_tie_breaker_id:
+                index += 1
+            start = index
+    stop = len(reverse_ordered_list)
+    if min_timestamp is not None:
+        stop = bisect.bisect_left(timestamps, -min_timestamp)
+    return start, max(start, stop)